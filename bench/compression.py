@@ -0,0 +1,112 @@
+"""NATS payload compression: encode/decode CPU time against bytes on the
+wire, per algorithm and level, on three kinds of payload: the usual
+telegram.update mix, large updates (join waves) and telegram.sync.chatmembers
+batches. Then the share of traffic compressed, and the bytes saved, at a few
+thresholds for the configured algorithm. No services needed.
+
+    python -m bench.compression --payloads 5000 --thresholds 1024,4096,16384
+
+zstd rows appear only with zstandard installed.
+"""
+import argparse
+import json
+import random
+import time
+from typing import List, Tuple
+
+from bench.report import write_report
+from bench.synthetic import SyntheticUpdates
+from common.compression import PayloadCompression, zstandard
+from common.config import NATS_COMPRESSION_CFG
+
+CODECS = [("zlib", 1), ("zlib", 6), ("zlib", 9)]
+if zstandard is not None:
+    CODECS += [("zstd", 1), ("zstd", 3), ("zstd", 9)]
+
+
+def corpora(payloads: int, seed: int) -> List[Tuple[str, List[bytes]]]:
+    mix = SyntheticUpdates(seed=seed)
+    waves = SyntheticUpdates(seed=seed, mix={"join_wave": 1}, join_wave_size=200)
+    rng = random.Random(seed)
+    return [
+        ("updates", [
+            json.dumps({"event_id": event_id, "update": mix.next()}).encode() for event_id in range(payloads)
+        ]),
+        ("join waves", [
+            json.dumps({"event_id": event_id, "update": waves.next()}).encode()
+            for event_id in range(max(1, payloads // 10))
+        ]),
+        ("sync.chatmembers", [
+            json.dumps({
+                "user_ids": [rng.randint(10_000_000, 7_000_000_000) for _ in range(rng.randint(50, 2000))],
+                "chat_id": -1001000000000 - rng.randint(0, 20),
+                "timestamp": "2026-01-01T00:00:00",
+            }).encode()
+            for _ in range(max(1, payloads // 10))
+        ]),
+    ]
+
+
+def run(compression: PayloadCompression, payloads: List[bytes]) -> Tuple[float, float, int, int, int]:
+    # Returns encode and decode seconds per payload, raw and wire bytes, and
+    # how many payloads went out compressed.
+    for data, headers in [compression.compress(payload, None) for payload in payloads[:200]]:
+        compression.decompress(data, headers)
+
+    encoded = []
+    started = time.perf_counter()
+    for payload in payloads:
+        encoded.append(compression.compress(payload, None))
+    encode = (time.perf_counter() - started) / len(payloads)
+
+    started = time.perf_counter()
+    for data, headers in encoded:
+        compression.decompress(data, headers)
+    decode = (time.perf_counter() - started) / len(payloads)
+
+    raw = sum(len(payload) for payload in payloads)
+    wire = sum(len(data) for data, _ in encoded)
+    return encode, decode, raw, wire, sum(1 for _, headers in encoded if headers)
+
+
+def main(payloads: int, seed: int, thresholds: List[int]):
+    sets = corpora(payloads, seed)
+    lines = []
+    for label, data in sets:
+        sizes = sorted(len(payload) for payload in data)
+        lines.append(
+            f"{label}: {len(data)} payloads, median {sizes[len(sizes) // 2]} bytes, max {sizes[-1]} bytes"
+        )
+        for algorithm, level in CODECS:
+            # Threshold 0: the cost of compressing every payload of this kind.
+            compression = PayloadCompression({"algorithm": algorithm, "level": level, "threshold": 0})
+            encode, decode, raw, wire, _ = run(compression, data)
+            lines.append(
+                f"  {algorithm:>4} {level}: encode {encode * 1e6:8.1f} us, decode {decode * 1e6:7.1f} us | "
+                f"wire {wire / raw:6.1%} of raw | "
+                f"{(raw - wire) / max(encode + decode, 1e-9) / len(data) / 1e6:7.1f} MB saved per CPU second"
+            )
+
+    algorithm = NATS_COMPRESSION_CFG.get("algorithm") or "zlib"
+    level = NATS_COMPRESSION_CFG.get("level", 1)
+    everything = [payload for _, data in sets for payload in data]
+    lines.append(f"thresholds, {algorithm} {level}, all payloads:")
+    for threshold in thresholds:
+        compression = PayloadCompression({"algorithm": algorithm, "level": level, "threshold": threshold})
+        encode, decode, raw, wire, compressed = run(compression, everything)
+        lines.append(
+            f"  {threshold:>6} bytes: {compressed / len(everything):6.1%} of messages compressed | "
+            f"wire {wire / raw:6.1%} of raw, {(raw - wire) / 1024:.0f} KiB saved | "
+            f"encode {encode * 1e6:.1f} us, decode {decode * 1e6:.1f} us per message"
+        )
+
+    write_report(f"NATS payload compression: seed {seed}", lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--payloads", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--thresholds", default="1024,4096,16384")
+    args = parser.parse_args()
+    main(args.payloads, args.seed, [int(t) for t in args.thresholds.split(",")])
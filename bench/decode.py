@@ -0,0 +1,100 @@
+"""Decoding telegram.update payloads: json.loads into dicts (what handlers
+walked before common.models) vs the typed models, per update time and the
+memory the decoded updates hold on to. No services needed.
+
+    python -m bench.decode --updates 20000
+
+Reports which backend the models used (msgspec or __slots__ classes).
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+from typing import Callable, List
+
+from bench.report import percentile, write_report
+from bench.synthetic import SyntheticUpdates
+from common.models import msgspec, decode_event, classify_message
+
+DICT_TYPES = ("text", "audio", "video", "video_note", "voice", "animation", "document", "photo", "sticker")
+
+
+def dict_path(payload: bytes):
+    # The fields the handlers read, the way they read them from dicts.
+    data = json.loads(payload.decode())
+    message = data.get("update", {}).get("message", {})
+    if message:
+        message.get("from", {}).get("id")
+        message.get("chat", {}).get("type")
+        message_type = "other"
+        for key in DICT_TYPES:
+            if key in message:
+                message_type = key
+                break
+        message.get("reply_to_message", {}).get("message_id")
+    return data
+
+
+def model_path(payload: bytes):
+    event = decode_event(payload)
+    message = event.update.message if event.update else None
+    if message:
+        message.from_.id
+        message.chat.type
+        classify_message(message)
+        message.reply_to_message.message_id if message.reply_to_message else None
+    return event
+
+
+def timings(decode: Callable, payloads: List[bytes]) -> List[float]:
+    times = []
+    for payload in payloads:
+        started = time.perf_counter()
+        decode(payload)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def retained(decode: Callable, payloads: List[bytes]) -> float:
+    # Bytes held per decoded update while all of them are kept alive.
+    gc.collect()
+    tracemalloc.start()
+    decoded = [decode(payload) for payload in payloads]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del decoded
+    return size / len(payloads)
+
+
+def main(updates: int, seed: int):
+    generator = SyntheticUpdates(seed=seed)
+    payloads = [
+        json.dumps({"event_id": event_id, "update": generator.next()}).encode()
+        for event_id in range(updates)
+    ]
+    average = sum(len(payload) for payload in payloads) / len(payloads)
+
+    lines = []
+    for label, decode in (("dict", dict_path), ("models", model_path)):
+        timings(decode, payloads[:1000])
+        times = timings(decode, payloads)
+        lines.append(
+            f"{label:>6}: {sum(times) / len(times) * 1e6:.1f} us/update "
+            f"(p99 {percentile(times, 99) * 1e6:.1f} us) | "
+            f"{retained(decode, payloads):.0f} bytes retained/update"
+        )
+
+    backend = f"msgspec {msgspec.__version__}" if msgspec is not None else "__slots__ classes"
+    write_report(
+        f"update decoding: {updates} synthetic updates, {average:.0f} bytes average, models on {backend}",
+        lines
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    main(args.updates, args.seed)
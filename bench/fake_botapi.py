@@ -0,0 +1,156 @@
+"""Local stand-in for the Telegram Bot API.
+
+Answers the methods this service calls with plausible results, after a
+configurable latency, and injects 429 responses at a configurable rate.
+Point the service at it with TELEGRAM_API_URL=http://127.0.0.1:<port>.
+"""
+import asyncio
+import json
+import random
+from collections import Counter
+from typing import Dict, Any, Optional
+from urllib.parse import parse_qsl
+
+STATUSES = ("member",) * 8 + ("administrator", "left")
+
+
+class FakeBotAPI:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8081,
+        latency_ms: float = 50,
+        jitter_ms: float = 20,
+        rate_429: float = 0.0,
+        retry_after: int = 1,
+        seed: Optional[int] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+        self.calls = Counter()
+        self.throttled = 0
+        self.connections = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode().split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode().partition(":")
+                    headers[key.strip().lower()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, payload = await self._dispatch(path, headers, body)
+
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, path: str, headers: Dict[str, str], body: bytes):
+        method = path.rstrip("/").rsplit("/", 1)[-1]
+        params = {}
+        if headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            params = dict(parse_qsl(body.decode()))
+
+        delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms))
+        await asyncio.sleep(delay / 1000)
+
+        if "/file/" in path:
+            self.calls["file"] += 1
+            return 200, {}
+
+        self.calls[method] += 1
+        if self.random.random() < self.rate_429:
+            self.throttled += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        return 200, {"ok": True, "result": self._result(method, params)}
+
+    def _result(self, method: str, params: Dict[str, str]) -> Any:
+        if method == "getChatMember":
+            return {
+                "status": self.random.choice(STATUSES),
+                "user": {"id": int(params.get("user_id", 0)), "is_bot": False, "first_name": "Bench"},
+            }
+        if method == "getChat":
+            chat_id = int(params.get("chat_id", 0))
+            return {"id": chat_id, "type": "supergroup", "title": f"Bench chat {chat_id}"}
+        if method == "getUserProfilePhotos":
+            return {"total_count": 0, "photos": []}
+        if method == "getFile":
+            return {"file_id": params.get("file_id"), "file_path": "photos/bench.jpg"}
+        if method == "sendMessage":
+            return {
+                "message_id": self.random.randint(1, 2**31),
+                "chat": {"id": int(params.get("chat_id", 0))},
+                "text": params.get("text", ""),
+            }
+        return True
+
+
+async def main(port: int, latency_ms: float, rate_429: float):
+    api = FakeBotAPI(port=port, latency_ms=latency_ms, rate_429=rate_429)
+    await api.start()
+    print(f"Fake Bot API listening on {api.url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    args = parser.parse_args()
+    asyncio.run(main(args.port, args.latency_ms, args.rate_429))
@@ -0,0 +1,92 @@
+"""Event loop stall caused by logging: direct RotatingFileHandler vs the
+queued handlers installed by common.logs.enqueue_handlers.
+
+    python -m bench.logging_stall --records 50000 --burst 50 [--fsync] [--dir LOG_PATH]
+"""
+import argparse
+import asyncio
+import logging
+import logging.handlers
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from bench.report import percentile, write_report
+from common.logs import enqueue_handlers, stop_listener
+
+
+class FsyncRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def flush(self):
+        super().flush()
+        if self.stream:
+            os.fsync(self.stream.fileno())
+
+
+def file_logger(name: str, directory: str, fsync: bool) -> logging.Logger:
+    log = logging.getLogger(name)
+    log.propagate = False
+    log.setLevel(logging.INFO)
+    handler_class = FsyncRotatingFileHandler if fsync else logging.handlers.RotatingFileHandler
+    handler = handler_class(
+        Path(directory, f"{name}.log"), maxBytes=1024*1024, backupCount=3, encoding="utf-8"
+    )
+    handler.setFormatter(logging.Formatter(
+        '%(levelname)s %(asctime)s %(name)s %(process)d %(thread)d %(message)s'
+    ))
+    log.addHandler(handler)
+    return log
+
+
+async def measure(log: logging.Logger, records: int, burst: int):
+    lags = []
+    running = True
+
+    async def ticker():
+        while running:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - started - 0.001)
+
+    tick = asyncio.create_task(ticker())
+    in_logging = 0.0
+    for i in range(0, records, burst):
+        started = time.perf_counter()
+        for j in range(burst):
+            log.info(f"Inserted message {i + j} in database.")
+        in_logging += time.perf_counter() - started
+        await asyncio.sleep(0)
+
+    running = False
+    await tick
+    return in_logging, lags
+
+
+async def main(records: int, burst: int, fsync: bool, directory: str):
+    lines = []
+    with tempfile.TemporaryDirectory(dir=directory) as directory:
+        direct = file_logger("bench_direct", directory, fsync)
+        queued = file_logger("bench_queued", directory, fsync)
+        listener = enqueue_handlers({'loggers': {'bench_queued': {}}})
+
+        for label, log in (("direct", direct), ("queued", queued)):
+            in_logging, lags = await measure(log, records, burst)
+            lines.append(
+                f"{label:>7}: on-loop logging {in_logging*1000:.1f} ms total, "
+                f"{in_logging/records*1e6:.2f} us/record | loop lag "
+                f"p50 {percentile(lags, 50)*1000:.3f} ms, p99 {percentile(lags, 99)*1000:.3f} ms, "
+                f"max {max(lags, default=0)*1000:.3f} ms"
+            )
+        stop_listener(listener)
+
+    write_report(f"logging stall: {records} records, bursts of {burst}, fsync={fsync}", lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=50000)
+    parser.add_argument("--burst", type=int, default=50)
+    parser.add_argument("--fsync", action="store_true", help="fsync after every record, like a slow or durable disk")
+    parser.add_argument("--dir", default=None, help="directory to write the log files in (defaults to the system temp dir)")
+    args = parser.parse_args()
+    asyncio.run(main(args.records, args.burst, args.fsync, args.dir))
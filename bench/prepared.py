@@ -0,0 +1,89 @@
+"""Message insert path with text queries vs the prepared statements declared
+in handlers.update: per query client CPU and latency.
+
+Needs the throwaway MySQL bench.run uses (same MYSQL_* variables); the rows
+it inserts go to a chat id no real chat has and are deleted afterwards.
+
+    python -m bench.prepared --iterations 5000
+"""
+import argparse
+import time
+from datetime import datetime
+
+from bench.report import percentile, write_report
+from bench.run import setup_schema
+from common.mysql import MySQL as db
+from handlers.update import SELECT_MESSAGE_ID, INSERT_MESSAGE
+
+BENCH_CHAT_ID = -42
+
+
+def statement_counters() -> dict:
+    rows = db.execute_query("SHOW GLOBAL STATUS LIKE 'Com_stmt_%';")
+    return {row['Variable_name']: int(row['Value']) for row in rows}
+
+
+def message_path(select_query, insert_query, message_id: int):
+    # What handle_message does per new message: dedupe lookup, then insert.
+    db.execute_query(select_query, (BENCH_CHAT_ID, message_id), fetch_one=True)
+    db.execute_insert(
+        insert_query,
+        (message_id, 1, 1, BENCH_CHAT_ID, datetime.now(), None, "text", False)
+    )
+
+
+def measure(select_query, insert_query, first_id: int, iterations: int):
+    cpu, wall = [], []
+    for message_id in range(first_id, first_id + iterations):
+        started_cpu = time.process_time()
+        started = time.perf_counter()
+        message_path(select_query, insert_query, message_id)
+        wall.append((time.perf_counter() - started) / 2)
+        cpu.append((time.process_time() - started_cpu) / 2)
+    return cpu, wall
+
+
+def main(iterations: int, warmup: int):
+    setup_schema(reset=False)
+    db.primary.warm_up()
+
+    modes = (
+        ("text", str(SELECT_MESSAGE_ID), str(INSERT_MESSAGE)),
+        ("prepared", SELECT_MESSAGE_ID, INSERT_MESSAGE),
+    )
+    lines = []
+    next_id = 1
+    try:
+        for label, select_query, insert_query in modes:
+            measure(select_query, insert_query, next_id, warmup)
+            next_id += warmup
+
+            before = statement_counters()
+            cpu, wall = measure(select_query, insert_query, next_id, iterations)
+            after = statement_counters()
+            next_id += iterations
+
+            prepares = after.get("Com_stmt_prepare", 0) - before.get("Com_stmt_prepare", 0)
+            lines.append(
+                f"{label:>8}: cpu {sum(cpu) / len(cpu) * 1e6:.1f} us/query | latency "
+                f"p50 {percentile(wall, 50) * 1000:.3f} ms, p99 {percentile(wall, 99) * 1000:.3f} ms | "
+                f"server prepares {prepares}"
+            )
+    finally:
+        db.execute_update(
+            "DELETE FROM `kopilot_telegram`.`message` WHERE `chat_id` = %s;", (BENCH_CHAT_ID,)
+        )
+
+    write_report(
+        f"prepared statements: message insert path, {iterations} iterations, "
+        f"pool of {db.primary.opened}",
+        lines
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--warmup", type=int, default=200)
+    args = parser.parse_args()
+    main(args.iterations, args.warmup)
@@ -0,0 +1,32 @@
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, List
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+BENCH_OUTPUT = BASE_DIR / "bench_output.txt"
+
+
+def percentile(values: Iterable[float], pct: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def write_report(title: str, lines: List[str]):
+    header = f"== {title} | {revision()} | {datetime.now().isoformat(timespec='seconds')}"
+    text = "\n".join([header] + lines)
+    print(text)
+    with open(BENCH_OUTPUT, "a", encoding="utf-8") as f:
+        f.write(text + "\n\n")
@@ -0,0 +1,256 @@
+"""End-to-end throughput benchmark.
+
+Needs a local nats-server and a throwaway MySQL, configured through the same
+NATS_URL / MYSQL_* variables main.py uses. The run:
+
+1. creates the kopilot_telegram schema from migrations/ (and a minimal
+   kopilot_events.raw_events table) if it does not exist yet,
+2. starts the fake Bot API and points TELEGRAM_API_URL at it,
+3. runs the service in-process, or uses one already running with --external
+   (it must then be started with TELEGRAM_API_URL pointing at --api-port),
+4. publishes synthetic updates to telegram.update and waits for each one's
+   telegram.update.processed / telegram.update.error_processing.
+
+    python -m bench.run --updates 5000 --concurrency 100 --latency-ms 50 --rate-429 0.01
+
+With --soak SECONDS it instead publishes updates at --rate per second for
+that long and checks the service's resources for leaks (see bench.soak);
+it exits with status 1 when one keeps growing.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+import mysql.connector
+import nats
+
+from bench.fake_botapi import FakeBotAPI
+from bench.soak import soak
+from bench.report import percentile, write_report, BASE_DIR
+from bench.synthetic import SyntheticUpdates
+
+load_dotenv()
+
+RAW_EVENTS_DDL = """
+CREATE TABLE IF NOT EXISTS `kopilot_events`.`raw_events` (
+    `id` BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+    `source` VARCHAR(32) NOT NULL DEFAULT 'telegram',
+    `payload` JSON NOT NULL,
+    `processed` BOOLEAN DEFAULT FALSE,
+    `processed_at` DATETIME(6) NULL,
+    `status` ENUM('pending', 'done', 'failed') DEFAULT 'pending',
+    `error_message` TEXT NULL,
+    `retry_count` INT DEFAULT 0,
+    `date_created` DATETIME(6) DEFAULT CURRENT_TIMESTAMP(6),
+
+    INDEX `idx_status` (`status`)
+);
+"""
+
+
+def mysql_connect(**kwargs):
+    return mysql.connector.connect(
+        host=os.environ.get("MYSQL_HOST"),
+        user=os.environ.get("MYSQL_USER"),
+        password=os.environ.get("MYSQL_PASSWORD"),
+        **kwargs
+    )
+
+
+def setup_schema(reset: bool):
+    con = mysql_connect()
+    cursor = con.cursor()
+    try:
+        if reset:
+            cursor.execute("DROP DATABASE IF EXISTS `kopilot_telegram`;")
+            cursor.execute("DROP DATABASE IF EXISTS `kopilot_events`;")
+
+        cursor.execute("SHOW DATABASES LIKE 'kopilot_telegram';")
+        exists = cursor.fetchone() is not None
+
+        cursor.execute("CREATE DATABASE IF NOT EXISTS `kopilot_telegram`;")
+        cursor.execute("CREATE DATABASE IF NOT EXISTS `kopilot_events`;")
+        cursor.execute(RAW_EVENTS_DDL)
+
+        if not exists:
+            cursor.execute("USE `kopilot_telegram`;")
+            for migration in sorted(Path(BASE_DIR, "migrations").glob("*.sql")):
+                for statement in migration.read_text().split(";"):
+                    if statement.strip():
+                        cursor.execute(statement)
+                print(f"Applied {migration.name}")
+        con.commit()
+    finally:
+        cursor.close()
+        con.close()
+
+
+def store_raw_events(updates) -> list:
+    con = mysql_connect(database="kopilot_events")
+    cursor = con.cursor()
+    try:
+        cursor.execute("SELECT COALESCE(MAX(`id`), 0) FROM `raw_events`;")
+        first_id = cursor.fetchone()[0] + 1
+        rows = [(first_id + i, json.dumps(update)) for i, update in enumerate(updates)]
+        for start in range(0, len(rows), 1000):
+            cursor.executemany(
+                "INSERT INTO `raw_events` (`id`, `payload`) VALUES (%s, %s);",
+                rows[start:start + 1000]
+            )
+        con.commit()
+        return [row[0] for row in rows]
+    finally:
+        cursor.close()
+        con.close()
+
+
+async def service_counters(client) -> dict:
+    response = await client.request("telegram.debug.metrics", b"", timeout=5)
+    return json.loads(response.data.decode()).get("counters", {})
+
+
+async def run(args):
+    api = FakeBotAPI(
+        port=args.api_port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        rate_429=args.rate_429, seed=args.seed
+    )
+    await api.start()
+    os.environ["TELEGRAM_API_URL"] = api.url
+
+    setup_schema(args.reset)
+    generator = SyntheticUpdates(
+        chats=args.chats, users_per_chat=args.users_per_chat, seed=args.seed,
+        # Join waves would otherwise grow the generator itself during a soak.
+        max_members=args.users_per_chat if args.soak else None,
+    )
+    if not args.soak:
+        updates = [generator.next() for _ in range(args.updates)]
+        event_ids = store_raw_events(updates)
+
+    service = None
+    if not args.external:
+        # Imported here so common.config picks up TELEGRAM_API_URL above.
+        from main import NATSService
+        from common.config import configure_logging
+        configure_logging()
+        service = NATSService()
+        asyncio.create_task(service.start())
+        await asyncio.sleep(1)
+
+    client = await nats.connect(os.environ.get("NATS_URL"), name="kopilot_bench")
+    if args.soak:
+        try:
+            return await soak(args, client, store_raw_events, generator)
+        finally:
+            await client.close()
+            if service:
+                await service.stop()
+            await api.stop()
+
+    try:
+        before = await service_counters(client)
+        calls_before = api.total_calls
+
+        pending = {}
+        latencies = []
+        failed = 0
+        window = asyncio.Semaphore(args.concurrency)
+        done = asyncio.Event()
+
+        async def on_result(msg):
+            nonlocal failed
+            data = json.loads(msg.data.decode())
+            sent = pending.pop(data.get("event_id"), None)
+            if sent is None:
+                return
+            latencies.append(time.perf_counter() - sent)
+            if msg.subject.endswith("error_processing"):
+                failed += 1
+            window.release()
+            if not pending and len(latencies) == len(updates):
+                done.set()
+
+        await client.subscribe("telegram.update.processed", cb=on_result)
+        await client.subscribe("telegram.update.error_processing", cb=on_result)
+
+        started = time.perf_counter()
+        for event_id, update in zip(event_ids, updates):
+            await window.acquire()
+            pending[event_id] = time.perf_counter()
+            await client.publish(
+                "telegram.update",
+                json.dumps({"event_id": event_id, "update": update}).encode()
+            )
+
+        try:
+            await asyncio.wait_for(done.wait(), timeout=args.timeout)
+        except asyncio.TimeoutError:
+            print(f"Timed out with {len(pending)} updates still pending")
+        elapsed = time.perf_counter() - started
+
+        # Let the raw_events status handlers settle before reading counters.
+        await asyncio.sleep(1)
+        after = await service_counters(client)
+        api_calls = api.total_calls - calls_before
+    finally:
+        await client.close()
+        if service:
+            await service.stop()
+        await api.stop()
+
+    completed = max(len(latencies), 1)
+    queries = after.get("mysql.queries", 0) - before.get("mysql.queries", 0)
+    write_report(
+        f"e2e: {args.updates} updates, concurrency {args.concurrency}, "
+        f"api latency {args.latency_ms}ms, 429 rate {args.rate_429}",
+        [
+            f"completed: {len(latencies)} ({failed} failed, {len(pending)} timed out)",
+            f"throughput: {len(latencies) / elapsed:.1f} updates/s over {elapsed:.2f}s",
+            f"latency: p50 {percentile(latencies, 50)*1000:.1f} ms, "
+            f"p99 {percentile(latencies, 99)*1000:.1f} ms, max {max(latencies, default=0)*1000:.1f} ms",
+            f"db queries/update: {queries / completed:.2f}",
+            f"bot api calls/update: {api_calls / completed:.2f} ({api.throttled} answered 429)",
+        ]
+    )
+    return True
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=100, help="max updates in flight")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users-per-chat", type=int, default=200)
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--reset", action="store_true", help="drop and recreate the bench databases")
+    parser.add_argument("--external", action="store_true", help="bench a service that is already running")
+
+    soak_args = parser.add_argument_group("soak")
+    soak_args.add_argument("--soak", type=float, default=0, help="run for this many seconds and check for leaks")
+    soak_args.add_argument("--rate", type=float, default=50, help="updates/s published during a soak")
+    soak_args.add_argument("--batch", type=int, default=1000, help="raw_events rows stored at a time")
+    soak_args.add_argument("--sample-interval", type=float, default=60)
+    soak_args.add_argument("--soak-warmup", type=float, default=600, help="seconds before slopes are measured")
+    soak_args.add_argument("--max-slope", action="append", metavar="NAME=PER_HOUR",
+                           help="growth limit for a sampled series, e.g. rss_mb=50")
+    soak_args.add_argument("--no-tracemalloc", action="store_true")
+    soak_args.add_argument("--tracemalloc-frames", type=int, default=1)
+
+    args = parser.parse_args(argv)
+    if args.soak and args.external:
+        parser.error("--soak samples this process and cannot be used with --external")
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(0 if asyncio.run(run(parse_args())) else 1)
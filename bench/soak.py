@@ -0,0 +1,260 @@
+"""Soak mode of bench.run: synthetic updates at a steady rate for hours,
+with the process's resources sampled every `--sample-interval` seconds.
+
+Each sample records RSS, traced Python memory, open file descriptors,
+open sockets, asyncio tasks and the service's in-memory queues (Bot API
+limiter waiters, NATS messages delivered but not handled, deferred
+background work, rollup keys), plus the cache size for reference. After
+the warm-up, the growth of each series is fitted with a least-squares
+slope; the run fails when one grows faster per hour than its limit in
+SLOPES (`--max-slope name=value` to change one). The tracemalloc lines
+that grew the most since the end of the warm-up are reported too. The
+limits are per hour: over much shorter runs the slopes mostly measure
+noise, and the warm-up should cover the caches filling up.
+
+The service has to run in-process (no --external): everything is sampled
+from this process.
+
+    python -m bench.run --soak 14400 --rate 100 --sample-interval 60
+"""
+import asyncio
+import json
+import os
+import resource
+import time
+import tracemalloc
+from typing import Dict, List, Optional, Tuple
+
+from bench.report import percentile, write_report
+
+# Allowed growth per hour after the warm-up.
+SLOPES = {
+    "rss_mb": 20.0,
+    "traced_mb": 10.0,
+    "fds": 5.0,
+    "sockets": 5.0,
+    "tasks": 20.0,
+    "queued": 200.0,
+}
+
+
+def slope(points: List[Tuple[float, float]]) -> float:
+    """Least-squares slope of (seconds, value) points, per hour."""
+    if len(points) < 2:
+        return 0.0
+    n = len(points)
+    mean_t = sum(t for t, _ in points) / n
+    mean_v = sum(v for _, v in points) / n
+    variance = sum((t - mean_t) ** 2 for t, _ in points)
+    if not variance:
+        return 0.0
+    return sum((t - mean_t) * (v - mean_v) for t, v in points) / variance * 3600
+
+
+class ResourceSampler:
+    def __init__(self, trace: bool = True, frames: int = 1):
+        self.trace = trace
+        self.frames = frames
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def start(self):
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self):
+        if self.trace and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def rss_mb(self) -> float:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self._page_size / 2**20
+        except OSError:
+            # Peak rather than current RSS, in KiB on Linux.
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    @staticmethod
+    def descriptors() -> Tuple[Optional[int], Optional[int]]:
+        # (open fds, of which sockets); None where /proc is not available.
+        try:
+            names = os.listdir("/proc/self/fd")
+        except OSError:
+            return None, None
+        sockets = 0
+        for name in names:
+            try:
+                if os.readlink(f"/proc/self/fd/{name}").startswith("socket:"):
+                    sockets += 1
+            except OSError:
+                pass
+        return len(names), sockets
+
+    @staticmethod
+    def service_queues() -> Dict[str, int]:
+        from common.cache import cache
+        from common.lanes import LANES
+        from common.nats_server import nc
+        from common.rollup import rollup
+        from common.telegram import TelegramBot
+
+        delivered = sum(nc.pending(lane) for lane in LANES)
+        return {
+            "queued": TelegramBot.waiting + delivered + len(nc.background.deferred) + rollup.pending,
+            "cache": len(cache),
+        }
+
+    def sample(self) -> Dict[str, float]:
+        fds, sockets = self.descriptors()
+        values = {
+            "rss_mb": self.rss_mb(),
+            "tasks": len(asyncio.all_tasks()),
+        }
+        if fds is not None:
+            values["fds"] = fds
+            values["sockets"] = sockets
+        if self.trace:
+            values["traced_mb"] = tracemalloc.get_traced_memory()[0] / 2**20
+        values.update(self.service_queues())
+        return values
+
+    def set_baseline(self):
+        if self.trace:
+            self.baseline = tracemalloc.take_snapshot()
+
+    def top_growth(self, limit: int = 10) -> List[str]:
+        if self.baseline is None:
+            return []
+        stats = tracemalloc.take_snapshot().compare_to(self.baseline, "lineno")
+        return [
+            f"    {stat.size_diff / 1024:+10.1f} KiB {stat.count_diff:+8d} blocks  {stat.traceback}"
+            for stat in stats[:limit] if stat.size_diff > 0
+        ]
+
+
+async def soak(args, client, store_raw_events, generator) -> bool:
+    """Publishes `generator`'s updates at `args.rate` per second for
+    `args.soak` seconds and returns whether every slope stayed in bounds."""
+    limits = dict(SLOPES)
+    for item in args.max_slope or ():
+        name, _, value = item.partition("=")
+        limits[name] = float(value)
+
+    sampler = ResourceSampler(trace=not args.no_tracemalloc, frames=args.tracemalloc_frames)
+    sampler.start()
+
+    pending: Dict[int, float] = {}
+    latencies: List[float] = []
+    totals = {"sent": 0, "done": 0, "failed": 0, "lost": 0}
+    window = asyncio.Semaphore(args.concurrency)
+
+    async def on_result(msg):
+        data = json.loads(msg.data.decode())
+        sent = pending.pop(data.get("event_id"), None)
+        if sent is None:
+            return
+        latencies.append(time.perf_counter() - sent)
+        totals["done"] += 1
+        if msg.subject.endswith("error_processing"):
+            totals["failed"] += 1
+        window.release()
+
+    subscriptions = [
+        await client.subscribe("telegram.update.processed", cb=on_result),
+        await client.subscribe("telegram.update.error_processing", cb=on_result),
+    ]
+
+    async def publish():
+        gap = 1 / args.rate
+        next_at = time.perf_counter()
+        while True:
+            updates = [generator.next() for _ in range(args.batch)]
+            event_ids = await asyncio.to_thread(store_raw_events, updates)
+            for event_id, update in zip(event_ids, updates):
+                await window.acquire()
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                next_at = max(next_at + gap, time.perf_counter() - 1)
+                pending[event_id] = time.perf_counter()
+                totals["sent"] += 1
+                await client.publish(
+                    "telegram.update", json.dumps({"event_id": event_id, "update": update}).encode()
+                )
+
+    publisher = asyncio.create_task(publish())
+    started = time.perf_counter()
+    series: Dict[str, List[Tuple[float, float]]] = {}
+    lines = []
+    baseline_set = False
+    try:
+        while True:
+            await asyncio.sleep(args.sample_interval)
+            elapsed = time.perf_counter() - started
+            if publisher.done():
+                publisher.result()
+
+            # Updates whose result never came back would hold the window.
+            now = time.perf_counter()
+            for event_id, sent in list(pending.items()):
+                if now - sent > args.timeout:
+                    del pending[event_id]
+                    totals["lost"] += 1
+                    window.release()
+
+            values = sampler.sample()
+            if elapsed >= args.soak_warmup:
+                if not baseline_set:
+                    sampler.set_baseline()
+                    baseline_set = True
+                for name, value in values.items():
+                    series.setdefault(name, []).append((elapsed, value))
+
+            line = (
+                f"{elapsed:8.0f}s "
+                + " ".join(f"{name} {value:.1f}" if isinstance(value, float) else f"{name} {value}"
+                           for name, value in values.items())
+                + f" | {len(latencies) / args.sample_interval:.1f} updates/s, "
+                f"p99 {percentile(latencies, 99) * 1000:.0f} ms"
+            )
+            print(line, flush=True)
+            lines.append("  " + line)
+            latencies.clear()
+            if elapsed >= args.soak:
+                break
+    finally:
+        publisher.cancel()
+        try:
+            await publisher
+        except asyncio.CancelledError:
+            pass
+        for sub in subscriptions:
+            await sub.unsubscribe()
+
+    ok = True
+    verdicts = []
+    for name, points in sorted(series.items()):
+        growth = slope(points)
+        limit = limits.get(name)
+        over = limit is not None and len(points) >= 3 and growth > limit
+        ok = ok and not over
+        verdicts.append(
+            f"  {name:<10} {growth:+10.2f}/h"
+            + (f" (limit {limit:g}/h)" if limit is not None else " (not checked)")
+            + (" GROWING" if over else "")
+        )
+    if min((len(points) for points in series.values()), default=0) < 3:
+        verdicts.append("  fewer than 3 samples after the warm-up: slopes not checked")
+
+    report = [
+        f"sent {totals['sent']}, completed {totals['done']} ({totals['failed']} failed), "
+        f"{totals['lost']} lost after {args.timeout:g}s",
+        "samples:",
+    ] + lines + [f"slopes after {args.soak_warmup:g}s warm-up:"] + verdicts
+    growth = sampler.top_growth()
+    if growth:
+        report += ["top allocation growth since the warm-up (tracemalloc):"] + growth
+    report.append("PASS" if ok else "FAIL: resources kept growing")
+    write_report(f"soak: {args.soak:g}s at {args.rate:g} updates/s", report)
+    sampler.stop()
+    return ok
@@ -0,0 +1,72 @@
+"""Cold import time of the service, against a budget.
+
+Imports main in `--runs` fresh interpreters and takes the median; one more
+run under -X importtime gives the per-module breakdown. It also checks that
+the modules meant to load lazily (PIL, httpx, nats) are not loaded by the
+import. Exits with status 1 when over budget or when one of them is, so it
+can gate a change. No services needed.
+
+    python -m bench.startup --runs 10 --budget-ms 250
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+from bench.report import write_report, BASE_DIR
+from common.startup import StartupProfile
+
+DEFAULT_BUDGET_MS = 250
+LAZY_MODULES = ("PIL.Image", "httpx", "nats")
+
+MEASURE = """
+import sys, time
+started = time.perf_counter()
+import main
+elapsed = time.perf_counter() - started
+eager = [
+    name for name in {lazy!r}
+    if name in sys.modules and type(sys.modules[name]).__name__ != "_LazyModule"
+]
+print(elapsed, ",".join(eager))
+"""
+
+
+def measure() -> tuple:
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE.format(lazy=LAZY_MODULES)],
+        cwd=BASE_DIR, capture_output=True, text=True, env=dict(os.environ), check=True
+    )
+    elapsed, _, eager = result.stdout.strip().splitlines()[-1].partition(" ")
+    return float(elapsed), [name for name in eager.split(",") if name]
+
+
+def main(runs: int, budget_ms: float) -> bool:
+    times, eager = [], set()
+    for _ in range(runs):
+        elapsed, loaded = measure()
+        times.append(elapsed)
+        eager.update(loaded)
+    median_ms = statistics.median(times) * 1000
+
+    _, entries = StartupProfile.import_times("main")
+    over = median_ms > budget_ms
+    lines = [
+        f"import main: median {median_ms:.1f} ms, min {min(times) * 1000:.1f} ms, "
+        f"max {max(times) * 1000:.1f} ms over {runs} runs | budget {budget_ms:.0f} ms"
+        + (" | OVER BUDGET" if over else ""),
+        "loaded eagerly, should be lazy: " + (", ".join(sorted(eager)) if eager else "none"),
+        "breakdown (-X importtime, one run):",
+    ]
+    lines.extend(StartupProfile.summarize(entries))
+    write_report(f"startup: cold import of main, {runs} runs", lines)
+    return not over and not eager
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=float(os.environ.get("STARTUP_BUDGET_MS", DEFAULT_BUDGET_MS)))
+    args = parser.parse_args()
+    sys.exit(0 if main(args.runs, args.budget_ms) else 1)
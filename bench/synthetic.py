@@ -0,0 +1,199 @@
+"""Synthetic Telegram updates shaped like the ones the webhook stores in
+kopilot_events.raw_events: group messages, replies, reactions, join waves,
+chat_member changes and the occasional private message.
+"""
+import random
+import time
+from collections import deque
+from typing import Dict, Any, List, Optional
+
+DEFAULT_MIX = {
+    "message": 60,
+    "reply": 15,
+    "reaction": 15,
+    "join_wave": 2,
+    "chat_member": 5,
+    "private": 3,
+}
+
+MESSAGE_KINDS = (
+    ("text", 70), ("photo", 8), ("sticker", 8), ("voice", 4), ("video", 3),
+    ("animation", 3), ("document", 2), ("video_note", 1), ("audio", 1),
+)
+
+WORDS = (
+    "salam", "chetori", "kopilot", "bot", "group", "link", "photo", "today",
+    "tomorrow", "meeting", "thanks", "ok", "lol", "price", "please", "who",
+)
+
+
+class SyntheticUpdates:
+    def __init__(
+        self,
+        chats: int = 20,
+        users_per_chat: int = 200,
+        mix: Optional[Dict[str, int]] = None,
+        join_wave_size: int = 25,
+        seed: Optional[int] = None,
+        max_members: Optional[int] = None,
+    ):
+        self.random = random.Random(seed)
+        self.mix = mix or DEFAULT_MIX
+        self.join_wave_size = join_wave_size
+        self.max_members = max_members
+
+        self.update_id = 0
+        self.next_user_id = 10_000_000
+        self.chats = [
+            {"id": -1001000000000 - i, "title": f"Bench group {i}", "type": "supergroup"}
+            for i in range(chats)
+        ]
+        self.members: Dict[int, List[dict]] = {
+            chat["id"]: [self._new_user() for _ in range(users_per_chat)] for chat in self.chats
+        }
+        self.next_message_id = {chat["id"]: 1 for chat in self.chats}
+        self.recent: Dict[int, deque] = {chat["id"]: deque(maxlen=200) for chat in self.chats}
+        # A few chats are much busier than the rest, like real deployments.
+        self.chat_weights = [1 / (rank + 1) for rank in range(chats)]
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Dict[str, Any]:
+        return self.next()
+
+    def next(self) -> Dict[str, Any]:
+        kind = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        self.update_id += 1
+        update = getattr(self, f"_{kind}")()
+        update["update_id"] = self.update_id
+        return update
+
+    def _new_user(self) -> dict:
+        self.next_user_id += 1
+        user = {"id": self.next_user_id, "is_bot": False, "first_name": f"User{self.next_user_id}"}
+        if self.random.random() < 0.6:
+            user["username"] = f"user_{self.next_user_id}"
+        if self.random.random() < 0.3:
+            user["last_name"] = "Bench"
+        return user
+
+    def _pick_chat(self) -> dict:
+        return self.random.choices(self.chats, weights=self.chat_weights)[0]
+
+    def _text(self) -> str:
+        return " ".join(self.random.choices(WORDS, k=self.random.randint(1, 20)))
+
+    def _message_body(self, chat: dict, user: dict) -> dict:
+        message_id = self.next_message_id[chat["id"]]
+        self.next_message_id[chat["id"]] += 1
+
+        message = {
+            "message_id": message_id,
+            "from": user,
+            "chat": chat,
+            "date": int(time.time()),
+        }
+        kind = self.random.choices(
+            [k for k, _ in MESSAGE_KINDS], weights=[w for _, w in MESSAGE_KINDS]
+        )[0]
+        if kind == "text":
+            message["text"] = self._text()
+            if self.random.random() < 0.1:
+                message["entities"] = [
+                    {"type": "mention", "offset": 0, "length": 5} for _ in range(self.random.randint(1, 10))
+                ]
+        elif kind == "photo":
+            message["photo"] = [
+                {"file_id": f"AgAC{message_id}_{size}", "file_unique_id": f"u{message_id}{size}",
+                 "width": size, "height": size, "file_size": size * 90}
+                for size in (90, 320, 800, 1280)
+            ]
+            message["caption"] = self._text()
+        else:
+            message[kind] = {"file_id": f"{kind}_{message_id}", "file_unique_id": f"u{message_id}"}
+
+        if self.random.random() < 0.05:
+            message["forward_from"] = self._new_user()
+
+        self.recent[chat["id"]].append(message)
+        return message
+
+    def _message(self) -> dict:
+        chat = self._pick_chat()
+        user = self.random.choice(self.members[chat["id"]])
+        return {"message": self._message_body(chat, user)}
+
+    def _reply(self) -> dict:
+        chat = self._pick_chat()
+        if not self.recent[chat["id"]]:
+            return self._message()
+        original = self.random.choice(self.recent[chat["id"]])
+        user = self.random.choice(self.members[chat["id"]])
+        message = self._message_body(chat, user)
+        # Telegram does not nest reply_to_message in a reply_to_message.
+        message["reply_to_message"] = {key: value for key, value in original.items() if key != "reply_to_message"}
+        return {"message": message}
+
+    def _reaction(self) -> dict:
+        chat = self._pick_chat()
+        if not self.recent[chat["id"]]:
+            return self._message()
+        original = self.random.choice(self.recent[chat["id"]])
+        return {
+            "message_reaction": {
+                "chat": chat,
+                "message_id": original["message_id"],
+                "user": self.random.choice(self.members[chat["id"]]),
+                "date": int(time.time()),
+                "old_reaction": [],
+                "new_reaction": [{"type": "emoji", "emoji": self.random.choice("👍❤🔥😁👏")}],
+            }
+        }
+
+    def _join_wave(self) -> dict:
+        chat = self._pick_chat()
+        joined = [self._new_user() for _ in range(self.random.randint(1, self.join_wave_size))]
+        adder = self.random.choice(self.members[chat["id"]])
+        self.members[chat["id"]].extend(joined)
+        if self.max_members and len(self.members[chat["id"]]) > self.max_members:
+            del self.members[chat["id"]][:-self.max_members]
+
+        message = {
+            "message_id": self.next_message_id[chat["id"]],
+            "from": adder,
+            "chat": chat,
+            "date": int(time.time()),
+            "new_chat_members": joined,
+            "new_chat_member": joined[0],
+            "new_chat_participant": joined[0],
+        }
+        self.next_message_id[chat["id"]] += 1
+        return {"message": message}
+
+    def _chat_member(self) -> dict:
+        chat = self._pick_chat()
+        user = self.random.choice(self.members[chat["id"]])
+        performer = self.random.choice(self.members[chat["id"]])
+        old, new = self.random.choice((("member", "left"), ("left", "member"), ("member", "kicked")))
+        return {
+            "chat_member": {
+                "chat": chat,
+                "from": performer,
+                "date": int(time.time()),
+                "old_chat_member": {"user": user, "status": old},
+                "new_chat_member": {"user": user, "status": new},
+            }
+        }
+
+    def _private(self) -> dict:
+        user = self.random.choice(self.members[self._pick_chat()["id"]])
+        return {
+            "message": {
+                "message_id": self.random.randint(1, 2**31),
+                "from": user,
+                "chat": {"id": user["id"], "first_name": user["first_name"], "type": "private"},
+                "date": int(time.time()),
+                "text": self._text(),
+            }
+        }
@@ -0,0 +1,140 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+from common.config import CACHE_CFG
+from common.metrics import metrics
+
+_MISSING = object()
+
+
+class Cache:
+    """Bounded LRU with per-entry expiry and tag-based invalidation.
+
+    Each entry has a weight (1 unless given, e.g. the row count of a page);
+    least-recently-used entries are evicted once the total weight exceeds
+    `maxsize`, so memory stays bounded no matter how many chats are queried.
+
+    Invalidations (and patches) stamp their key or tag with a generation.
+    A filler takes `generation()` before its read and passes it to `set()`,
+    which drops the value if the key or one of its tags was stamped since:
+    the read may predate the write. `settling()` tells whether a stamp is
+    recent enough (`settle` seconds) that a replica may still serve the old
+    row, so the filler should read from the primary. The latest `stamps`
+    stamps are kept; older ones only raise a floor that every fill must pass.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, settle: float = 10, stamps: int = 100_000):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.settle = settle
+        self.max_stamps = stamps
+        self.weight = 0
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._tags: Dict[Hashable, Set[Hashable]] = {}
+        self._generation = 0
+        self._stamps: "OrderedDict[Hashable, Tuple[int, float]]" = OrderedDict()
+        self._floor: Tuple[int, float] = (0, float("-inf"))
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            metrics.incr("cache.misses")
+            return default
+        expires, value, _, _ = entry
+        if expires < time.monotonic():
+            self._drop(key)
+            metrics.incr("cache.misses")
+            return default
+        self._data.move_to_end(key)
+        metrics.incr("cache.hits")
+        return value
+
+    def set(
+        self,
+        key: Hashable,
+        value: Any,
+        tags: Iterable[Hashable] = (),
+        ttl: Optional[float] = None,
+        weight: int = 1,
+        since: Optional[int] = None
+    ):
+        tags = tuple(tags)
+        if since is not None and self._stamped_after(since, (key, *tags)):
+            metrics.incr("cache.stale_fills")
+            return
+        self._drop(key)
+        self._data[key] = (time.monotonic() + (ttl or self.ttl), value, tags, weight)
+        self.weight += weight
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while self.weight > self.maxsize and len(self._data) > 1:
+            self._drop(next(iter(self._data)))
+            metrics.incr("cache.evictions")
+        metrics.gauge("cache.weight", self.weight)
+
+    def generation(self) -> int:
+        return self._generation
+
+    def settling(self, *names: Hashable) -> bool:
+        """Whether any of the keys or tags `names` was invalidated or patched
+        within the last `settle` seconds."""
+        since = time.monotonic() - self.settle
+        if self._floor[1] > since:
+            return True
+        for name in names:
+            stamp = self._stamps.get(name)
+            if stamp is not None and stamp[1] > since:
+                return True
+        return False
+
+    def patch(self, key: Hashable, **fields):
+        self._stamp(key)
+        entry = self._data.get(key)
+        if entry is not None and isinstance(entry[1], dict):
+            entry[1].update(fields)
+
+    def invalidate(self, key: Hashable):
+        self._stamp(key)
+        self._drop(key)
+
+    def invalidate_tag(self, tag: Hashable):
+        self._stamp(tag)
+        for key in list(self._tags.get(tag, ())):
+            self._drop(key)
+
+    def _stamp(self, name: Hashable):
+        self._generation += 1
+        self._stamps[name] = (self._generation, time.monotonic())
+        self._stamps.move_to_end(name)
+        while len(self._stamps) > self.max_stamps:
+            _, self._floor = self._stamps.popitem(last=False)
+
+    def _stamped_after(self, generation: int, names: Iterable[Hashable]) -> bool:
+        if self._floor[0] > generation:
+            return True
+        for name in names:
+            stamp = self._stamps.get(name)
+            if stamp is not None and stamp[0] > generation:
+                return True
+        return False
+
+    def _drop(self, key: Hashable):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        self.weight -= entry[3]
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+cache = Cache(
+    CACHE_CFG.get("maxsize", 200_000), CACHE_CFG.get("ttl", 300),
+    CACHE_CFG.get("settle", 10), CACHE_CFG.get("stamps", 100_000)
+)
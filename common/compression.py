@@ -0,0 +1,109 @@
+import logging
+import zlib
+from typing import Dict, Any, Optional, Tuple
+
+from common.config import NATS_COMPRESSION_CFG
+from common.metrics import metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("nats")
+
+ENCODING_HEADER = "Content-Encoding"
+ZLIB, ZSTD, GZIP = "zlib", "zstd", "gzip"
+
+
+class PayloadCompression:
+    """Compression of NATS payloads above `threshold` bytes.
+
+    The algorithm travels in the Content-Encoding header, so a payload is
+    only compressed for subjects whose consumers understand it (`subjects`
+    prefixes) or in replies to requests that were compressed themselves;
+    anything arriving with the header is decompressed, whatever the
+    local settings. zstd needs the zstandard package and falls back to zlib
+    without it. gzip is only decompressed; export pieces are sent with it.
+    """
+
+    def __init__(self, cfg: Dict[str, Any] = NATS_COMPRESSION_CFG):
+        self.algorithm = cfg.get("algorithm")
+        if self.algorithm in ("", "none"):
+            self.algorithm = None
+        self.threshold = cfg.get("threshold", 4096)
+        self.level = cfg.get("level", 1)
+        self.subjects = tuple(cfg.get("subjects", ()))
+
+        if self.algorithm == ZSTD and zstandard is None:
+            logger.warning("NATS compression set to zstd but zstandard is not installed, using zlib")
+            self.algorithm = ZLIB
+        if self.algorithm not in (None, ZLIB, ZSTD):
+            raise ValueError(f"Unknown NATS compression {self.algorithm}")
+
+        self._zstd_compressor = None
+        self._zstd_decompressor = None
+        if zstandard is not None:
+            self._zstd_decompressor = zstandard.ZstdDecompressor()
+            if self.algorithm == ZSTD:
+                self._zstd_compressor = zstandard.ZstdCompressor(level=self.level)
+
+    def applies(self, subject: str) -> bool:
+        return self.algorithm is not None and subject.startswith(self.subjects)
+
+    def compress(self, payload: bytes, headers: Optional[Dict[str, str]]) -> Tuple[bytes, Optional[Dict[str, str]]]:
+        """Compresses `payload` if it is over the threshold and gets smaller;
+        returns the payload to send and its headers."""
+        if self.algorithm is None or len(payload) < self.threshold:
+            return payload, headers
+
+        if self.algorithm == ZSTD:
+            compressed = self._zstd_compressor.compress(payload)
+        else:
+            compressed = zlib.compress(payload, self.level)
+
+        if len(compressed) >= len(payload):
+            metrics.incr("nats.compression.incompressible")
+            return payload, headers
+
+        metrics.incr("nats.compression.messages")
+        metrics.incr("nats.compression.raw_bytes", len(payload))
+        metrics.incr("nats.compression.wire_bytes", len(compressed))
+        headers = dict(headers or {})
+        headers[ENCODING_HEADER] = self.algorithm
+        return compressed, headers
+
+    def decompress(self, payload: bytes, headers: Optional[Dict[str, str]]) -> bytes:
+        encoding = headers.get(ENCODING_HEADER) if headers else None
+        if not encoding or not payload:
+            return payload
+        if encoding == ZLIB:
+            data = zlib.decompress(payload)
+        elif encoding == GZIP:
+            data = zlib.decompress(payload, 16 + zlib.MAX_WBITS)
+        elif encoding == ZSTD:
+            if self._zstd_decompressor is None:
+                raise ValueError("Received a zstd payload but zstandard is not installed")
+            data = self._zstd_decompressor.decompress(payload)
+        else:
+            raise ValueError(f"Unsupported payload encoding {encoding}")
+        metrics.incr("nats.compression.decompressed")
+        return data
+
+    def stats(self) -> Dict[str, Any]:
+        counters = metrics.snapshot().get("counters", {})
+        raw = int(counters.get("nats.compression.raw_bytes", 0))
+        wire = int(counters.get("nats.compression.wire_bytes", 0))
+        return {
+            "algorithm": self.algorithm,
+            "level": self.level,
+            "threshold": self.threshold,
+            "subjects": list(self.subjects),
+            "compressed": int(counters.get("nats.compression.messages", 0)),
+            "incompressible": int(counters.get("nats.compression.incompressible", 0)),
+            "decompressed": int(counters.get("nats.compression.decompressed", 0)),
+            "raw_bytes": raw,
+            "wire_bytes": wire,
+            "bytes_saved": raw - wire,
+            "ratio": round(wire / raw, 3) if raw else None,
+        }
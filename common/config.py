@@ -1,10 +1,13 @@
 from dotenv import load_dotenv
 from pathlib import Path
 import os
+import tempfile
 import logging
 import logging.config
 import logging.handlers
 
+from common.logs import enqueue_handlers
+
 load_dotenv()
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -14,19 +17,180 @@ MYSQL_CFG = {
     'user': os.environ.get("MYSQL_USER"),
     'password': os.environ.get("MYSQL_PASSWORD"),
     'database': os.environ.get("MYSQL_DATABASE"),
-    'pool_size': 5,
+}
+
+# Every pool (primary and each replica) admits between min_size and max_size
+# concurrent queries, growing while callers wait longer than grow_wait_ms and
+# shrinking after shrink_after quiet resize intervals. Connections are opened
+# on demand up to max_size (mysql.connector caps a pool at 32).
+MYSQL_POOL_CFG = {
+    'min_size': int(os.environ.get("MYSQL_POOL_MIN", 5)),
+    'max_size': int(os.environ.get("MYSQL_POOL_MAX", 16)),
+    'grow_wait_ms': 10,
+    'shrink_after': 12,
+    'resize_interval': 5,
+    'ping_interval': 30,
+}
+
+# Comma separated hosts; the replicas share the primary's credentials. The
+# lag check needs the REPLICATION CLIENT privilege.
+MYSQL_REPLICA_CFGS = [
+    {**MYSQL_CFG, 'host': host.strip()}
+    for host in os.environ.get("MYSQL_REPLICA_HOSTS", "").split(",") if host.strip()
+]
+
+MYSQL_ROUTING_CFG = {
+    'max_replica_lag': float(os.environ.get("MYSQL_MAX_REPLICA_LAG", 5)),
+    'lag_check_interval': 5,
+}
+
+# Writes are diverted to the local spool while the primary is tripped: after
+# `errors` consecutive failures, a smoothed latency above `latency_ms`, or more
+# than `backlog` callers queued on the pool. It is retried after `cooldown`s.
+MYSQL_BREAKER_CFG = {
+    'errors': 3,
+    'latency_ms': int(os.environ.get("MYSQL_BREAKER_LATENCY_MS", 2000)),
+    'backlog': 50,
+    'cooldown': 5,
 }
 
 TELEGRAM_SECRET = os.environ.get("TELEGRAM_SECRET")
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org")
 
 MEDIA_PATH = os.environ.get("MEDIA_PATH")
+LOG_PATH = os.environ.get("LOG_PATH")
 
 NATS_CFG = {
     'servers': os.environ.get("NATS_URL"),
     'name': 'kopilot_telegram',
     'reconnect_time_wait': 2,
-    'max_reconnect_attempts': 10
+    'max_reconnect_attempts': 10,
+    # Also the shutdown deadline for in-flight handlers; keep it below the
+    # orchestrator's kill timeout.
+    'drain_timeout': int(os.environ.get("NATS_DRAIN_TIMEOUT", 25)),
+}
+
+# Payloads of at least `threshold` bytes on subjects starting with one of
+# `subjects` are published compressed (Content-Encoding header); only list
+# subjects whose consumers all decompress. algorithm: zlib, zstd (needs
+# zstandard) or none.
+NATS_COMPRESSION_CFG = {
+    'algorithm': os.environ.get("NATS_COMPRESSION", "zlib").lower(),
+    'threshold': int(os.environ.get("NATS_COMPRESSION_THRESHOLD", 4096)),
+    'level': int(os.environ.get("NATS_COMPRESSION_LEVEL", 1)),
+    'subjects': [
+        subject.strip()
+        for subject in os.environ.get("NATS_COMPRESS_SUBJECTS", "telegram.sync.,telegram.update.").split(",")
+        if subject.strip()
+    ],
+}
+
+TRACING_CFG = {
+    'enabled': os.environ.get("TRACING_ENABLED", "true").lower() == "true",
+    'slow_threshold_ms': int(os.environ.get("TRACING_SLOW_MS", 1000)),
+    'sample_rate': float(os.environ.get("TRACING_SAMPLE_RATE", 0)),
+    'service_name': 'kopilot_telegram',
+}
+
+REPLAY_CFG = {
+    'payload_column': os.environ.get("RAW_EVENTS_PAYLOAD_COLUMN", "payload"),
+    'batch_size': 500,
+    'workers': 8,
+    'checkpoint': LOG_PATH + "replay.checkpoint" if LOG_PATH else None,
+}
+
+# Background lane (sync, media) admission: it stops admitting, and shrinks,
+# while callers wait on the primary pool or the Bot API rate limiter beyond
+# these counts, or too many critical messages are queued. db_waiting is per
+# slot of the primary pool: 0.5 is half as many waiters as it has slots.
+LANES_CFG = {
+    'background_min': 1,
+    'background_max': int(os.environ.get("BACKGROUND_CONCURRENCY", 8)),
+    'interval': 1,
+    'max_deferred': 50_000,
+    'db_waiting': 0.5,
+    'telegram_waiting': 5,
+    'critical_queue': 100,
+}
+
+# Upper bound on concurrent steps per fan-out inside one update (e.g. the
+# members of a join wave).
+HANDLER_CFG = {
+    'fan_out': int(os.environ.get("UPDATE_FAN_OUT", 8)),
+}
+
+ROLLUP_CFG = {
+    'interval': float(os.environ.get("ROLLUP_FLUSH_INTERVAL", 5)),
+    'max_pending': 5000,
+}
+
+# Fills of a key or tag invalidated within `settle` seconds read from the
+# primary: until then a replica within the lag bound may still have the old
+# row. The last `stamps` invalidations are remembered.
+CACHE_CFG = {
+    'maxsize': int(os.environ.get("CACHE_MAXSIZE", 200_000)),
+    'ttl': 300,
+    'stats_ttl': 60,
+    'settle': MYSQL_ROUTING_CFG['max_replica_lag'] + MYSQL_ROUTING_CFG['lag_check_interval'],
+    'stamps': 100_000,
+}
+
+SPOOL_CFG = {
+    'path': os.environ.get("SPOOL_PATH") or (LOG_PATH + "spool.sqlite3" if LOG_PATH else None),
+    'batch_size': 200,
+    'interval': 1,
+}
+
+# Outbound queue (telegram.send / telegram.broadcast). Telegram allows about
+# 30 messages/s overall (TelegramBot's limiter), 1/s per private chat and
+# 20/min per group. A batch is picked from the first `scan` batches' worth
+# of due rows, each chat capped at what it can send within the lease.
+OUTBOUND_CFG = {
+    'batch_size': 200,
+    'scan': 10,
+    'interval': 1,
+    'concurrency': 25,
+    'lease': 60,
+    'private_gap': 1.0,
+    'group_gap': 3.0,
+    'max_wait': 5,
+    'max_attempts': 5,
+    'backoff': 2,
+    'backoff_max': 300,
+    'receipts_subject': 'telegram.outbound.receipts',
+    'receipts_batch': 500,
+}
+
+# telegram.export: each keyset page is one query of `page_size` rows,
+# fetched `batch_size` at a time. Files hold up to `chunk_rows` rows; inbox
+# messages up to `piece_bytes` of NDJSON before gzip.
+EXPORT_CFG = {
+    'path': os.environ.get("EXPORT_PATH") or (os.path.join(MEDIA_PATH, "exports") if MEDIA_PATH else None),
+    'page_size': 50_000,
+    'batch_size': 1000,
+    'chunk_rows': 500_000,
+    'piece_bytes': 512 * 1024,
+    'concurrency': 2,
+}
+
+PARTITION_CFG = {
+    'months_ahead': 3,
+    'retention_months': int(os.environ.get("PARTITION_RETENTION_MONTHS", 0)),
+    'archive_path': os.environ.get("ARCHIVE_PATH") or (os.path.join(MEDIA_PATH, "archive") if MEDIA_PATH else None),
+    'check_interval': 6 * 3600,
+}
+
+WATCHDOG_CFG = {
+    'interval': float(os.environ.get("WATCHDOG_INTERVAL", 0.1)),
+    'slow_callback_ms': int(os.environ.get("WATCHDOG_SLOW_CALLBACK_MS", 100)),
+    'history': 20,
+}
+
+PROFILER_CFG = {
+    'path': os.environ.get("PROFILE_PATH") or LOG_PATH or tempfile.gettempdir(),
+    'max_duration': 120,
+    'interval_ms': 5,
 }
 
 LOGGING_CFG = {
@@ -39,6 +203,17 @@ LOGGING_CFG = {
         'simple': {
             'format': '%(levelname)s %(message)s',
         },
+        'raw': {
+            'format': '%(message)s',
+        },
+    },
+    'filters': {
+        'hot_path': {
+            '()': 'common.logs.RateLimitFilter',
+            'rate': int(os.environ.get("LOG_RATE_LIMIT", 50)),
+            'burst': int(os.environ.get("LOG_RATE_BURST", 200)),
+            'sample_every': 100,
+        },
     },
     'handlers': {
         'console': {
@@ -49,7 +224,7 @@ LOGGING_CFG = {
         'main_file': {
             'level': 'INFO',
             'class': 'logging.handlers.RotatingFileHandler',
-            'filename': os.environ.get("LOG_PATH")+"main.log",
+            'filename': LOG_PATH+"main.log",
             'formatter': 'verbose',
             'encoding': 'utf-8',
             'maxBytes': 10*1024*1024,
@@ -58,7 +233,7 @@ LOGGING_CFG = {
         'mysql_file': {
             'level': 'INFO',
             'class': 'logging.handlers.RotatingFileHandler',
-            'filename': os.environ.get("LOG_PATH")+"mysql.log",
+            'filename': LOG_PATH+"mysql.log",
             'formatter': 'verbose',
             'encoding': 'utf-8',
             'maxBytes': 10*1024*1024,
@@ -67,7 +242,7 @@ LOGGING_CFG = {
         'telegram_file': {
             'level': 'INFO',
             'class': 'logging.handlers.RotatingFileHandler',
-            'filename': os.environ.get("LOG_PATH")+"telegram.log",
+            'filename': LOG_PATH+"telegram.log",
             'formatter': 'verbose',
             'encoding': 'utf-8',
             'maxBytes': 10*1024*1024,
@@ -76,35 +251,63 @@ LOGGING_CFG = {
         'nats_file': {
             'level': 'INFO',
             'class': 'logging.handlers.RotatingFileHandler',
-            'filename': os.environ.get("LOG_PATH")+"nats.log",
+            'filename': LOG_PATH+"nats.log",
             'formatter': 'verbose',
             'encoding': 'utf-8',
             'maxBytes': 10*1024*1024,
             'backupCount': 5,
         },
+        'traces_file': {
+            'level': 'INFO',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': LOG_PATH+"traces.json",
+            'formatter': 'raw',
+            'encoding': 'utf-8',
+            'maxBytes': 10*1024*1024,
+            'backupCount': 5,
+        },
     },
     'loggers': {
         '': {
+            'filters': ['hot_path'],
             'handlers': ['console', 'main_file'],
             'level': 'INFO',
             'propagate': False,
         },
         'mysql': {
+            'filters': ['hot_path'],
             'handlers': ['console', 'mysql_file'],
             'level': 'INFO',
             'propagate': False,
         },
         'telegram': {
+            'filters': ['hot_path'],
             'handlers': ['console', 'telegram_file'],
             'level': 'INFO',
             'propagate': False,
         },
         'nats': {
+            'filters': ['hot_path'],
             'handlers': ['console', 'nats_file'],
             'level': 'INFO',
             'propagate': False,
         },
+        'tracing': {
+            'handlers': ['traces_file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
 
-logging.config.dictConfig(LOGGING_CFG)
\ No newline at end of file
+log_listener = None
+
+
+def configure_logging():
+    """Applies LOGGING_CFG (opening the log files) and starts the queue
+    listener. Entry points call it once at startup, not on import."""
+    global log_listener
+    if log_listener is None:
+        logging.config.dictConfig(LOGGING_CFG)
+        log_listener = enqueue_handlers(LOGGING_CFG, secrets=(TELEGRAM_TOKEN, TELEGRAM_SECRET))
+    return log_listener
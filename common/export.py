@@ -0,0 +1,301 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import aclosing
+from datetime import datetime
+from typing import Dict, Any, Optional, List
+
+from common.config import EXPORT_CFG
+from common.metrics import metrics
+from common.mysql import MySQL as db
+from common.nats_server import nc
+from common.compression import ENCODING_HEADER, GZIP
+
+import anyio
+from anyio import CapacityLimiter, to_thread
+
+logger = logging.getLogger("mysql")
+
+# Exportable tables; `since`/`until` apply to the `date` of the ones that
+# have it (and prune their partitions).
+EXPORT_TABLES = {
+    "message": True,
+    "reaction": True,
+    "chatmember": False,
+}
+KEEP_FINISHED = 100
+
+
+class FileSink:
+    """Writes a table as <table>-<n>.ndjson.gz chunks of about `chunk_rows`
+    rows; a chunk only gets its final name once complete."""
+
+    def __init__(self, directory: str, table: str, chunk_rows: int):
+        self.directory = directory
+        self.table = table
+        self.chunk_rows = chunk_rows
+        self.files: List[Dict[str, Any]] = []
+        self._file = None
+        self._path = None
+        self._rows = 0
+
+    async def write(self, text: str, rows: int):
+        if self._file is None:
+            self._path = os.path.join(self.directory, f"{self.table}-{len(self.files) + 1:05d}.ndjson.gz")
+            self._file = await to_thread.run_sync(gzip.open, self._path + ".tmp", "wt", 6, "utf-8")
+            self._rows = 0
+        await to_thread.run_sync(self._file.write, text)
+        self._rows += rows
+        if self._rows >= self.chunk_rows:
+            await self._finish()
+
+    async def _finish(self):
+        await to_thread.run_sync(self._file.close)
+        await to_thread.run_sync(os.replace, self._path + ".tmp", self._path)
+        self.files.append({"file": os.path.basename(self._path), "rows": self._rows})
+        self._file = None
+
+    async def close(self):
+        if self._file is not None:
+            await self._finish()
+
+    async def abort(self):
+        if self._file is not None:
+            file, self._file = self._file, None
+            await to_thread.run_sync(file.close)
+            await to_thread.run_sync(os.remove, self._path + ".tmp")
+
+    def summary(self) -> Dict[str, Any]:
+        return {"files": self.files}
+
+
+class InboxSink:
+    """Publishes a table to `subject` as gzipped NDJSON pieces of about
+    `piece_bytes` uncompressed, flushing after each so at most one piece
+    is buffered."""
+
+    def __init__(self, subject: str, export_id: str, table: str, piece_bytes: int):
+        self.subject = subject
+        self.export_id = export_id
+        self.table = table
+        self.piece_bytes = piece_bytes
+        self.pieces = 0
+        self._buffer: List[str] = []
+        self._size = 0
+        self._rows = 0
+
+    async def write(self, text: str, rows: int):
+        self._buffer.append(text)
+        self._size += len(text)
+        self._rows += rows
+        if self._size >= self.piece_bytes:
+            await self._send()
+
+    async def _send(self):
+        payload = await to_thread.run_sync(gzip.compress, "".join(self._buffer).encode(), 6)
+        self.pieces += 1
+        await nc.pub_bytes(self.subject, payload, {
+            "Export-Id": self.export_id,
+            "Export-Table": self.table,
+            "Export-Piece": str(self.pieces),
+            "Export-Rows": str(self._rows),
+            "Content-Type": "application/x-ndjson",
+            ENCODING_HEADER: GZIP,
+        })
+        await nc.flush()
+        metrics.incr("export.bytes", len(payload))
+        self._buffer, self._size, self._rows = [], 0, 0
+
+    async def close(self):
+        if self._buffer:
+            await self._send()
+
+    async def abort(self):
+        self._buffer, self._size, self._rows = [], 0, 0
+
+    def summary(self) -> Dict[str, Any]:
+        return {"pieces": self.pieces}
+
+
+class ExportJob:
+    def __init__(
+        self, chat_id: int, tables: List[str], inbox: Optional[str],
+        since: Optional[datetime], until: Optional[datetime]
+    ):
+        self.id = uuid.uuid4().hex
+        self.chat_id = chat_id
+        self.tables = tables
+        self.inbox = inbox
+        self.since = since
+        self.until = until
+        self.path: Optional[str] = None
+        self.status = "queued"
+        self.error: Optional[str] = None
+        self.results: Dict[str, Dict[str, Any]] = {}
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "export_id": self.id,
+            "chat_id": self.chat_id,
+            "tables": self.tables,
+            "since": self.since.isoformat() if self.since else None,
+            "until": self.until.isoformat() if self.until else None,
+            "inbox": self.inbox,
+            "path": self.path,
+            "status": self.status,
+            "error": self.error,
+            "results": self.results,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class Exports:
+    """Streaming exports of one chat's history.
+
+    Each table is read in keyset pages by `id` (WHERE `id` > last ORDER BY
+    `id` LIMIT page_size), every page through an unbuffered cursor on a
+    replica, and written out batch by batch as NDJSON: gzipped chunk files
+    under `path`/<chat_id>/<export_id>/ with a manifest.json once complete,
+    or gzipped pieces published to the requester's inbox. Memory use is a
+    batch plus a piece, whatever the size of the chat. At most
+    `concurrency` jobs run at once; the others wait their turn.
+    """
+
+    def __init__(self):
+        self.path = EXPORT_CFG.get("path")
+        self.page_size = EXPORT_CFG.get("page_size", 50_000)
+        self.batch_size = EXPORT_CFG.get("batch_size", 1000)
+        self.chunk_rows = EXPORT_CFG.get("chunk_rows", 500_000)
+        self.piece_bytes = EXPORT_CFG.get("piece_bytes", 512 * 1024)
+        self.limiter = CapacityLimiter(EXPORT_CFG.get("concurrency", 2))
+        self.jobs: Dict[str, ExportJob] = {}
+
+    def start(
+        self, chat_id: int, tables: Optional[List[str]] = None, inbox: Optional[str] = None,
+        since: Optional[datetime] = None, until: Optional[datetime] = None
+    ) -> Dict[str, Any]:
+        tables = list(tables or EXPORT_TABLES)
+        unknown = [table for table in tables if table not in EXPORT_TABLES]
+        if unknown:
+            raise ValueError(f"Cannot export {unknown}; exportable tables are {list(EXPORT_TABLES)}")
+        if not inbox and not self.path:
+            raise ValueError("No export path configured (EXPORT_PATH or MEDIA_PATH); pass an inbox")
+
+        job = ExportJob(chat_id, tables, inbox, since, until)
+        if not inbox:
+            job.path = os.path.join(self.path, str(chat_id), job.id)
+        self._prune()
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job), name=f"export:{job.id}")
+        logger.info(f"Export {job.id} of chat {chat_id} queued: {tables} to {inbox or job.path}")
+        return job.to_dict()
+
+    def status(self, export_id: str) -> Optional[Dict[str, Any]]:
+        job = self.jobs.get(export_id)
+        return job.to_dict() if job else None
+
+    def _prune(self):
+        finished = [job for job in self.jobs.values() if job.finished is not None]
+        for job in sorted(finished, key=lambda job: job.finished)[:-KEEP_FINISHED]:
+            del self.jobs[job.id]
+
+    async def _run(self, job: ExportJob):
+        async with self.limiter:
+            job.status = "running"
+            started = time.monotonic()
+            try:
+                if job.path:
+                    await anyio.Path(job.path).mkdir(parents=True, exist_ok=True)
+                for table in job.tables:
+                    job.results[table] = await self._export_table(job, table)
+                job.status = "done"
+            except asyncio.CancelledError:
+                job.status = "cancelled"
+                raise
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                logger.error(f"Export {job.id} of chat {job.chat_id} failed: {e}")
+            finally:
+                job.finished = time.time()
+                metrics.incr(f"export.jobs.{job.status}")
+                await self._complete(job)
+
+        rows = sum(result["rows"] for result in job.results.values())
+        logger.info(f"Export {job.id} of chat {job.chat_id}: {job.status}, {rows} rows in {time.monotonic() - started:.1f}s")
+
+    async def _complete(self, job: ExportJob):
+        # The manifest, or the inbox's last message, tells the consumer the
+        # export is whole (or why it is not).
+        summary = json.dumps(job.to_dict()).encode()
+        try:
+            if job.inbox:
+                await nc.pub_bytes(job.inbox, summary, {"Export-Id": job.id, "Export-Done": job.status})
+            elif job.path:
+                manifest = os.path.join(job.path, "manifest.json")
+                await anyio.Path(manifest + ".tmp").write_bytes(summary)
+                await to_thread.run_sync(os.replace, manifest + ".tmp", manifest)
+        except Exception as e:
+            logger.error(f"Could not complete export {job.id}: {e}")
+
+    def _page(self, job: ExportJob, table: str, after_id: int):
+        conditions = ["`chat_id` = %s", "`id` > %s"]
+        params: List[Any] = [job.chat_id, after_id]
+        if EXPORT_TABLES[table] and job.since:
+            conditions.append("`date` >= %s")
+            params.append(job.since)
+        if EXPORT_TABLES[table] and job.until:
+            conditions.append("`date` < %s")
+            params.append(job.until)
+        params.append(self.page_size)
+        query = f"""
+        SELECT * FROM `kopilot_telegram`.`{table}`
+        WHERE {" AND ".join(conditions)}
+        ORDER BY `id`
+        LIMIT %s;
+        """
+        return query, tuple(params)
+
+    async def _export_table(self, job: ExportJob, table: str) -> Dict[str, Any]:
+        if job.inbox:
+            sink = InboxSink(job.inbox, job.id, table, self.piece_bytes)
+        else:
+            sink = FileSink(job.path, table, self.chunk_rows)
+
+        rows = 0
+        last_id = 0
+        try:
+            while True:
+                query, params = self._page(job, table, last_id)
+                fetched = 0
+                async with aclosing(db.astream(query, params, self.batch_size)) as pages:
+                    async for batch in pages:
+                        fetched += len(batch)
+                        last_id = batch[-1]['id']
+                        text = "".join(json.dumps(row, default=str) + "\n" for row in batch)
+                        await sink.write(text, len(batch))
+                rows += fetched
+                metrics.incr("export.rows", fetched)
+                if fetched < self.page_size:
+                    break
+            await sink.close()
+        except BaseException:
+            await sink.abort()
+            raise
+        return {"rows": rows, "last_id": last_id, **sink.summary()}
+
+    async def close(self):
+        running = [job.task for job in self.jobs.values() if job.task and not job.task.done()]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+exports = Exports()
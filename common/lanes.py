@@ -0,0 +1,161 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple, Any
+
+from common.config import LANES_CFG
+from common.metrics import metrics
+from common.mysql import MySQL as db
+from common.telegram import TelegramBot as tg
+from common.spool import spool
+
+from anyio import CapacityLimiter
+
+logger = logging.getLogger("nats")
+
+# Subjects are registered with one of these (`@nc.sub(subject, lane=...)`):
+# critical and normal handlers run inline as messages arrive; background
+# handlers go through BackgroundLane admission.
+CRITICAL, NORMAL, BACKGROUND = "critical", "normal", "background"
+LANES = (CRITICAL, NORMAL, BACKGROUND)
+
+
+class BackgroundLane:
+    """Admission control for background subjects (sync, media).
+
+    A background message starts right away only while no pressure signal is
+    over its threshold and the lane has a free slot; otherwise it is deferred
+    in arrival order and resumed once the load drops. Past `max_deferred`
+    queued messages, new ones are written to the spool, which replays them
+    once the primary accepts writes, back through this admission. The number
+    of slots follows AIMD: halved on every tick under pressure, one more per
+    calm tick, between `min_size` and `max_size`.
+    """
+
+    def __init__(self, runner: Callable):
+        self.runner = runner
+        self.min_size = LANES_CFG.get("background_min", 1)
+        self.max_size = LANES_CFG.get("background_max", 8)
+        self.interval = LANES_CFG.get("interval", 1)
+
+        self.limiter = CapacityLimiter(self.max_size)
+        # Past max_deferred, new work goes to the spool instead.
+        self.max_deferred = LANES_CFG.get("max_deferred", 50_000)
+        self.deferred: deque = deque()
+        self.paused = False
+        self._handlers: Dict[str, Callable] = {}
+        self._signals: List[Tuple[str, Callable[[], float], float]] = []
+        self._wakeup = asyncio.Event()
+
+        self.add_signal(
+            "db_waiting", lambda: db.primary.limiter.statistics().tasks_waiting / max(db.primary.size, 1),
+            LANES_CFG.get("db_waiting", 0.5)
+        )
+        self.add_signal("telegram_waiting", lambda: tg.waiting, LANES_CFG.get("telegram_waiting", 5))
+
+    def add_signal(self, name: str, probe: Callable[[], float], threshold: float):
+        self._signals.append((name, probe, threshold))
+
+    def pressure(self) -> Optional[str]:
+        for name, probe, threshold in self._signals:
+            value = probe()
+            metrics.gauge(f"lanes.signal.{name}", value)
+            if value > threshold:
+                return f"{name}={value}"
+        return None
+
+    def register(self, subject: str, handler: Callable):
+        self._handlers[subject] = handler
+        # Work still deferred at shutdown is spooled and replayed from there.
+        spool.replayer(subject)(lambda data, subject=subject: self.replay(subject, data))
+
+    async def replay(self, subject: str, data: dict):
+        """Hands a spooled message back to admission as if it had just
+        arrived. While the deferred queue is full (or the lane is paused for
+        shutdown) the spool drainer waits here rather than spooling it again.
+        """
+        while self.paused or len(self.deferred) >= self.max_deferred:
+            await asyncio.sleep(self.interval)
+        await self.submit(subject, json.dumps(data).encode(), None)
+        metrics.incr("lanes.background.replayed")
+
+    async def submit(self, subject: str, data: bytes, headers: Optional[Dict[str, str]]):
+        if not self.paused and not self.deferred and self.limiter.available_tokens >= 1 and not self.pressure():
+            self._start(subject, data, headers)
+            return
+        if len(self.deferred) >= self.max_deferred:
+            # Queued work is never evicted; the overflow is replayed from
+            # the spool instead.
+            if await self._spool(subject, data):
+                metrics.incr("lanes.background.overflow")
+            return
+        self.deferred.append((subject, data, headers))
+        metrics.incr("lanes.background.deferred")
+        metrics.gauge("lanes.background.queued", len(self.deferred))
+
+    def _start(self, subject: str, data: bytes, headers: Optional[Dict[str, str]]):
+        borrower = object()
+        self.limiter.acquire_on_behalf_of_nowait(borrower)
+        asyncio.create_task(self._run(borrower, subject, data, headers))
+
+    async def _run(self, borrower, subject: str, data: bytes, headers: Optional[Dict[str, str]]):
+        try:
+            await self.runner(subject, self._handlers[subject], data, headers)
+        finally:
+            self.limiter.release_on_behalf_of(borrower)
+            if self.deferred:
+                self._wakeup.set()
+
+    def _adjust(self) -> Optional[str]:
+        size = int(self.limiter.total_tokens)
+        reason = self.pressure()
+        if reason:
+            new_size = max(self.min_size, size // 2)
+        else:
+            new_size = min(self.max_size, size + 1)
+        if new_size != size:
+            self.limiter.total_tokens = new_size
+            if reason:
+                logger.info(f"Background lane down to {new_size} slots ({reason})")
+        metrics.gauge("lanes.background.size", new_size)
+        metrics.gauge("lanes.background.active", int(self.limiter.borrowed_tokens))
+        metrics.gauge("lanes.background.queued", len(self.deferred))
+        return reason
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if self._adjust() or self.paused:
+                continue
+            resumed = 0
+            while self.deferred and self.limiter.available_tokens >= 1:
+                self._start(*self.deferred.popleft())
+                resumed += 1
+            if resumed:
+                metrics.incr("lanes.background.resumed", resumed)
+
+    async def spill(self) -> int:
+        """Moves work still deferred into the spool. Call after the lane is
+        paused, so nothing new gets deferred meanwhile."""
+        spilled = 0
+        while self.deferred:
+            subject, data, headers = self.deferred.popleft()
+            spilled += await self._spool(subject, data)
+        if spilled:
+            logger.info(f"Spooled {spilled} deferred background messages")
+        return spilled
+
+    async def _spool(self, subject: str, data: bytes) -> bool:
+        try:
+            await spool.defer(subject, json.loads(data.decode()) if data else {})
+            return True
+        except Exception as e:
+            metrics.incr("lanes.background.lost")
+            logger.error(f"Failed to spool deferred {subject}: {e}")
+            return False
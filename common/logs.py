@@ -0,0 +1,106 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, List, Optional, Iterable
+
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per logger for records below WARNING.
+
+    While a logger is over budget every `sample_every`-th record still goes
+    through, and the next record let through carries the suppressed count.
+    """
+
+    def __init__(self, rate: float = 50, burst: int = 200, sample_every: int = 100):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_every = sample_every
+        self._buckets: Dict[str, tuple] = {}
+        self._suppressed: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(record.name, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            suppressed = self._suppressed.get(record.name, 0)
+            if tokens < 1:
+                self._buckets[record.name] = (tokens, now)
+                suppressed += 1
+                self._suppressed[record.name] = suppressed
+                if not self.sample_every or suppressed % self.sample_every:
+                    return False
+            else:
+                self._buckets[record.name] = (tokens - 1, now)
+
+            if suppressed:
+                self._suppressed[record.name] = 0
+                record.msg = f"{record.getMessage()} [{suppressed} messages rate-limited]"
+                record.args = None
+        return True
+
+
+class RoutedQueueHandler(QueueHandler):
+    def __init__(self, log_queue, route: str, secrets: Iterable[Optional[str]] = ()):
+        super().__init__(log_queue)
+        self.route = route
+        self.secrets = [secret for secret in secrets if secret]
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        for secret in self.secrets:
+            if secret in record.msg:
+                record.msg = record.msg.replace(secret, "<redacted>")
+        record.message = record.msg
+        record.route = self.route
+        return record
+
+
+class _Router(logging.Handler):
+    def __init__(self, routes: Dict[str, List[logging.Handler]]):
+        super().__init__()
+        self.routes = routes
+
+    def handle(self, record: logging.LogRecord):
+        for handler in self.routes.get(record.route, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+
+def enqueue_handlers(logging_cfg: dict, secrets: Iterable[Optional[str]] = ()) -> QueueListener:
+    """Move the handlers configured by `logging_cfg` behind a single background
+    listener thread, leaving each logger with a non-blocking QueueHandler."""
+
+    log_queue = queue.SimpleQueue()
+    secrets = list(secrets)
+    routes = {}
+
+    for name in logging_cfg.get('loggers', {}):
+        log = logging.getLogger(name)
+        routes[name] = list(log.handlers)
+
+        queue_handler = RoutedQueueHandler(log_queue, name, secrets)
+        # Filters move to the handler so records propagated from child
+        # loggers (e.g. nats.aio.client) are throttled too.
+        queue_handler.filters = list(log.filters)
+        log.filters = []
+        log.handlers = [queue_handler]
+
+    listener = QueueListener(log_queue, _Router(routes))
+    listener.start()
+    atexit.register(stop_listener, listener)
+    return listener
+
+
+def stop_listener(listener: QueueListener):
+    if listener._thread is not None:
+        listener.stop()
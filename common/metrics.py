@@ -0,0 +1,67 @@
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Dict, Any
+
+
+class Timing:
+    __slots__ = ("count", "total", "max", "recent")
+
+    def __init__(self, window: int = 1024):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+
+    def summary(self) -> Dict[str, Any]:
+        recent = sorted(self.recent)
+        def pct(p):
+            return recent[min(len(recent) - 1, int(len(recent) * p / 100))] if recent else 0.0
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": pct(50),
+            "p99": pct(99),
+            "max": self.max,
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._gauges: Dict[str, float] = {}
+        self._timings: Dict[str, Timing] = {}
+        self.started = time.time()
+
+    def incr(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def gauge(self, name: str, value: float):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = Timing()
+            timing.observe(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "uptime": time.time() - self.started,
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "timings": {name: t.summary() for name, t in self._timings.items()},
+            }
+
+metrics = Metrics()
@@ -0,0 +1,232 @@
+"""Typed view of the Telegram updates this service handles.
+
+Only the fields the handlers read are declared; everything else in an
+update is skipped. With msgspec installed the models are msgspec Structs
+decoded straight from the NATS payload, so skipped subtrees (reply_to_message
+bodies, photo sizes, entities, reactions...) are never turned into Python
+objects. Without it they are plain `__slots__` classes built from
+`json.loads` output, with the same attributes and the same strictness
+(a wrong shape raises ValueError). The fallback keeps less memory per
+update than the dicts it replaced but costs more CPU (bench.decode); msgspec
+is the backend req.txt installs.
+
+Message content fields (`audio`, `photo`, ...) are only checked for
+presence, so they are kept undecoded (`Raw`).
+"""
+import json
+from typing import Any, Dict, List, Optional, Union, get_args, get_origin, get_type_hints
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+if msgspec is not None:
+    Raw = msgspec.Raw
+
+    class Model(msgspec.Struct, kw_only=True):
+        @classmethod
+        def from_dict(cls, data: Dict[str, Any]):
+            # Through JSON: Raw fields can only be decoded from bytes.
+            return msgspec.json.decode(msgspec.json.encode(data), type=cls)
+
+else:
+    class Raw:
+        """Placeholder type: the value is kept as json.loads returned it."""
+
+    _MISSING = object()
+
+    class _ModelMeta(type):
+        # Declared fields become __slots__; their defaults move to _defaults.
+        def __new__(mcs, name, bases, namespace, rename: Optional[Dict[str, str]] = None, **kwargs):
+            fields = tuple(namespace.get("__annotations__", {}))
+            defaults = {field: namespace.pop(field) for field in fields if field in namespace}
+            namespace["__slots__"] = fields
+            cls = super().__new__(mcs, name, bases, namespace)
+            cls._defaults = defaults
+            cls._rename = rename or {}
+            cls._plan = None
+            return cls
+
+        def __init__(cls, name, bases, namespace, rename=None, **kwargs):
+            super().__init__(name, bases, namespace)
+
+    def _expect(value, expected: type):
+        # As strict as msgspec: no bool for int, no coercion.
+        if not isinstance(value, expected) or (expected is not bool and isinstance(value, bool)):
+            raise ValueError(f"expected {expected.__name__}, got {type(value).__name__}")
+        return value
+
+    def _converter(hint):
+        # Validates (and for models, builds) a present, non-null value.
+        if type(None) in get_args(hint):
+            hint = next(arg for arg in get_args(hint) if arg is not type(None))
+        if isinstance(hint, type) and issubclass(hint, Model):
+            return hint.from_dict
+        if get_origin(hint) in (list, List):
+            item = get_args(hint)[0]
+            if isinstance(item, type) and issubclass(item, Model):
+                return lambda values: [item.from_dict(value) for value in _expect(values, list)]
+            return lambda values: _expect(values, list)
+        if get_origin(hint) in (dict, Dict):
+            return lambda value: _expect(value, dict)
+        if hint in (int, str, bool):
+            return lambda value: _expect(value, hint)
+        return None
+
+    class Model(metaclass=_ModelMeta):
+        def __init__(self, **fields):
+            for field in self.__slots__:
+                setattr(self, field, fields.get(field, self._defaults.get(field)))
+
+        def __repr__(self) -> str:
+            fields = ", ".join(f"{field}={getattr(self, field)!r}" for field in self.__slots__)
+            return f"{type(self).__name__}({fields})"
+
+        @classmethod
+        def _build_plan(cls):
+            hints = get_type_hints(cls)
+            return tuple(
+                (field, cls._rename.get(field, field), _converter(hints[field]), cls._defaults.get(field, _MISSING))
+                for field in cls.__slots__
+            )
+
+        @classmethod
+        def from_dict(cls, data: Dict[str, Any]):
+            # Wrong shapes raise ValueError, like msgspec's ValidationError.
+            if not isinstance(data, dict):
+                raise ValueError(f"{cls.__name__}: expected object, got {type(data).__name__}")
+            plan = cls._plan
+            if plan is None:
+                plan = cls._plan = cls._build_plan()
+            obj = cls.__new__(cls)
+            for field, key, convert, default in plan:
+                value = data.get(key, _MISSING)
+                if value is _MISSING or value is None:
+                    if default is _MISSING:
+                        raise ValueError(f"{cls.__name__}: missing required field {key}")
+                    value = default
+                elif convert is not None:
+                    try:
+                        value = convert(value)
+                    except ValueError as e:
+                        raise ValueError(f"{cls.__name__}.{key}: {e}") from None
+                setattr(obj, field, value)
+            return obj
+
+
+class User(Model):
+    id: int
+    is_bot: bool = False
+    first_name: str = ''
+    last_name: str = ''
+    username: Optional[str] = None
+
+
+class Chat(Model):
+    id: int
+    type: str = ''
+    title: str = ''
+
+
+class MessageRef(Model):
+    # A reply_to_message is a whole message; only its id is used.
+    message_id: int
+
+
+class ChatMember(Model):
+    status: Optional[str] = None
+    user: Optional[User] = None
+
+
+class Message(Model, rename={"from_": "from"}):
+    message_id: int
+    date: int
+    chat: Chat
+    from_: Optional[User] = None
+    reply_to_message: Optional[MessageRef] = None
+    forward_from: Optional[User] = None
+    text: Optional[str] = None
+    audio: Raw = None
+    video: Raw = None
+    video_note: Raw = None
+    voice: Raw = None
+    animation: Raw = None
+    document: Raw = None
+    photo: Raw = None
+    sticker: Raw = None
+    new_chat_members: Optional[List[User]] = None
+    left_chat_member: Optional[User] = None
+    new_chat_title: Optional[str] = None
+    new_chat_photo: Raw = None
+    delete_chat_photo: Optional[bool] = None
+
+
+class MessageReactionUpdated(Model):
+    message_id: int
+    date: int
+    chat: Chat
+    user: Optional[User] = None
+
+
+class ChatMemberUpdated(Model, rename={"from_": "from"}):
+    date: int
+    chat: Chat
+    from_: Optional[User] = None
+    new_chat_member: Optional[ChatMember] = None
+
+
+class Update(Model):
+    update_id: Optional[int] = None
+    message: Optional[Message] = None
+    message_reaction: Optional[MessageReactionUpdated] = None
+    my_chat_member: Optional[ChatMemberUpdated] = None
+    chat_member: Optional[ChatMemberUpdated] = None
+    # Forwarded as is to youtube.callback.
+    callback_query: Optional[Dict[str, Any]] = None
+
+
+class UpdateEvent(Model):
+    """A telegram.update payload: a raw_events row id and the update."""
+    event_id: Optional[int] = None
+    update: Optional[Update] = None
+
+
+# Content field -> message.type, in the order the first present one wins.
+MESSAGE_TYPES = (
+    ("text", "text"),
+    ("audio", "audio"),
+    ("video", "video"),
+    ("video_note", "video_note"),
+    ("voice", "voice"),
+    ("animation", "animation"),
+    ("document", "document"),
+    ("photo", "photo"),
+    ("sticker", "sticker"),
+)
+
+
+def classify_message(message: Message) -> str:
+    for field, kind in MESSAGE_TYPES:
+        if getattr(message, field) is not None:
+            return kind
+    return "other"
+
+
+if msgspec is not None:
+    _decoders: Dict[type, "msgspec.json.Decoder"] = {}
+
+    def decode(payload: Union[bytes, str], model: type):
+        decoder = _decoders.get(model)
+        if decoder is None:
+            decoder = _decoders[model] = msgspec.json.Decoder(model)
+        return decoder.decode(payload)
+
+else:
+    def decode(payload: Union[bytes, str], model: type):
+        return model.from_dict(json.loads(payload) if payload else {})
+
+
+def decode_event(payload: bytes) -> UpdateEvent:
+    return decode(payload, UpdateEvent)
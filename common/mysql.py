@@ -1,67 +1,320 @@
 import logging
+import threading
+import time
 from contextlib import contextmanager, asynccontextmanager
-from typing import Optional, Type, Union
+from typing import Optional, Type, Union, List, Dict, Any
 
-from common.config import MYSQL_CFG
+from common.config import MYSQL_CFG, MYSQL_POOL_CFG, MYSQL_REPLICA_CFGS, MYSQL_ROUTING_CFG, MYSQL_BREAKER_CFG
+from common.tracing import tracer
+from common.metrics import metrics
 
+import mysql.connector
 from mysql.connector import Error
-from mysql.connector.pooling import MySQLConnectionPool
+from mysql.connector.errors import InterfaceError, OperationalError, PoolError
+from mysql.connector.pooling import MySQLConnectionPool, CNX_POOL_MAXSIZE
 import anyio
-from anyio import to_thread, Semaphore
+from anyio import to_thread, CapacityLimiter
 
 logger = logging.getLogger("mysql")
 
-class MySQL:
-    _instance: Optional[MySQLConnectionPool] = None
-    _semaphore = Semaphore(MYSQL_CFG.get("pool_size", 5))
+# Errors meaning the server could not be reached or did not answer, as opposed
+# to errors about the statement itself. Only these count toward the breaker.
+UNAVAILABLE_ERRORS = (InterfaceError, OperationalError, PoolError)
 
-    @classmethod
-    def get_pool(cls) -> MySQLConnectionPool:
-        if cls._instance is None:
-            cls._instance = MySQLConnectionPool(**MYSQL_CFG)
-        return cls._instance
 
-    @classmethod
+class Statement:
+    """A hot query declared once with MySQL.prepare(). It runs as a
+    server-side prepared statement, prepared once per pooled connection."""
+
+    __slots__ = ("name", "query")
+
+    def __init__(self, name: str, query: str):
+        self.name = name
+        self.query = query
+
+    def __str__(self) -> str:
+        return self.query
+
+    def __repr__(self) -> str:
+        return f"Statement({self.name!r})"
+
+
+class Pool:
+    def __init__(self, name: str, config: dict):
+        self.name = name
+        self.config = {**config, 'pool_name': name}
+        self.min_size = MYSQL_POOL_CFG.get("min_size", 5)
+        self.max_size = min(max(MYSQL_POOL_CFG.get("max_size", 16), self.min_size), CNX_POOL_MAXSIZE)
+        # Admission to the pool; its token count is the adaptive pool size.
+        self.limiter = CapacityLimiter(self.min_size)
+        self.opened = 0
+        self.healthy = True
+        self.lag: Optional[float] = None
+        self._instance: Optional[MySQLConnectionPool] = None
+        self._lock = threading.Lock()
+
+        # Checkout waits and peak use since the last resize.
+        self._wait_total = 0.0
+        self._wait_count = 0
+        self._peak = 0
+        self._quiet = 0
+
+        # Circuit breaker state, fed by MySQL._run.
+        self.latency = 0.0
+        self.errors = 0
+        self.open_until = 0.0
+
+    @property
+    def size(self) -> int:
+        return int(self.limiter.total_tokens)
+
+    def get(self) -> MySQLConnectionPool:
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    # No connection arguments here, so nothing is opened yet;
+                    # connections are added by warm_up() and on demand.
+                    # No reset on checkin: COM_RESET_CONNECTION would drop
+                    # the prepared statements. connection() ends any open
+                    # transaction instead.
+                    pool = MySQLConnectionPool(
+                        pool_name=self.name, pool_size=self.max_size, pool_reset_session=False
+                    )
+                    pool.set_config(**{k: v for k, v in self.config.items() if not k.startswith("pool_")})
+                    self._instance = pool
+        return self._instance
+
+    def _open(self) -> bool:
+        with self._lock:
+            if self.opened >= self.max_size:
+                return False
+            self._instance.add_connection()
+            self.opened += 1
+            return True
+
+    def warm_up(self) -> int:
+        self.get()
+        while self.opened < self.size and self._open():
+            pass
+        return self.opened
+
+    def _checkout(self):
+        pool = self.get()
+        while True:
+            try:
+                return pool.get_connection()
+            except PoolError:
+                if not self._open():
+                    raise
+
     @contextmanager
-    def connection(cls):
-        pool = cls.get_pool()
+    def connection(self):
         con = None
         try:
-            con = pool.get_connection()
+            con = self._checkout()
             yield con
         except Error as e:
-            logger.error(f"Database error: {e}")
+            logger.error(f"Database error on {self.name}: {e}")
             if con:
-                con.rollback()
+                try:
+                    con.rollback()
+                except Error:
+                    pass
             raise
         finally:
-            if con and con.is_connected():
-                con.close()
-    
+            if con:
+                # Always hand it back, even if it died: the pool reconnects
+                # it on the next checkout instead of losing the slot.
+                try:
+                    if con.in_transaction:
+                        con.rollback()
+                    con.close()
+                except Error:
+                    pass
+
+    def close(self) -> int:
+        # Closes the idle connections; call once nothing is checked out.
+        with self._lock:
+            if self._instance is None:
+                return 0
+            closed = self._instance._remove_connections()
+            self.opened = 0
+            return closed
+
+    def ping(self):
+        # get_connection() reconnects a connection whose ping fails.
+        with self.connection() as con:
+            con.ping()
+
+    def checked_out(self, wait: float):
+        self._wait_total += wait
+        self._wait_count += 1
+        self._peak = max(self._peak, int(self.limiter.borrowed_tokens))
+        metrics.observe(f"mysql.{self.name}.wait_ms", wait * 1000)
+
+    def resize(self):
+        size = self.size
+        wait_ms = self._wait_total / self._wait_count * 1000 if self._wait_count else 0.0
+        if wait_ms > MYSQL_POOL_CFG.get("grow_wait_ms", 10) and size < self.max_size:
+            self.limiter.total_tokens = size + 1
+            self._quiet = 0
+            logger.info(f"Growing {self.name} pool to {size + 1} (avg checkout wait {wait_ms:.1f}ms)")
+        elif self._peak < size - 1 and size > self.min_size:
+            self._quiet += 1
+            if self._quiet >= MYSQL_POOL_CFG.get("shrink_after", 12):
+                # A shrink only lowers admission; the pool keeps its open
+                # connections, which stay alive through the pings.
+                self.limiter.total_tokens = size - 1
+                self._quiet = 0
+                logger.info(f"Shrinking {self.name} pool to {size - 1}")
+        else:
+            self._quiet = 0
+
+        self._wait_total, self._wait_count = 0.0, 0
+        self._peak = int(self.limiter.borrowed_tokens)
+        self.export()
+
+    def export(self):
+        active = int(self.limiter.borrowed_tokens)
+        metrics.gauge(f"mysql.{self.name}.size", self.size)
+        metrics.gauge(f"mysql.{self.name}.opened", self.opened)
+        metrics.gauge(f"mysql.{self.name}.active", active)
+        metrics.gauge(f"mysql.{self.name}.idle", max(self.opened - active, 0))
+        metrics.gauge(f"mysql.{self.name}.waiting", self.limiter.statistics().tasks_waiting)
+
+    @property
+    def available(self) -> bool:
+        if time.monotonic() < self.open_until:
+            return False
+        if self.limiter.statistics().tasks_waiting > MYSQL_BREAKER_CFG.get("backlog", 50):
+            self.trip("backlog")
+            return False
+        return True
+
+    def trip(self, reason: str):
+        if time.monotonic() >= self.open_until:
+            logger.warning(f"Circuit breaker on {self.name} opened ({reason})")
+            metrics.incr(f"mysql.{self.name}.breaker_trips")
+        self.open_until = time.monotonic() + MYSQL_BREAKER_CFG.get("cooldown", 5)
+        # Start over when the cool-down ends instead of tripping on old samples.
+        self.latency = 0.0
+        self.errors = 0
+
+    def record(self, duration: float, failed: bool):
+        self.latency = 0.8 * self.latency + 0.2 * duration
+        self.errors = self.errors + 1 if failed else 0
+        if self.errors >= MYSQL_BREAKER_CFG.get("errors", 3):
+            self.trip(f"{self.errors} consecutive errors")
+        elif self.latency * 1000 > MYSQL_BREAKER_CFG.get("latency_ms", 2000):
+            self.trip(f"latency {self.latency * 1000:.0f}ms")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "healthy": self.healthy,
+            "available": time.monotonic() >= self.open_until,
+            "latency_ms": round(self.latency * 1000, 1),
+            "lag": self.lag,
+            "size": self.size,
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "opened": self.opened,
+            "in_use": int(self.limiter.borrowed_tokens),
+            "waiting": self.limiter.statistics().tasks_waiting,
+        }
+
+
+class MySQL:
+    primary = Pool("primary", MYSQL_CFG)
+    replicas: List[Pool] = [
+        Pool(f"replica{i}", config) for i, config in enumerate(MYSQL_REPLICA_CFGS)
+    ]
+    _next_replica = 0
+    statements: Dict[str, Statement] = {}
+
+    @classmethod
+    def get_pool(cls) -> MySQLConnectionPool:
+        return cls.primary.get()
+
+    @classmethod
+    def connection(cls, pool: Optional[Pool] = None):
+        return (pool or cls.primary).connection()
+
+    @classmethod
+    def read_pool(cls, primary: bool = False) -> Pool:
+        # Reads that decide a write pass primary=True; replicas may lag.
+        if primary or not cls.replicas:
+            return cls.primary
+        for _ in range(len(cls.replicas)):
+            pool = cls.replicas[cls._next_replica % len(cls.replicas)]
+            cls._next_replica += 1
+            if pool.healthy and pool.available:
+                return pool
+        return cls.primary
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        return {pool.name: pool.stats() for pool in [cls.primary, *cls.replicas]}
+
+    @classmethod
+    def prepare(cls, name: str, query: str) -> "Statement":
+        statement = cls.statements.get(name)
+        if statement is not None and statement.query != query:
+            raise ValueError(f"Statement {name} is already registered with a different query")
+        if statement is None:
+            statement = cls.statements[name] = Statement(name, query)
+        return statement
+
+    @staticmethod
+    def _prepared_cursor(con, statement: "Statement", dictionary: bool):
+        # Prepared cursors live on the underlying connection for as long as
+        # its server session does; a reconnect gets a new connection_id and
+        # with it an empty cache.
+        cnx = getattr(con, "_cnx", con)
+        cache = getattr(cnx, "_prepared_cursors", None)
+        if cache is None or cache[0] != cnx.connection_id:
+            cache = (cnx.connection_id, {})
+            cnx._prepared_cursors = cache
+        cursor = cache[1].get((statement.name, dictionary))
+        if cursor is None:
+            cursor = cnx.cursor(prepared=True, dictionary=dictionary)
+            cache[1][(statement.name, dictionary)] = cursor
+            metrics.incr("mysql.prepared")
+        return cursor
+
+    @classmethod
+    @contextmanager
+    def cursor(cls, con, query: Union[str, "Statement"], dictionary: bool = False):
+        if isinstance(query, Statement):
+            yield cls._prepared_cursor(con, query, dictionary)
+            return
+        cursor = con.cursor(dictionary=dictionary)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+
     @classmethod
     def execute_query(
         cls,
         query,
         params = None,
-        fetch_one = False
+        fetch_one = False,
+        pool = None
     ):
-        with cls.connection() as con:
-            cursor = None
-            try:
-                cursor = con.cursor(dictionary=True)
-                cursor.execute(query, params or ())
+        with cls.connection(pool) as con:
+            with cls.cursor(con, query, dictionary=True) as cursor:
+                cursor.execute(str(query), params or ())
                 
                 if fetch_one:
                     result = cursor.fetchone()
-                    logger.debug(f"Query executed (fetch_one): {query[:100]}...")
+                    # Drain the rest so the connection has no unread result.
+                    cursor.fetchall()
+                    logger.debug(f"Query executed (fetch_one): {str(query)[:100]}...")
                     return result
                 else:
                     result = cursor.fetchall()
-                    logger.debug(f"Query executed: {query[:100]}... | Rows returned: {len(result)}")
+                    logger.debug(f"Query executed: {str(query)[:100]}... | Rows returned: {len(result)}")
                     return result
-            finally:
-                if cursor:
-                    cursor.close()
     
     @classmethod
     def execute_update(
@@ -70,17 +323,12 @@ class MySQL:
         params = None
     ):
         with cls.connection() as con:
-            cursor = None
-            try:
-                cursor = con.cursor()
-                cursor.execute(query, params or ())
+            with cls.cursor(con, query) as cursor:
+                cursor.execute(str(query), params or ())
                 con.commit()
                 affected_rows = cursor.rowcount
-                logger.debug(f"Update executed: {query[:100]}... | Affected rows: {affected_rows}")
+                logger.debug(f"Update executed: {str(query)[:100]}... | Affected rows: {affected_rows}")
                 return affected_rows
-            finally:
-                if cursor:
-                    cursor.close()
     
     @classmethod
     def execute_insert(
@@ -89,17 +337,12 @@ class MySQL:
         params = None
     ):
         with cls.connection() as con:
-            cursor = None
-            try:
-                cursor = con.cursor()
-                cursor.execute(query, params or ())
+            with cls.cursor(con, query) as cursor:
+                cursor.execute(str(query), params or ())
                 con.commit()
                 last_id = cursor.lastrowid
-                logger.debug(f"Insert executed: {query[:100]}... | Last ID: {last_id}")
+                logger.debug(f"Insert executed: {str(query)[:100]}... | Last ID: {last_id}")
                 return last_id
-            finally:
-                if cursor:
-                    cursor.close()
     
     @classmethod
     def execute_many(
@@ -107,6 +350,9 @@ class MySQL:
         query, 
         params_list
     ):
+        # Always the text protocol: it rewrites inserts into one multi-row
+        # statement, where a prepared cursor would run them one by one.
+        query = str(query)
         with cls.connection() as con:
             cursor = None
             try:
@@ -121,18 +367,161 @@ class MySQL:
                     cursor.close()
     
     @classmethod
-    async def aexecute_query(cls, query, params=None, fetch_one=False):
-        async with cls._semaphore:
-            return await to_thread.run_sync(cls.execute_query, query, params, fetch_one)
+    async def astream(cls, query, params=None, batch_size=1000, primary=False):
+        # Unbuffered cursor on a dedicated connection, so rows are pulled from
+        # the server as they are consumed instead of all at once.
+        pool = cls.read_pool(primary)
+        config = {k: v for k, v in pool.config.items() if not k.startswith("pool_")}
+        con = await to_thread.run_sync(lambda: mysql.connector.connect(**config))
+        cursor = None
+        try:
+            cursor = con.cursor(dictionary=True)
+            await to_thread.run_sync(cursor.execute, query, params or ())
+            while True:
+                rows = await to_thread.run_sync(cursor.fetchmany, batch_size)
+                if not rows:
+                    break
+                metrics.incr("mysql.streamed_rows", len(rows))
+                yield rows
+        finally:
+            def close():
+                if cursor:
+                    try:
+                        cursor.close()
+                    except Error:
+                        pass
+                con.close()
+            await to_thread.run_sync(close)
+
+    @classmethod
+    async def _run(cls, pool: Pool, func, *args):
+        metrics.incr("mysql.queries")
+        metrics.incr(f"mysql.{pool.name}.queries")
+        started = time.monotonic()
+        try:
+            async with pool.limiter:
+                pool.checked_out(time.monotonic() - started)
+                result = await to_thread.run_sync(func, *args)
+        except Error as e:
+            pool.record(time.monotonic() - started, isinstance(e, UNAVAILABLE_ERRORS))
+            raise
+        pool.record(time.monotonic() - started, False)
+        return result
+
+    @classmethod
+    async def aexecute_query(cls, query, params=None, fetch_one=False, primary=False):
+        pool = cls.read_pool(primary)
+        with tracer.span("mysql.query", **{"db.statement": str(query).strip()[:100], "db.pool": pool.name}):
+            try:
+                return await cls._run(pool, cls.execute_query, query, params, fetch_one, pool)
+            except Error as e:
+                if pool is cls.primary:
+                    raise
+                logger.warning(f"Read on {pool.name} failed, retrying on primary: {e}")
+                pool.healthy = False
+                return await cls._run(cls.primary, cls.execute_query, query, params, fetch_one, cls.primary)
     @classmethod
     async def aexecute_update(cls, query, params=None):
-        async with cls._semaphore:
-            return await to_thread.run_sync(cls.execute_update, query, params)
+        with tracer.span("mysql.update", **{"db.statement": str(query).strip()[:100]}):
+            return await cls._run(cls.primary, cls.execute_update, query, params)
     @classmethod
     async def aexecute_insert(cls, query, params=None):
-        async with cls._semaphore:
-            return await to_thread.run_sync(cls.execute_insert, query, params)
+        with tracer.span("mysql.insert", **{"db.statement": str(query).strip()[:100]}):
+            return await cls._run(cls.primary, cls.execute_insert, query, params)
     @classmethod
     async def aexecute_many(cls, query, params_list):
-        async with cls._semaphore:
-            return await to_thread.run_sync(cls.execute_many, query, params_list)
\ No newline at end of file
+        with tracer.span("mysql.many", **{"db.statement": str(query).strip()[:100]}):
+            return await cls._run(cls.primary, cls.execute_many, query, params_list)
+
+    @classmethod
+    async def warm_up(cls):
+        for pool in [cls.primary, *cls.replicas]:
+            started = time.monotonic()
+            try:
+                opened = await to_thread.run_sync(pool.warm_up)
+                logger.info(f"Opened {opened} connections on {pool.name} in {time.monotonic() - started:.2f}s")
+            except Error as e:
+                # Not fatal: the breaker and the spool cover a primary that is
+                # down at startup, and the lag monitor covers replicas.
+                logger.error(f"Warm-up of {pool.name} failed: {e}")
+            pool.export()
+
+    @classmethod
+    async def close(cls):
+        for pool in [cls.primary, *cls.replicas]:
+            closed = await to_thread.run_sync(pool.close)
+            logger.info(f"Closed {closed} connections on {pool.name}")
+
+    @classmethod
+    async def ping(cls, pool: Pool):
+        # Only idle connections are pinged; a busy one is in use and alive.
+        for _ in range(pool.opened):
+            borrower = object()
+            try:
+                pool.limiter.acquire_on_behalf_of_nowait(borrower)
+            except anyio.WouldBlock:
+                return
+            started = time.monotonic()
+            try:
+                await to_thread.run_sync(pool.ping)
+                pool.record(time.monotonic() - started, False)
+            except Error as e:
+                logger.warning(f"Liveness ping on {pool.name} failed: {e}")
+                metrics.incr(f"mysql.{pool.name}.ping_failures")
+                pool.record(time.monotonic() - started, isinstance(e, UNAVAILABLE_ERRORS))
+                return
+            finally:
+                pool.limiter.release_on_behalf_of(borrower)
+
+    @classmethod
+    async def maintain_pools(cls):
+        resize_interval = MYSQL_POOL_CFG.get("resize_interval", 5)
+        ping_every = max(1, round(MYSQL_POOL_CFG.get("ping_interval", 30) / resize_interval))
+        ticks = 0
+        while True:
+            await anyio.sleep(resize_interval)
+            ticks += 1
+            for pool in [cls.primary, *cls.replicas]:
+                pool.resize()
+                if ticks % ping_every == 0 and pool.available:
+                    await cls.ping(pool)
+
+    @classmethod
+    def replica_lag(cls, pool: Pool) -> Optional[float]:
+        with pool.connection() as con:
+            cursor = con.cursor(dictionary=True)
+            try:
+                try:
+                    cursor.execute("SHOW REPLICA STATUS;")
+                except Error:
+                    cursor.execute("SHOW SLAVE STATUS;")
+                row = cursor.fetchone()
+            finally:
+                cursor.close()
+        if not row:
+            return None
+        return row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+
+    @classmethod
+    async def monitor_replicas(cls):
+        max_lag = MYSQL_ROUTING_CFG.get("max_replica_lag", 5)
+        interval = MYSQL_ROUTING_CFG.get("lag_check_interval", 5)
+        while True:
+            for pool in cls.replicas:
+                try:
+                    lag = await cls._run(pool, cls.replica_lag, pool)
+                except Error as e:
+                    logger.warning(f"Lag check on {pool.name} failed: {e}")
+                    lag = None
+
+                healthy = lag is not None and lag <= max_lag
+                if healthy != pool.healthy:
+                    if healthy:
+                        logger.info(f"{pool.name} is back in rotation (lag {lag}s)")
+                    else:
+                        logger.warning(f"Routing reads away from {pool.name} (lag {lag}s)")
+                pool.healthy = healthy
+                pool.lag = lag
+                metrics.gauge(f"mysql.{pool.name}.lag", lag if lag is not None else -1)
+                metrics.gauge(f"mysql.{pool.name}.healthy", int(healthy))
+            await anyio.sleep(interval)
\ No newline at end of file
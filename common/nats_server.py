@@ -1,12 +1,20 @@
+import asyncio
 import json
 import logging
-from typing import Dict, Any, Optional, List, Callable
+from typing import Dict, Any, Optional, List, Callable, Set
 
-from common.config import NATS_CFG
+from common.config import NATS_CFG, LANES_CFG
+from common.tracing import tracer
+from common.metrics import metrics
+from common.lanes import BackgroundLane, LANES, NORMAL, CRITICAL, BACKGROUND
+from common.compression import PayloadCompression, ENCODING_HEADER
+from common.startup import lazy_import
 
-import nats
 import anyio
 
+# Loaded by connect() in the startup phase.
+nats = lazy_import("nats")
+
 logger = logging.getLogger("nats")
 
 class NATSServer:
@@ -15,56 +23,181 @@ class NATSServer:
 
         self.pending_subscribers: List[tuple] = []
         self.pending_responders: List[tuple] = []
+
+        # (lane, subscription); responders are in the normal lane.
+        self._subscriptions: List[tuple] = []
+        self._in_flight: Set[asyncio.Task] = set()
+        self.draining = False
+        self.compression = PayloadCompression()
+
+        self.background = BackgroundLane(self._dispatch)
+        self.background.add_signal(
+            "critical_queue", lambda: self.pending(CRITICAL), LANES_CFG.get("critical_queue", 100)
+        )
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+
+    def pending(self, lane: str) -> int:
+        # Messages delivered to this process and not yet handled.
+        return sum(sub.pending_msgs for sub_lane, sub in self._subscriptions if sub_lane == lane)
+
+    def _track(self):
+        task = asyncio.current_task()
+        self._in_flight.add(task)
+        metrics.gauge("nats.in_flight", len(self._in_flight))
+        return task
+
+    def _untrack(self, task):
+        self._in_flight.discard(task)
+        metrics.gauge("nats.in_flight", len(self._in_flight))
     
-    async def connect(self):
+    async def connect(self, register_handlers: bool = True):
         if self._connection is None or not self._connection.is_connected:
             try:
                 self._connection = await nats.connect(**NATS_CFG)
                 logger.info("Connected to NATS server")
 
-                await self._register_pending_handlers()
+                if register_handlers:
+                    await self._register_pending_handlers()
             except Exception as e:
                 logger.error(f"Failed to connect to NATS: {e}")
                 raise
     
+    async def drain(self, timeout: float) -> int:
+        """Stops taking new messages and waits up to `timeout` seconds for the
+        handlers in flight, and the messages already delivered to this
+        process, to finish. The connection stays open so they can still
+        publish. Returns how many handlers were still running at the deadline."""
+        if self._connection is None or not self._connection.is_connected:
+            return self.in_flight
+
+        self.draining = True
+        # Background work not started yet is deferred, and spilled by the caller.
+        self.background.paused = True
+        deadline = asyncio.get_running_loop().time() + timeout
+        logger.info(f"Draining {len(self._subscriptions)} subscriptions, {self.in_flight} handlers in flight")
+        drained = asyncio.gather(*(sub.drain() for _, sub in self._subscriptions), return_exceptions=True)
+        done, _ = await asyncio.wait({drained}, timeout=timeout)
+        if not done:
+            drained.cancel()
+            try:
+                await drained
+            except asyncio.CancelledError:
+                pass
+        self._subscriptions = []
+
+        # Background handlers run outside the subscription callbacks.
+        left = deadline - asyncio.get_running_loop().time()
+        if self._in_flight and left > 0:
+            await asyncio.wait(set(self._in_flight), timeout=left)
+
+        remaining = self.in_flight
+        if remaining:
+            logger.warning(f"Drain deadline of {timeout}s passed with {remaining} handlers still in flight")
+        try:
+            await self._connection.flush(timeout=max(1, int(timeout)))
+        except Exception as e:
+            logger.warning(f"Failed to flush NATS publishes while draining: {e}")
+        return remaining
+
     async def close(self):
         if self._connection and self._connection.is_connected:
             await self._connection.close()
             self._connection = None
+            self._subscriptions = []
             logger.info("NATS connection closed")
     
     
+    async def _dispatch(
+        self, subject: str, handler: Callable, payload: bytes, headers: Optional[Dict[str, str]], raw: bool = False
+    ):
+        task = self._track()
+        task.set_name(f"nats:{subject}")
+        with tracer.trace(subject, headers=headers, **{"messaging.destination": subject}):
+            try:
+                if raw:
+                    await handler(payload)
+                else:
+                    data = json.loads(payload.decode()) if payload else {}
+                    await handler(data)
+            except Exception as e:
+                tracer.record_exception(e)
+                logger.error(f"Error in {subject}: {e}")
+            finally:
+                self._untrack(task)
+
     async def _register_pending_handlers(self):
 
-        for subject, handler in self.pending_subscribers:
-            async def wrapper(msg, h=handler):
-                try:
-                    data = json.loads(msg.data.decode()) if msg.data else {}
-                    await h(data)
-                except Exception as e:
-                    logger.error(f"Error in {subject}: {e}")
+        for subject, handler, lane, raw in self.pending_subscribers:
+            # Payloads are decompressed here, so what is spooled or
+            # deferred is plain JSON.
+            if lane == BACKGROUND:
+                self.background.register(subject, handler)
+                async def wrapper(msg, s=subject):
+                    payload = self._decompress(s, msg)
+                    if payload is not None:
+                        await self.background.submit(s, payload, msg.headers)
+            else:
+                async def wrapper(msg, h=handler, s=subject, r=raw):
+                    payload = self._decompress(s, msg)
+                    if payload is not None:
+                        await self._dispatch(s, h, payload, msg.headers, r)
             
-            await self._connection.subscribe(subject, cb=wrapper)
-            logging.info(f"Registered subscription: {subject}")
+            self._subscriptions.append((lane, await self._connection.subscribe(subject, cb=wrapper)))
+            logging.info(f"Registered subscription: {subject} ({lane})")
 
         for subject, handler in self.pending_responders:
-            async def wrapper(msg, h=handler):
-                try:
-                    data = json.loads(msg.data.decode()) if msg.data else {}
-                    result = await h(data)
-                    response = json.dumps(result).encode()
-                    await msg.respond(response)
-                except Exception as e:
-                    logger.error(f"Error handling {subject}: {e}")
-                    error_response = json.dumps({"error": str(e)}).encode()
-                    await msg.respond(error_response)
-
-            await self._connection.subscribe(subject, cb=wrapper)
+            async def wrapper(msg, h=handler, s=subject):
+                task = self._track()
+                task.set_name(f"nats:{s}")
+                with tracer.trace(s, headers=msg.headers, **{"messaging.destination": s}):
+                    # Replies are compressed only when the request was, as
+                    # proof the requester can read them.
+                    compressed = bool(msg.headers and msg.headers.get(ENCODING_HEADER))
+                    try:
+                        payload = self.compression.decompress(msg.data, msg.headers)
+                        data = json.loads(payload.decode()) if payload else {}
+                        result = await h(data)
+                        await self._respond(msg, json.dumps(result).encode(), compressed)
+                    except Exception as e:
+                        tracer.record_exception(e)
+                        logger.error(f"Error handling {s}: {e}")
+                        error_response = json.dumps({"error": str(e)}).encode()
+                        await self._respond(msg, error_response, compressed)
+                    finally:
+                        self._untrack(task)
+
+            self._subscriptions.append((NORMAL, await self._connection.subscribe(subject, cb=wrapper)))
             logging.info(f"Registered responder: {subject}")
 
-    def sub(self, subject: str):
+    def _decompress(self, subject: str, msg) -> Optional[bytes]:
+        try:
+            return self.compression.decompress(msg.data, msg.headers)
+        except Exception as e:
+            metrics.incr("nats.compression.errors")
+            logger.error(f"Dropping undecodable {subject} payload: {e}")
+            return None
+
+    async def _respond(self, msg, response: bytes, compress: bool):
+        # Not msg.respond(): it sends the request's headers back, including
+        # its Content-Encoding.
+        if not msg.reply:
+            return
+        headers = None
+        if compress:
+            response, headers = self.compression.compress(response, None)
+        await self._connection.publish(msg.reply, response, headers=headers)
+
+    def sub(self, subject: str, lane: str = NORMAL, raw: bool = False):
+        # raw: the handler gets the payload bytes and decodes them itself.
+        if lane not in LANES:
+            raise ValueError(f"Unknown lane {lane} for {subject}")
+        if raw and lane == BACKGROUND:
+            raise ValueError(f"Background subjects are spooled as JSON and cannot be raw: {subject}")
         def decorator(func: Callable):
-            self.pending_subscribers.append((subject, func))
+            self.pending_subscribers.append((subject, func, lane, raw))
             return func
         return decorator
     
@@ -75,12 +208,32 @@ class NATSServer:
         return decorator
     
     async def pub(self, subject: str, data: dict):
-        message = json.dumps(data).encode()
-        await self._connection.publish(subject, message)
+        with tracer.span("nats.publish", **{"messaging.destination": subject}):
+            message, headers = self._encode(subject, data)
+            await self._connection.publish(subject, message, headers=headers)
+
+    async def pub_bytes(self, subject: str, payload: bytes, headers: Optional[Dict[str, str]] = None):
+        # Payloads encoded by the caller (export pieces), sent as they are.
+        with tracer.span("nats.publish", **{"messaging.destination": subject}):
+            await self._connection.publish(subject, payload, headers=tracer.inject(headers))
+
+    async def flush(self, timeout: int = 10):
+        await self._connection.flush(timeout=timeout)
 
     async def request(self, subject:str, data: dict, timeout: int = 5):
+        with tracer.span("nats.request", **{"messaging.destination": subject}):
+            message, headers = self._encode(subject, data)
+            response = await self._connection.request(
+                subject, message, timeout=timeout, headers=headers
+            )
+        payload = self.compression.decompress(response.data, response.headers)
+        return json.loads(payload.decode()) if payload else None
+
+    def _encode(self, subject: str, data: dict):
         message = json.dumps(data).encode()
-        response = await self._connection.request(subject, message, timeout=timeout)
-        return json.loads(response.data.decode()) if response.data else None
+        headers = tracer.inject()
+        if self.compression.applies(subject):
+            message, headers = self.compression.compress(message, headers)
+        return message, headers
     
 nc = NATSServer()
\ No newline at end of file
@@ -0,0 +1,391 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from typing import Dict, Any, Optional, List, Iterable, Tuple
+
+from common.config import OUTBOUND_CFG
+from common.metrics import metrics
+from common.tracing import tracer
+from common.mysql import MySQL as db
+from common.telegram import TelegramBot as tg, TelegramError
+from common.nats_server import nc
+from common.cache import cache
+from common.tasks import map_bounded
+from common.startup import lazy_import
+
+httpx = lazy_import("httpx")
+
+logger = logging.getLogger("telegram")
+
+MAX_TEXT_LENGTH = 4096
+IN_CHUNK = 1000
+
+# sendMessage parameters callers may pass through `options`.
+SEND_OPTIONS = frozenset({
+    "parse_mode", "entities", "link_preview_options", "disable_notification",
+    "protect_content", "message_thread_id", "reply_parameters", "reply_markup",
+})
+
+INSERT_OUTBOUND = """
+INSERT INTO `kopilot_telegram`.`outbound_message` (`broadcast_id`, `chat_id`, `text`, `options`)
+VALUES (%s, %s, %s, %s);
+"""
+
+# Due rows, and rows whose sending lease ran out (a crashed instance); the
+# batch is picked from the first `scan` of them.
+SELECT_DUE = """
+SELECT `id`, `chat_id`
+FROM `kopilot_telegram`.`outbound_message`
+WHERE `state` IN ('queued', 'sending') AND `not_before` <= NOW(6)
+ORDER BY `id`
+LIMIT %s;
+"""
+
+# Takes the picked rows still due; another instance may have claimed some
+# in between.
+CLAIM_OUTBOUND = """
+UPDATE `kopilot_telegram`.`outbound_message`
+SET `state` = 'sending', `claim` = %s, `not_before` = NOW(6) + INTERVAL %s SECOND
+WHERE `id` IN ({}) AND `state` IN ('queued', 'sending') AND `not_before` <= NOW(6);
+"""
+
+SELECT_CLAIMED = """
+SELECT `id`, `broadcast_id`, `chat_id`, `text`, `options`, `attempts`
+FROM `kopilot_telegram`.`outbound_message`
+WHERE `claim` = %s AND `state` = 'sending'
+ORDER BY `id`;
+"""
+
+UPDATE_OUTBOUND = """
+UPDATE `kopilot_telegram`.`outbound_message`
+SET `chat_id` = %s, `state` = %s, `attempts` = `attempts` + %s,
+    `not_before` = TIMESTAMPADD(MICROSECOND, %s, NOW(6)),
+    `message_id` = %s, `error` = %s, `claim` = NULL
+WHERE `id` = %s AND `claim` = %s;
+"""
+
+MARK_BLOCKED = "UPDATE `kopilot_telegram`.`user` SET `can_chat` = FALSE WHERE `user_id` = %s;"
+MARK_REACHABLE = "UPDATE `kopilot_telegram`.`user` SET `can_chat` = TRUE WHERE `user_id` = %s AND `can_chat` IS NULL;"
+MARK_USER_DELETED = "UPDATE `kopilot_telegram`.`user` SET `is_deleted` = TRUE WHERE `user_id` = %s;"
+MARK_CHAT_DELETED = "UPDATE `kopilot_telegram`.`chat` SET `is_deleted` = TRUE WHERE `chat_id` = %s;"
+
+# What a failed send says about the chat, in the order they are checked.
+BLOCKED, USER_DELETED, CHAT_DELETED = "blocked", "user_deleted", "chat_deleted"
+
+
+def _unreachable(chat_id: int, error: TelegramError) -> Optional[str]:
+    description = error.description.lower()
+    if error.error_code == 403 or (error.error_code == 400 and "chat not found" in description):
+        if chat_id > 0:
+            return USER_DELETED if "deactivated" in description else BLOCKED
+        return CHAT_DELETED
+    return None
+
+
+class Outcome:
+    __slots__ = ("row", "chat_id", "state", "attempt", "delay", "message_id", "error", "mark")
+
+    def __init__(self, row: dict, state: str, attempt: int = 1, delay: float = 0.0,
+                 message_id: Optional[int] = None, error: Optional[str] = None,
+                 mark: Optional[str] = None, chat_id: Optional[int] = None):
+        self.row = row
+        self.chat_id = chat_id or row['chat_id']
+        self.state = state
+        self.attempt = attempt
+        self.delay = delay
+        self.message_id = message_id
+        self.error = error
+        self.mark = mark
+
+
+class Outbound:
+    """Persistent outbound queue behind telegram.send and telegram.broadcast.
+
+    Messages are rows in `outbound_message`. `run()` claims due rows in
+    batches (a lease, so several instances can share the queue), sends them
+    paced per chat on top of TelegramBot's global limiter, and writes the
+    outcomes back in one go:
+
+    - sent: `user.can_chat` becomes TRUE for private chats;
+    - 429: requeued after `retry_after`, which also holds that chat;
+    - blocked, deactivated or gone: failed, and the user or chat is marked
+      (`can_chat` FALSE, `is_deleted` TRUE) so later sends skip it;
+    - upgraded group: requeued to `migrate_to_chat_id`;
+    - server or network errors: retried with backoff up to `max_attempts`.
+
+    A batch is spread across chats: each chat gets at most the rows it can
+    send, at its pace, within the lease (less `max_wait` for the write-back).
+    Rows whose slot would fall past that are requeued without an attempt,
+    so no row outlives its lease and gets sent again by another instance.
+
+    Receipts for messages that reached a final state are published on
+    `receipts_subject` in batches.
+    """
+
+    def __init__(self):
+        self.batch_size = OUTBOUND_CFG.get("batch_size", 200)
+        self.interval = OUTBOUND_CFG.get("interval", 1)
+        self.concurrency = OUTBOUND_CFG.get("concurrency", 25)
+        self.lease = OUTBOUND_CFG.get("lease", 60)
+        self.private_gap = OUTBOUND_CFG.get("private_gap", 1.0)
+        self.group_gap = OUTBOUND_CFG.get("group_gap", 3.0)
+        self.max_wait = OUTBOUND_CFG.get("max_wait", 5)
+        self.scan = OUTBOUND_CFG.get("scan", 10) * self.batch_size
+        # Sending time per claim; the rest of the lease covers the write-back.
+        self.window = max(self.lease - self.max_wait, 1)
+        self.max_attempts = OUTBOUND_CFG.get("max_attempts", 5)
+        self.backoff = OUTBOUND_CFG.get("backoff", 2)
+        self.backoff_max = OUTBOUND_CFG.get("backoff_max", 300)
+        self.receipts_subject = OUTBOUND_CFG.get("receipts_subject", "telegram.outbound.receipts")
+        self.receipts_batch = OUTBOUND_CFG.get("receipts_batch", 500)
+
+        # chat_id -> monotonic time its next message may go out.
+        self._next_slot: Dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+
+    @staticmethod
+    def _validate(text: str, options: Optional[Dict[str, Any]]) -> Optional[str]:
+        if not text or not isinstance(text, str):
+            raise ValueError("text is required")
+        if len(text) > MAX_TEXT_LENGTH:
+            raise ValueError(f"text is longer than {MAX_TEXT_LENGTH} characters")
+        if not options:
+            return None
+        if not isinstance(options, dict):
+            raise ValueError("options must be an object")
+        unknown = set(options) - SEND_OPTIONS
+        if unknown:
+            raise ValueError(f"Unsupported options: {', '.join(sorted(unknown))}")
+        return json.dumps(options)
+
+    async def unreachable(self, chat_ids: Iterable[int]) -> set:
+        """The chats sends are skipped for: users who blocked the bot or were
+        deleted, and deleted chats."""
+        chat_ids = list(chat_ids)
+        users = [chat_id for chat_id in chat_ids if chat_id > 0]
+        chats = [chat_id for chat_id in chat_ids if chat_id < 0]
+        skipped = set()
+        for ids, query in (
+            (users, "SELECT `user_id` AS `id` FROM `kopilot_telegram`.`user` "
+                    "WHERE `user_id` IN ({}) AND (`can_chat` = FALSE OR `is_deleted`);"),
+            (chats, "SELECT `chat_id` AS `id` FROM `kopilot_telegram`.`chat` "
+                    "WHERE `chat_id` IN ({}) AND `is_deleted`;"),
+        ):
+            for start in range(0, len(ids), IN_CHUNK):
+                chunk = ids[start:start + IN_CHUNK]
+                rows = await db.aexecute_query(
+                    query.format(", ".join(["%s"] * len(chunk))), tuple(chunk), primary=True
+                )
+                skipped.update(row['id'] for row in rows)
+        return skipped
+
+    async def send(self, chat_id: int, text: str, options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        encoded = self._validate(text, options)
+        if await self.unreachable([chat_id]):
+            metrics.incr("outbound.skipped")
+            return {"chat_id": chat_id, "state": "skipped"}
+
+        outbound_id = await db.aexecute_insert(INSERT_OUTBOUND, (None, chat_id, text, encoded))
+        metrics.incr("outbound.queued")
+        self._wakeup.set()
+        return {"id": outbound_id, "chat_id": chat_id, "state": "queued"}
+
+    async def broadcast(
+        self, chat_ids: Iterable[int], text: str,
+        options: Optional[Dict[str, Any]] = None, broadcast_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        encoded = self._validate(text, options)
+        broadcast_id = broadcast_id or uuid.uuid4().hex
+        chat_ids = list(dict.fromkeys(int(chat_id) for chat_id in chat_ids))
+
+        skipped = await self.unreachable(chat_ids)
+        queued = [chat_id for chat_id in chat_ids if chat_id not in skipped]
+        for start in range(0, len(queued), self.batch_size):
+            await db.aexecute_many(
+                INSERT_OUTBOUND,
+                [(broadcast_id, chat_id, text, encoded) for chat_id in queued[start:start + self.batch_size]]
+            )
+
+        metrics.incr("outbound.queued", len(queued))
+        metrics.incr("outbound.skipped", len(skipped))
+        logger.info(f"Broadcast {broadcast_id}: {len(queued)} queued, {len(skipped)} skipped")
+        self._wakeup.set()
+        return {"broadcast_id": broadcast_id, "queued": len(queued), "skipped": sorted(skipped)}
+
+    def _slot(self, chat_id: int, now: float) -> float:
+        return max(now, self._next_slot.get(chat_id, 0.0))
+
+    def _hold(self, chat_id: int, until: float):
+        self._next_slot[chat_id] = max(self._next_slot.get(chat_id, 0.0), until)
+
+    def _retry(self, row: dict, error: str) -> Outcome:
+        attempts = row['attempts'] + 1
+        if attempts >= self.max_attempts:
+            return Outcome(row, "failed", error=error)
+        return Outcome(row, "queued", delay=min(self.backoff_max, self.backoff ** attempts), error=error)
+
+    async def _deliver(self, row: dict) -> Outcome:
+        chat_id = row['chat_id']
+        options = json.loads(row['options']) if row['options'] else {}
+        try:
+            result = await tg.request('sendMessage', chat_id=chat_id, text=row['text'], **options)
+        except TelegramError as e:
+            if e.error_code == 429:
+                retry_after = e.retry_after or 1
+                self._hold(chat_id, time.monotonic() + retry_after)
+                metrics.incr("outbound.throttled")
+                return Outcome(row, "queued", attempt=0, delay=retry_after, error=e.description[:255])
+            if e.migrate_to_chat_id:
+                return Outcome(row, "queued", attempt=0, chat_id=e.migrate_to_chat_id, error=e.description[:255])
+            mark = _unreachable(chat_id, e)
+            if e.error_code >= 500:
+                return self._retry(row, e.description[:255])
+            return Outcome(row, "failed", error=e.description[:255], mark=mark)
+        except httpx.RequestError as e:
+            return self._retry(row, f"{type(e).__name__}: {e}"[:255])
+
+        return Outcome(row, "sent", message_id=(result or {}).get('message_id'))
+
+    def _gap(self, chat_id: int) -> float:
+        return self.private_gap if chat_id > 0 else self.group_gap
+
+    def _pick(self, due: List[dict]) -> List[int]:
+        # Up to what each chat can send within the window, first rows of
+        # every chat ahead of later ones.
+        positions: Dict[int, int] = {}
+        ranked = []
+        for row in due:
+            position = positions.get(row['chat_id'], 0)
+            if position < max(1, int(self.window / self._gap(row['chat_id']))):
+                ranked.append((position, row['id']))
+            positions[row['chat_id']] = position + 1
+        return [row_id for _, row_id in sorted(ranked)[:self.batch_size]]
+
+    async def _send_chat(self, rows: List[dict], deadline: float) -> List[Outcome]:
+        # One chat's messages, in order and paced for that chat.
+        outcomes = []
+        gap = self._gap(rows[0]['chat_id'])
+        unreachable: Optional[Outcome] = None
+        for row in rows:
+            chat_id = row['chat_id']
+            if unreachable is not None:
+                outcomes.append(Outcome(row, "failed", error=unreachable.error))
+                continue
+
+            now = time.monotonic()
+            slot = self._slot(chat_id, now)
+            if slot - now > self.max_wait or slot > deadline:
+                # Too far off to hold the lease for; back to the queue, no attempt spent.
+                outcomes.append(Outcome(row, "queued", attempt=0, delay=slot - now))
+                continue
+            self._next_slot[chat_id] = slot + gap
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            outcome = await self._deliver(row)
+            if outcome.mark:
+                unreachable = outcome
+            outcomes.append(outcome)
+        return outcomes
+
+    async def _record(self, claim: str, outcomes: List[Outcome]):
+        recorded = await db.aexecute_many(UPDATE_OUTBOUND, [
+            (
+                outcome.chat_id, outcome.state, outcome.attempt, int(outcome.delay * 1_000_000),
+                outcome.message_id, outcome.error, outcome.row['id'], claim
+            )
+            for outcome in outcomes
+        ])
+        if recorded is not None and recorded < len(outcomes):
+            # The lease ran out and another instance reclaimed these rows.
+            metrics.incr("outbound.lease_lost", len(outcomes) - recorded)
+            logger.warning(f"Claim {claim}: {len(outcomes) - recorded} of {len(outcomes)} outcomes came after the lease")
+
+        marks: Dict[str, List[Tuple[int]]] = {}
+        for outcome in outcomes:
+            if outcome.mark:
+                marks.setdefault(outcome.mark, []).append((outcome.chat_id,))
+            elif outcome.state == "sent" and outcome.chat_id > 0:
+                marks.setdefault("reachable", []).append((outcome.chat_id,))
+        for mark, query in (
+            (BLOCKED, MARK_BLOCKED), (USER_DELETED, MARK_USER_DELETED),
+            (CHAT_DELETED, MARK_CHAT_DELETED), ("reachable", MARK_REACHABLE),
+        ):
+            if marks.get(mark):
+                await db.aexecute_many(query, list(dict.fromkeys(marks[mark])))
+                if mark == CHAT_DELETED:
+                    for (chat_id,) in marks[mark]:
+                        cache.invalidate(("chat", chat_id))
+                if mark != "reachable":
+                    logger.info(f"Marked {len(marks[mark])} chats {mark}")
+
+        for outcome in outcomes:
+            metrics.incr(f"outbound.{outcome.state}")
+
+    async def _publish_receipts(self, outcomes: List[Outcome]):
+        receipts = [
+            {
+                "id": outcome.row['id'],
+                "broadcast_id": outcome.row['broadcast_id'],
+                "chat_id": outcome.chat_id,
+                "state": outcome.state,
+                "message_id": outcome.message_id,
+                "error": outcome.error,
+            }
+            for outcome in outcomes if outcome.state in ("sent", "failed")
+        ]
+        for start in range(0, len(receipts), self.receipts_batch):
+            try:
+                await nc.pub(self.receipts_subject, {"receipts": receipts[start:start + self.receipts_batch]})
+            except Exception as e:
+                logger.error(f"Failed to publish {len(receipts[start:start + self.receipts_batch])} outbound receipts: {e}")
+
+    async def dispatch(self) -> int:
+        """Claims one batch of due messages, sends it and records the outcomes.
+        Returns the number of messages claimed."""
+        claim = uuid.uuid4().hex
+        with tracer.span("outbound.dispatch"):
+            due = await db.aexecute_query(SELECT_DUE, (self.scan,), primary=True)
+            picked = self._pick(due)
+            if not picked:
+                return 0
+            claimed = await db.aexecute_update(
+                CLAIM_OUTBOUND.format(", ".join(["%s"] * len(picked))), (claim, self.lease, *picked)
+            )
+            if not claimed:
+                return 0
+            deadline = time.monotonic() + self.window
+            rows = await db.aexecute_query(SELECT_CLAIMED, (claim,), primary=True)
+
+            by_chat: Dict[int, List[dict]] = {}
+            for row in rows:
+                by_chat.setdefault(row['chat_id'], []).append(row)
+            results = await map_bounded(
+                lambda chat_rows: self._send_chat(chat_rows, deadline), list(by_chat.values()), self.concurrency
+            )
+            outcomes = [outcome for chat_outcomes in results for outcome in chat_outcomes]
+
+            await self._record(claim, outcomes)
+            await self._publish_receipts(outcomes)
+
+        now = time.monotonic()
+        self._next_slot = {chat_id: slot for chat_id, slot in self._next_slot.items() if slot > now}
+        return claimed
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if tg.offline:
+                continue
+            try:
+                while await self.dispatch() >= self.batch_size:
+                    pass
+            except Exception as e:
+                logger.error(f"Outbound dispatch failed: {e}")
+
+outbound = Outbound()
@@ -0,0 +1,182 @@
+import gzip
+import json
+import logging
+import os
+from datetime import date
+from typing import List, Dict, Any, Optional
+
+from common.config import PARTITION_CFG
+from common.mysql import MySQL as db
+
+import anyio
+from anyio import to_thread
+
+logger = logging.getLogger("mysql")
+
+PARTITIONED_TABLES = ("message", "reaction")
+HISTORY, FUTURE = "p_history", "p_future"
+
+
+def month_start(day: date, offset: int = 0) -> date:
+    month = day.year * 12 + day.month - 1 + offset
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"p{month:%Y%m}"
+
+
+def _upper_bound(description: Optional[str]) -> Optional[date]:
+    if not description or description == "MAXVALUE":
+        return None
+    return date.fromisoformat(description.strip("'")[:10])
+
+
+class PartitionManager:
+    def __init__(self):
+        self.months_ahead = PARTITION_CFG.get("months_ahead", 3)
+        self.retention_months = PARTITION_CFG.get("retention_months", 0)
+        self.archive_path = PARTITION_CFG.get("archive_path")
+
+    async def partitions(self, table: str) -> List[Dict[str, Any]]:
+        rows = await db.aexecute_query(
+            """
+            SELECT `PARTITION_NAME` AS `name`, `PARTITION_DESCRIPTION` AS `description`, `TABLE_ROWS` AS `rows`
+            FROM `information_schema`.`PARTITIONS`
+            WHERE `TABLE_SCHEMA` = 'kopilot_telegram' AND `TABLE_NAME` = %s AND `PARTITION_NAME` IS NOT NULL
+            ORDER BY `PARTITION_ORDINAL_POSITION`;
+            """,
+            (table,),
+            primary=True
+        )
+        for row in rows:
+            row['upper_bound'] = _upper_bound(row['description'])
+        return rows
+
+    async def ensure_future(self, table: str, today: Optional[date] = None) -> List[str]:
+        today = today or date.today()
+        partitions = await self.partitions(table)
+        if not partitions:
+            logger.warning(f"{table} is not partitioned; skipping partition maintenance")
+            return []
+
+        bounds = [p['upper_bound'] for p in partitions if p['upper_bound']]
+        target = month_start(today, self.months_ahead + 1)
+
+        created = []
+        new_partitions = []
+        if bounds:
+            month = max(bounds)
+        else:
+            # Freshly partitioned (migration 0005): rows so far go to p_history.
+            month = month_start(today)
+            new_partitions.append(f"PARTITION `{HISTORY}` VALUES LESS THAN ('{month}')")
+            created.append(HISTORY)
+        while month < target:
+            new_partitions.append(
+                f"PARTITION `{partition_name(month)}` VALUES LESS THAN ('{month_start(month, 1)}')"
+            )
+            created.append(partition_name(month))
+            month = month_start(month, 1)
+
+        if new_partitions:
+            # p_future is empty while the months ahead exist, so splitting it
+            # only touches metadata; the first split moves the existing rows.
+            await db.aexecute_update(f"""
+            ALTER TABLE `kopilot_telegram`.`{table}`
+            REORGANIZE PARTITION `{FUTURE}` INTO (
+                {", ".join(new_partitions)},
+                PARTITION `{FUTURE}` VALUES LESS THAN (MAXVALUE)
+            );
+            """)
+            logger.info(f"Created partitions {created} on {table}")
+        return created
+
+    async def archive_expired(self, table: str, today: Optional[date] = None) -> List[str]:
+        if not self.retention_months:
+            return []
+        cutoff = month_start(today or date.today(), -self.retention_months)
+
+        archived = []
+        for partition in await self.partitions(table):
+            bound = partition['upper_bound']
+            if bound is None or bound > cutoff:
+                continue
+            if self.archive_path:
+                rows = await self.archive_partition(table, partition['name'])
+                logger.info(f"Archived {rows} rows of {table}.{partition['name']}")
+            await db.aexecute_update(
+                f"ALTER TABLE `kopilot_telegram`.`{table}` DROP PARTITION `{partition['name']}`;"
+            )
+            logger.info(f"Dropped partition {table}.{partition['name']}")
+            archived.append(partition['name'])
+        return archived
+
+    async def archive_partition(self, table: str, partition: str) -> int:
+        directory = os.path.join(self.archive_path, table)
+        await anyio.Path(directory).mkdir(parents=True, exist_ok=True)
+        path = os.path.join(directory, f"{partition}.ndjson.gz")
+
+        f = await to_thread.run_sync(gzip.open, path + ".tmp", "wt", 6, "utf-8")
+        rows = 0
+        try:
+            async for batch in db.astream(
+                f"SELECT * FROM `kopilot_telegram`.`{table}` PARTITION (`{partition}`) ORDER BY `id`;",
+                batch_size=5000,
+                primary=True
+            ):
+                chunk = "".join(json.dumps(row, default=str) + "\n" for row in batch)
+                await to_thread.run_sync(f.write, chunk)
+                rows += len(batch)
+        finally:
+            await to_thread.run_sync(f.close)
+
+        count = await db.aexecute_query(
+            f"SELECT COUNT(*) AS `rows` FROM `kopilot_telegram`.`{table}` PARTITION (`{partition}`);",
+            fetch_one=True,
+            primary=True
+        )
+        if count['rows'] != rows:
+            raise RuntimeError(
+                f"Archive of {table}.{partition} wrote {rows} rows but the partition has {count['rows']}"
+            )
+        await to_thread.run_sync(os.replace, path + ".tmp", path)
+        return rows
+
+    async def maintain(self, today: Optional[date] = None) -> Dict[str, Any]:
+        result = {}
+        for table in PARTITIONED_TABLES:
+            result[table] = {
+                "created": await self.ensure_future(table, today),
+                "archived": await self.archive_expired(table, today),
+            }
+        return result
+
+    async def run(self):
+        # Safety net next to the cron job: keeps the months ahead created.
+        while True:
+            for table in PARTITIONED_TABLES:
+                try:
+                    await self.ensure_future(table)
+                except Exception as e:
+                    logger.error(f"Partition maintenance on {table} failed: {e}")
+            await anyio.sleep(PARTITION_CFG.get("check_interval", 6 * 3600))
+
+    async def index_usage(self) -> List[Dict[str, Any]]:
+        return await db.aexecute_query(
+            """
+            SELECT
+                `OBJECT_NAME` AS `table`,
+                `INDEX_NAME` AS `index`,
+                `COUNT_READ` AS `reads`,
+                `COUNT_WRITE` AS `writes`
+            FROM `performance_schema`.`table_io_waits_summary_by_index_usage`
+            WHERE `OBJECT_SCHEMA` = 'kopilot_telegram'
+                AND `INDEX_NAME` IS NOT NULL
+                AND `INDEX_NAME` != 'PRIMARY'
+            ORDER BY `COUNT_READ`, `OBJECT_NAME`, `INDEX_NAME`;
+            """,
+            primary=True
+        )
+
+partitions = PartitionManager()
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Optional, List, Dict, Any
+
+from common.config import PROFILER_CFG
+
+from anyio import Path, to_thread
+
+logger = logging.getLogger()
+
+
+def _frame_label(code) -> str:
+    module = code.co_filename.rsplit("/", 1)[-1].removesuffix(".py")
+    return f"{module}:{code.co_qualname}"
+
+
+def _coroutine_chain(coro) -> List[str]:
+    chain = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            chain.append(type(coro).__name__)
+            break
+        chain.append(_frame_label(frame.f_code))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return chain
+
+
+class SamplingProfiler:
+    """Time-boxed sampler for the event loop thread.
+
+    Nothing runs until `profile` is called; the sampler thread lives only for
+    the duration of one profile. Profiles are written to PROFILER_CFG's
+    `path`: PROFILE_PATH, else LOG_PATH, else the system temp directory.
+    """
+
+    def __init__(self):
+        self.running = False
+        self.path = PROFILER_CFG.get("path")
+
+    async def profile(self, duration: float, interval_ms: Optional[float] = None, mode: str = "cpu") -> Dict[str, Any]:
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        if mode not in ("cpu", "wall"):
+            raise ValueError(f"Unknown profile mode: {mode}")
+
+        duration = min(float(duration), PROFILER_CFG.get("max_duration", 120))
+        interval = (interval_ms or PROFILER_CFG.get("interval_ms", 5)) / 1000
+
+        loop = asyncio.get_running_loop()
+        thread_id = threading.get_ident()
+        stacks = Counter()
+        stop = threading.Event()
+
+        def sample():
+            while not stop.wait(interval):
+                self._sample_loop_thread(loop, thread_id, stacks)
+                if mode == "wall":
+                    self._sample_suspended_tasks(loop, stacks)
+
+        self.running = True
+        started = time.monotonic()
+        # The sampler only runs when it gets the GIL; a short switch interval
+        # stops samples from piling up at the loop's idle points.
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch_interval, interval / 10))
+        sampler = threading.Thread(target=sample, name="sampling-profiler", daemon=True)
+        sampler.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            stop.set()
+            await to_thread.run_sync(sampler.join)
+            sys.setswitchinterval(switch_interval)
+            self.running = False
+
+        filename = f"profile-{datetime.now():%Y%m%d-%H%M%S}-{mode}.folded"
+        output = Path(self.path, filename)
+        await output.write_text(
+            "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+        )
+        logger.info(f"Wrote {sum(stacks.values())} profile samples to {output}")
+
+        return {
+            "path": str(output),
+            "mode": mode,
+            "duration": round(time.monotonic() - started, 3),
+            "samples": sum(stacks.values()),
+            "top": [
+                {"stack": stack.rsplit(";", 3)[-3:], "samples": count}
+                for stack, count in stacks.most_common(10)
+            ],
+        }
+
+    def _sample_loop_thread(self, loop, thread_id: int, stacks: Counter):
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            return
+
+        frames = []
+        while frame is not None:
+            frames.append(frame.f_code)
+            frame = frame.f_back
+        frames.reverse()
+
+        task = asyncio.tasks._current_tasks.get(loop)
+        names = [code.co_qualname for code in frames]
+        if frames and frames[-1].co_name in ("select", "poll", "epoll") and task is None:
+            stacks["(idle)"] += 1
+            return
+
+        # Drop the event loop machinery above the callback being run.
+        for marker in ("Task.__step", "Handle._run", "BaseEventLoop._run_once"):
+            if marker in names:
+                frames = frames[len(names) - names[::-1].index(marker):]
+                break
+        prefix = f"task:{task.get_name()}" if task is not None else "(loop)"
+
+        stacks[";".join([prefix] + [_frame_label(code) for code in frames])] += 1
+
+    def _sample_suspended_tasks(self, loop, stacks: Counter):
+        current = asyncio.tasks._current_tasks.get(loop)
+        try:
+            tasks = asyncio.all_tasks(loop)
+        except RuntimeError:
+            return
+        for task in tasks:
+            if task is current or task.done():
+                continue
+            chain = _coroutine_chain(task.get_coro())
+            stacks[";".join([f"task:{task.get_name()}", "(awaiting)"] + chain)] += 1
+
+profiler = SamplingProfiler()
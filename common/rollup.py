@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from datetime import datetime, date
+from typing import Dict, Tuple, List
+
+from common.config import ROLLUP_CFG
+from common.metrics import metrics
+from common.mysql import MySQL as db
+from common.cache import cache
+
+logger = logging.getLogger("mysql")
+
+# Counter positions in the per-chat and per-member deltas.
+MESSAGES, REPLIES, REACTIONS = 0, 1, 2
+
+CHAT_UPSERT = """
+INSERT INTO `kopilot_telegram`.`chat_activity_daily` (
+    `chat_id`, `day`, `messages`, `replies`, `reactions`
+) VALUES (%s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+    `messages` = `messages` + VALUES(`messages`),
+    `replies` = `replies` + VALUES(`replies`),
+    `reactions` = `reactions` + VALUES(`reactions`);
+"""
+
+CHATMEMBER_UPSERT = """
+INSERT INTO `kopilot_telegram`.`chatmember_activity_daily` (
+    `chat_id`, `user_id`, `day`, `messages`, `replies`, `reactions`
+) VALUES (%s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+    `messages` = `messages` + VALUES(`messages`),
+    `replies` = `replies` + VALUES(`replies`),
+    `reactions` = `reactions` + VALUES(`reactions`);
+"""
+
+TYPE_UPSERT = """
+INSERT INTO `kopilot_telegram`.`chat_type_activity_daily` (
+    `chat_id`, `day`, `type`, `messages`
+) VALUES (%s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE
+    `messages` = `messages` + VALUES(`messages`);
+"""
+
+
+class ActivityRollup:
+    """In-memory counter deltas for the *_activity_daily tables, flushed as
+    additive upserts every `interval` seconds or once `max_pending` keys
+    have accumulated."""
+
+    def __init__(self):
+        self.interval = ROLLUP_CFG.get("interval", 5)
+        self.max_pending = ROLLUP_CFG.get("max_pending", 5000)
+
+        self._chats: Dict[Tuple[int, date], List[int]] = {}
+        self._chatmembers: Dict[Tuple[int, int, date], List[int]] = {}
+        self._types: Dict[Tuple[int, date, str], int] = {}
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+
+    @property
+    def pending(self) -> int:
+        return len(self._chats) + len(self._chatmembers) + len(self._types)
+
+    def _add(self, chat_id: int, user_id: int, day: date, field: int):
+        self._chats.setdefault((chat_id, day), [0, 0, 0])[field] += 1
+        self._chatmembers.setdefault((chat_id, user_id, day), [0, 0, 0])[field] += 1
+        if self.pending >= self.max_pending:
+            self._wakeup.set()
+
+    def add_message(self, chat_id: int, user_id: int, when: datetime, message_type: str, is_reply: bool):
+        day = when.date()
+        self._add(chat_id, user_id, day, MESSAGES)
+        if is_reply:
+            self._add(chat_id, user_id, day, REPLIES)
+        key = (chat_id, day, message_type)
+        self._types[key] = self._types.get(key, 0) + 1
+
+    def add_reaction(self, chat_id: int, user_id: int, when: datetime):
+        self._add(chat_id, user_id, when.date(), REACTIONS)
+
+    async def flush(self):
+        async with self._flush_lock:
+            chats, self._chats = self._chats, {}
+            chatmembers, self._chatmembers = self._chatmembers, {}
+            types, self._types = self._types, {}
+            if not (chats or chatmembers or types):
+                return
+
+            try:
+                if chats:
+                    await db.aexecute_many(
+                        CHAT_UPSERT,
+                        [(chat_id, day, *counts) for (chat_id, day), counts in chats.items()]
+                    )
+                    for chat_id in {chat_id for chat_id, _ in chats}:
+                        cache.invalidate_tag(("chat_stats", chat_id))
+                    chats = {}
+                if chatmembers:
+                    await db.aexecute_many(
+                        CHATMEMBER_UPSERT,
+                        [(chat_id, user_id, day, *counts) for (chat_id, user_id, day), counts in chatmembers.items()]
+                    )
+                    chatmembers = {}
+                if types:
+                    await db.aexecute_many(
+                        TYPE_UPSERT,
+                        [(chat_id, day, message_type, count) for (chat_id, day, message_type), count in types.items()]
+                    )
+                    types = {}
+            except BaseException as e:
+                # Also covers cancellation mid-flush: unwritten deltas go back.
+                self._merge(chats, chatmembers, types)
+                if isinstance(e, Exception):
+                    logger.error(f"Failed to flush activity rollups, keeping deltas for retry: {e}")
+                raise
+            finally:
+                metrics.gauge("rollup.pending", self.pending)
+
+    def _merge(self, chats, chatmembers, types):
+        for key, counts in chats.items():
+            current = self._chats.setdefault(key, [0, 0, 0])
+            for i, value in enumerate(counts):
+                current[i] += value
+        for key, counts in chatmembers.items():
+            current = self._chatmembers.setdefault(key, [0, 0, 0])
+            for i, value in enumerate(counts):
+                current[i] += value
+        for key, count in types.items():
+            self._types[key] = self._types.get(key, 0) + count
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                await asyncio.sleep(self.interval)
+
+rollup = ActivityRollup()
@@ -0,0 +1,254 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime, date
+from decimal import Decimal
+from typing import Dict, Any, Optional, List, Callable
+
+from common.config import SPOOL_CFG
+from common.metrics import metrics
+from common.mysql import MySQL as db, UNAVAILABLE_ERRORS
+
+from anyio import to_thread
+
+logger = logging.getLogger("mysql")
+
+# Name of spooled statements.
+STATEMENT = "update"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS `entries` (
+    `id` INTEGER PRIMARY KEY AUTOINCREMENT,
+    `kind` TEXT NOT NULL,
+    `name` TEXT NOT NULL,
+    `payload` TEXT NOT NULL,
+    `created` REAL NOT NULL
+);
+"""
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, date):
+        return {"$date": value.isoformat()}
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError(f"Cannot spool {type(value).__name__}")
+
+
+def _decode(value: dict):
+    if "$datetime" in value:
+        return datetime.fromisoformat(value["$datetime"])
+    if "$date" in value:
+        return date.fromisoformat(value["$date"])
+    return value
+
+
+class Spool:
+    """Local append-only journal (SQLite in WAL mode) for work that could not
+    reach MySQL. Two kinds of entries are kept, in arrival order:
+
+    - statements: a single write with its params, replayed as is;
+    - events: a whole payload handed back to the handler registered for its
+      name with `@spool.replayer(name)`. Handlers must be idempotent, as an
+      event may have been partly written before it was spooled.
+
+    `run()` drains the journal in batches once the primary accepts writes.
+    Until it has, writers of ordered work (`behind()`) keep appending to
+    the journal rather than overtaking what is spooled.
+    """
+
+    def __init__(self):
+        self.path = SPOOL_CFG.get("path")
+        self.batch_size = SPOOL_CFG.get("batch_size", 200)
+        self.interval = SPOOL_CFG.get("interval", 1)
+
+        self.depth = 0
+        self.depths: Counter = Counter()
+        self._replayers: Dict[str, Callable] = {}
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+
+    def _get(self) -> sqlite3.Connection:
+        if self._connection is None:
+            if not self.path:
+                raise RuntimeError("SPOOL_PATH (or LOG_PATH) is not configured")
+            con = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            # WAL + NORMAL: an append is durable once the process has written
+            # it, without an fsync per entry.
+            con.execute("PRAGMA journal_mode=WAL;")
+            con.execute("PRAGMA synchronous=NORMAL;")
+            con.execute(SCHEMA)
+            self.depths = Counter(dict(con.execute("SELECT `name`, COUNT(*) FROM `entries` GROUP BY `name`;")))
+            self.depth = sum(self.depths.values())
+            self._connection = con
+        return self._connection
+
+    def _append(self, kind: str, name: str, payload: str):
+        with self._lock:
+            self._get().execute(
+                "INSERT INTO `entries` (`kind`, `name`, `payload`, `created`) VALUES (?, ?, ?, ?);",
+                (kind, name, payload, time.time())
+            )
+            self.depth += 1
+            self.depths[name] += 1
+
+    def _read(self, limit: int) -> List[tuple]:
+        with self._lock:
+            return self._get().execute(
+                "SELECT `id`, `kind`, `name`, `payload`, `created` FROM `entries` ORDER BY `id` LIMIT ?;",
+                (limit,)
+            ).fetchall()
+
+    def _delete(self, rows: List[tuple]):
+        with self._lock:
+            self._get().execute("DELETE FROM `entries` WHERE `id` <= ?;", (rows[-1][0],))
+            self.depth = max(0, self.depth - len(rows))
+            self.depths.subtract(row[2] for row in rows)
+            self.depths = +self.depths
+
+    def behind(self, *names: str) -> bool:
+        """Whether entries spooled under one of `names` are still waiting.
+        Work that must apply in order after them has to be spooled too."""
+        return any(self.depths[name] > 0 for name in names)
+
+    def replayer(self, name: str):
+        def decorator(func: Callable):
+            self._replayers[name] = func
+            return func
+        return decorator
+
+    async def defer(self, name: str, data: dict):
+        await to_thread.run_sync(self._append, "event", name, json.dumps(data, default=_encode))
+        metrics.incr("spool.events")
+        metrics.gauge("spool.depth", self.depth)
+        self._wakeup.set()
+
+    async def execute_update(self, query: str, params=None) -> Optional[int]:
+        """`aexecute_update` that journals the statement instead of failing
+        or queueing while the primary is tripped, or while statements spooled
+        earlier are still waiting. Returns None when spooled."""
+        if db.primary.available and not self.behind(STATEMENT):
+            try:
+                return await db.aexecute_update(query, params)
+            except UNAVAILABLE_ERRORS as e:
+                logger.warning(f"Spooling statement, primary unavailable: {e}")
+
+        payload = json.dumps({"query": str(query), "params": list(params or ())}, default=_encode)
+        await to_thread.run_sync(self._append, "statement", STATEMENT, payload)
+        metrics.incr("spool.statements")
+        metrics.gauge("spool.depth", self.depth)
+        self._wakeup.set()
+        return None
+
+    async def drain(self) -> int:
+        """Replays spooled entries in order until the journal is empty or the
+        primary fails again. Returns the number of entries applied."""
+        applied = 0
+        while self.depth and db.primary.available:
+            rows = await to_thread.run_sync(self._read, self.batch_size)
+            if not rows:
+                self.depth = 0
+                self.depths.clear()
+                break
+
+            done = 0
+            try:
+                while done < len(rows):
+                    entry_id, kind, name, payload, created = rows[done]
+                    data = json.loads(payload, object_hook=_decode)
+                    if kind == "statement":
+                        # Consecutive copies of one statement go out as one executemany.
+                        start, end = done, done + 1
+                        while (
+                            end < len(rows) and rows[end][1] == "statement"
+                            and json.loads(rows[end][3])["query"] == data["query"]
+                        ):
+                            end += 1
+                        group = [json.loads(row[3], object_hook=_decode)["params"] for row in rows[start:end]]
+                        try:
+                            await db.aexecute_many(data["query"], [tuple(params) for params in group])
+                        except UNAVAILABLE_ERRORS:
+                            raise
+                        except Exception as e:
+                            # One bad row fails the whole executemany: apply them
+                            # one at a time so only the bad ones are dropped.
+                            logger.warning(
+                                f"Spooled statements {entry_id}-{rows[end - 1][0]} failed together, "
+                                f"retrying one by one: {e}"
+                            )
+                            for position in range(start, end):
+                                try:
+                                    await db.aexecute_update(data["query"], tuple(group[position - start]))
+                                except UNAVAILABLE_ERRORS:
+                                    raise
+                                except Exception as e:
+                                    self._dropped(rows[position], e)
+                                done = position + 1
+                        for row in rows[start:end]:
+                            metrics.observe("spool.age", time.time() - row[4])
+                        done = end
+                        continue
+                    try:
+                        if name in self._replayers:
+                            await self._replayers[name](data)
+                        else:
+                            logger.error(f"No replayer registered for spooled {name}, dropping entry {entry_id}")
+                            metrics.incr("spool.dropped")
+                    except UNAVAILABLE_ERRORS:
+                        raise
+                    except Exception as e:
+                        self._dropped(rows[done], e)
+                    metrics.observe("spool.age", time.time() - created)
+                    done += 1
+            except UNAVAILABLE_ERRORS as e:
+                logger.warning(f"Spool drain interrupted, primary unavailable: {e}")
+                break
+            finally:
+                if done:
+                    await to_thread.run_sync(self._delete, rows[:done])
+                    applied += done
+                    metrics.incr("spool.drained", done)
+                metrics.gauge("spool.depth", self.depth)
+
+        if applied:
+            logger.info(f"Drained {applied} spooled entries, {self.depth} left")
+        return applied
+
+    @staticmethod
+    def _dropped(row: tuple, error: Exception):
+        # Retrying cannot fix it; keep the journal moving.
+        entry_id, kind, name = row[:3]
+        logger.error(f"Dropping spooled {kind} {entry_id} ({name}): {error}")
+        metrics.incr("spool.dropped")
+
+    async def run(self):
+        if self.path:
+            await to_thread.run_sync(self._get)
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self.depth:
+                continue
+            try:
+                await self.drain()
+            except Exception as e:
+                logger.error(f"Spool drain failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+spool = Spool()
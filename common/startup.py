@@ -0,0 +1,115 @@
+import importlib.util
+import logging
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger()
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_PARTY = ("main", "common", "handlers")
+
+
+def lazy_import(name: str):
+    """The module `name`, executed on first attribute access instead of now.
+
+    For heavy dependencies only some code paths need (PIL for chat photos,
+    httpx until the first Bot API call): importing the service stays cheap
+    and the cost moves to the startup phase or the first use."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}")
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+class StartupProfile:
+    """Timings of the explicit startup phase (`phase()`) and of importing
+    an entry point (`import_times()`), for `main.py --startup-profile` and
+    bench.startup."""
+
+    def __init__(self):
+        self.phases: List[Tuple[str, float, Optional[str]]] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.phases.append((name, elapsed, error))
+            logger.info(f"Startup phase {name} took {elapsed * 1000:.1f} ms" + (f" ({error})" if error else ""))
+
+    @staticmethod
+    def import_times(module: str = "main") -> Tuple[float, List[Tuple[str, int, int, int]]]:
+        """Imports `module` in a fresh interpreter with -X importtime.
+
+        Returns the wall time of the import in seconds, and one
+        (name, depth, self_us, cumulative_us) entry per imported module in
+        import order."""
+        # The marker separates interpreter startup (site, .pth files) from
+        # the import being measured.
+        code = (
+            "import sys, time; sys.stderr.write('-- import\\n'); started = time.perf_counter(); "
+            f"import {module}; print(time.perf_counter() - started)"
+        )
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=BASE_DIR, capture_output=True, text=True, env=dict(os.environ), check=True
+        )
+        entries = []
+        lines = result.stderr.splitlines()
+        for line in lines[lines.index("-- import") + 1:]:
+            if not line.startswith("import time:"):
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            depth = (len(name) - len(name.lstrip())) // 2
+            entries.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+        return float(result.stdout.strip().splitlines()[-1]), entries
+
+    @staticmethod
+    def summarize(entries: List[Tuple[str, int, int, int]], top: int = 10) -> List[str]:
+        # First-party modules by cumulative time, then the heaviest
+        # packages (stdlib included) they pull in.
+        first_party: Dict[str, int] = {}
+        packages: Dict[str, int] = {}
+        for name, depth, self_us, cumulative_us in entries:
+            package = name.split(".")[0]
+            if package in FIRST_PARTY:
+                first_party[name] = cumulative_us
+            else:
+                packages[package] = max(packages.get(package, 0), cumulative_us)
+
+        lines = ["  first-party (cumulative):"]
+        for name, cumulative_us in sorted(first_party.items(), key=lambda item: -item[1])[:top]:
+            lines.append(f"    {name:<28} {cumulative_us / 1000:8.1f} ms")
+        lines.append("  packages (cumulative):")
+        for name, cumulative_us in sorted(packages.items(), key=lambda item: -item[1])[:top]:
+            lines.append(f"    {name:<28} {cumulative_us / 1000:8.1f} ms")
+        return lines
+
+    def report(self, module: str = "main") -> List[str]:
+        wall, entries = self.import_times(module)
+        lines = [f"import {module}: {wall * 1000:.1f} ms"]
+        lines.extend(self.summarize(entries))
+        lines.append("startup phases:")
+        for name, elapsed, error in self.phases:
+            lines.append(f"    {name:<28} {elapsed * 1000:8.1f} ms" + (f"  FAILED {error}" if error else ""))
+        lines.append(f"    {'total':<28} {sum(elapsed for _, elapsed, _ in self.phases) * 1000:8.1f} ms")
+        return lines
+
+startup = StartupProfile()
@@ -0,0 +1,62 @@
+import logging
+from typing import Awaitable, Callable, Iterable, List, Optional, Any
+
+from common.config import HANDLER_CFG
+
+import anyio
+from anyio import CapacityLimiter
+
+logger = logging.getLogger()
+
+
+def _leaves(group: BaseExceptionGroup) -> List[BaseException]:
+    errors = []
+    for error in group.exceptions:
+        if isinstance(error, BaseExceptionGroup):
+            errors.extend(_leaves(error))
+        else:
+            errors.append(error)
+    return errors
+
+
+async def gather(*calls: Optional[Awaitable]) -> List[Any]:
+    """Awaits `calls` concurrently in a task group and returns their results
+    in order; a None in place of a call gives a None result.
+
+    If any call fails the others are cancelled and the first failure is
+    raised as itself, not wrapped in an ExceptionGroup, so callers can keep
+    catching the exceptions they did before the fan-out.
+    """
+    results: List[Any] = [None] * len(calls)
+
+    async def run(index: int, call: Awaitable):
+        results[index] = await call
+
+    try:
+        async with anyio.create_task_group() as task_group:
+            for index, call in enumerate(calls):
+                if call is not None:
+                    task_group.start_soon(run, index, call)
+    except BaseExceptionGroup as group:
+        errors = _leaves(group)
+        for error in errors[1:]:
+            if not isinstance(error, anyio.get_cancelled_exc_class()):
+                logger.error(f"Concurrent step also failed: {error!r}")
+        raise errors[0] from None
+    finally:
+        # Calls cancelled before they started were never awaited.
+        for call in calls:
+            if call is not None and hasattr(call, "close"):
+                call.close()
+    return results
+
+
+async def map_bounded(func: Callable[[Any], Awaitable], items: Iterable, limit: Optional[int] = None) -> List[Any]:
+    """gather() over `func(item)` for every item, at most `limit` at a time."""
+    limiter = CapacityLimiter(limit or HANDLER_CFG.get("fan_out", 8))
+
+    async def bounded(item):
+        async with limiter:
+            return await func(item)
+
+    return await gather(*(bounded(item) for item in items))
@@ -1,59 +1,146 @@
 import logging
 from urllib.parse import quote
-from typing import Optional, Dict, Any, Union
+from typing import Optional, Dict, Any, Union, Iterable
+from collections import OrderedDict
 import json
 
-from common.config import TELEGRAM_TOKEN
+from common.config import TELEGRAM_TOKEN, TELEGRAM_API_URL
+from common.metrics import metrics
+from common.tracing import tracer
+from common.startup import lazy_import
 
 import anyio
 from anyio import to_thread, Semaphore
-import httpx
 from asynciolimiter import StrictLimiter
 
+# Loaded by start() in the startup phase (or the first call), not on import.
+httpx = lazy_import("httpx")
+
 logger = logging.getLogger("telegram")
 
+
+class TelegramError(Exception):
+    """An error response from the Bot API, with the details callers need to
+    react to it (`retry_after` on 429, `migrate_to_chat_id` on upgrades)."""
+
+    def __init__(self, method: str, error_code: int, description: str, parameters: Optional[Dict] = None):
+        super().__init__(f"{method}: {error_code} {description}")
+        self.method = method
+        self.error_code = error_code
+        self.description = description
+        parameters = parameters or {}
+        self.retry_after: Optional[int] = parameters.get('retry_after')
+        self.migrate_to_chat_id: Optional[int] = parameters.get('migrate_to_chat_id')
+
 class TelegramBot:
 
-    api_url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/"
+    api_url = f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/"
     _rate_limiter = StrictLimiter(30/1)
 
+    offline = False
+    # Callers currently queued on the rate limiter.
+    waiting = 0
+    _client: Optional["httpx.AsyncClient"] = None
+    _cache: Optional[OrderedDict] = None
+    _cache_size = 0
+    _cached_methods = frozenset()
+
+    @classmethod
+    def enable_cache(cls, methods: Iterable[str], size: int = 100_000):
+        cls._cache = OrderedDict()
+        cls._cache_size = size
+        cls._cached_methods = frozenset(methods)
+
+    @classmethod
+    def client(cls) -> "httpx.AsyncClient":
+        # One client for the process, so connections to the Bot API are reused.
+        if cls._client is None or cls._client.is_closed:
+            cls._client = httpx.AsyncClient()
+        return cls._client
+
+    @classmethod
+    async def start(cls):
+        cls.client()
+
+    @classmethod
+    async def close(cls):
+        if cls._client is not None:
+            await cls._client.aclose()
+            cls._client = None
+
     @classmethod
     async def call(cls, method: str, files: Optional[Dict] = None, **kwargs) -> Optional[Any]:
-        
-        await cls._rate_limiter.wait()
+        if cls.offline:
+            return None
 
-        url = f"{cls.api_url}{method}"
-        logger.info(f"Making API call to {url} with parameters: {kwargs}")
-        
-        async with httpx.AsyncClient() as client:
+        cache_key = None
+        if cls._cache is not None and method in cls._cached_methods and not files:
+            cache_key = (method, tuple(sorted(kwargs.items())))
+            if cache_key in cls._cache:
+                cls._cache.move_to_end(cache_key)
+                metrics.incr("telegram.cache_hits")
+                return cls._cache[cache_key]
+
+        try:
+            result = await cls.request(method, files, **kwargs)
+        except TelegramError as e:
+            logger.warning(f"API call to {method} failed with error {e.error_code}: {e.description}")
+            return None
+        except httpx.RequestError as e:
+            logger.exception(f"An error occurred while making API call to {method}: {e}")
+            return None
+
+        if cache_key is not None:
+            cls._cache[cache_key] = result
+            if len(cls._cache) > cls._cache_size:
+                cls._cache.popitem(last=False)
+        return result
+
+    @classmethod
+    async def request(cls, method: str, files: Optional[Dict] = None, **kwargs) -> Any:
+        """`call` without the cache and the error handling: returns the result
+        or raises TelegramError (API errors) / httpx.RequestError (transport)."""
+        with tracer.span(f"telegram.{method}", **{"telegram.method": method}):
+            cls.waiting += 1
             try:
-                data = {}
-                for key, value in kwargs.items():
-                    if isinstance(value, (list, dict)):
-                        data[key] = json.dumps(value)
-                    else:
-                        data[key] = value
-                
-                if files:
-                    response = await client.post(url, data=data, files=files)
-                else:
-                    response = await client.post(url, data=data)
-                    
-                if response.status_code == 200:
-                    response_data = response.json()
-                    if not response_data.get('ok'):
-                        logger.warning(f"API call to {url} failed with error: {response_data.get('description')}")
-                        return None
-                    
-                    logger.info(f"API call to {url} succeeded")
-                    return response_data.get('result')
+                await cls._rate_limiter.wait()
+            finally:
+                cls.waiting -= 1
+            metrics.incr("telegram.calls")
+
+            url = f"{cls.api_url}{method}"
+            logger.debug(f"Making API call to {method} with parameters: {kwargs}")
+
+            data = {}
+            for key, value in kwargs.items():
+                if isinstance(value, (list, dict)):
+                    data[key] = json.dumps(value)
                 else:
-                    logger.error(f"API call to {url} failed with status code {response.status_code} and response: {response.text}")
-                    return None
-                    
-            except httpx.RequestError as e:
-                logger.exception(f"An error occurred while making API call to {url}: {e}")
-                return None
+                    data[key] = value
+
+            client = cls.client()
+            if files:
+                response = await client.post(url, data=data, files=files)
+            else:
+                response = await client.post(url, data=data)
+            tracer.set_attribute("http.status_code", response.status_code)
+
+            try:
+                response_data = response.json()
+            except ValueError:
+                raise TelegramError(method, response.status_code, response.text[:200])
+
+            if response.status_code != 200 or not response_data.get('ok'):
+                metrics.incr(f"telegram.errors.{response_data.get('error_code', response.status_code)}")
+                raise TelegramError(
+                    method,
+                    response_data.get('error_code', response.status_code),
+                    response_data.get('description', ''),
+                    response_data.get('parameters')
+                )
+
+            logger.debug(f"API call to {method} succeeded")
+            return response_data.get('result')
 
     @classmethod
     async def send_message(cls, chat_id: Union[int, str], text: str, **kwargs) -> Optional[Any]:
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Optional, Dict, Any, List
+
+from common.config import TRACING_CFG
+
+logger = logging.getLogger("tracing")
+
+TRACEPARENT = "traceparent"
+
+
+class Trace:
+    __slots__ = ("trace_id", "spans", "error")
+
+    def __init__(self, trace_id: str):
+        self.trace_id = trace_id
+        self.spans: List["Span"] = []
+        self.error = False
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes", "start", "end", "error")
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end or time.time_ns()) - self.start) / 1e6
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Tracer:
+    def __init__(self):
+        self.enabled = TRACING_CFG.get("enabled", True)
+        self.slow_threshold_ms = TRACING_CFG.get("slow_threshold_ms", 1000)
+        self.sample_rate = TRACING_CFG.get("sample_rate", 0.0)
+        self.service_name = TRACING_CFG.get("service_name", "kopilot_telegram")
+
+    @contextmanager
+    def trace(self, name: str, headers: Optional[Dict[str, str]] = None, **attributes):
+        if not self.enabled:
+            yield None
+            return
+
+        trace_id, parent_id = None, None
+        traceparent = (headers or {}).get(TRACEPARENT)
+        if traceparent:
+            try:
+                _, trace_id, parent_id, _ = traceparent.split("-")
+            except ValueError:
+                logger.debug(f"Ignoring malformed traceparent: {traceparent}")
+
+        trace = Trace(trace_id or os.urandom(16).hex())
+        span = Span(trace, name, parent_id, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            self._mark_error(span, e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end = time.time_ns()
+            trace.spans.append(span)
+            self._finish(trace, span)
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+
+        span = Span(parent.trace, name, parent.span_id, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            self._mark_error(span, e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end = time.time_ns()
+            parent.trace.spans.append(span)
+
+    def traced(self, name: Optional[str] = None):
+        def decorator(func):
+            span_name = name or func.__name__
+
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def set_attribute(self, key: str, value: Any):
+        span = _current_span.get()
+        if span is not None:
+            span.attributes[key] = value
+
+    def record_exception(self, e: BaseException):
+        span = _current_span.get()
+        if span is not None:
+            self._mark_error(span, e)
+
+    def inject(self, headers: Optional[Dict[str, str]] = None) -> Optional[Dict[str, str]]:
+        span = _current_span.get()
+        if span is None:
+            return headers
+        headers = dict(headers or {})
+        headers[TRACEPARENT] = f"00-{span.trace.trace_id}-{span.span_id}-01"
+        return headers
+
+    def _mark_error(self, span: Span, e: BaseException):
+        span.error = f"{type(e).__name__}: {e}"
+        span.trace.error = True
+
+    def _finish(self, trace: Trace, root: Span):
+        if (
+            root.duration_ms >= self.slow_threshold_ms
+            or trace.error
+            or random.random() < self.sample_rate
+        ):
+            self._export(trace)
+
+    def _export(self, trace: Trace):
+        spans = []
+        for span in trace.spans:
+            otlp_span = {
+                "traceId": trace.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start),
+                "endTimeUnixNano": str(span.end),
+                "attributes": [
+                    {"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()
+                ],
+                "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+            }
+            if span.parent_id:
+                otlp_span["parentSpanId"] = span.parent_id
+            spans.append(otlp_span)
+
+        logger.info(json.dumps({
+            "resourceSpans": [{
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": self.service_name}}
+                    ]
+                },
+                "scopeSpans": [{
+                    "scope": {"name": "kopilot.telegram"},
+                    "spans": spans,
+                }],
+            }]
+        }))
+
+tracer = Tracer()
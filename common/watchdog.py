@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from typing import Optional, Dict, Any
+
+from common.config import WATCHDOG_CFG
+from common.metrics import metrics
+
+from anyio import to_thread
+
+logger = logging.getLogger()
+
+
+class LoopWatchdog:
+    def __init__(self):
+        self.interval = WATCHDOG_CFG.get("interval", 0.1)
+        self.slow_callback_ms = WATCHDOG_CFG.get("slow_callback_ms", 100)
+
+        self.slow_callbacks = deque(maxlen=WATCHDOG_CFG.get("history", 20))
+        self._heartbeat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._monitor: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._monitor = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._monitor.start()
+        logger.info("Event loop watchdog started")
+
+        try:
+            while True:
+                scheduled = loop.time()
+                await asyncio.sleep(self.interval)
+                lag_ms = (loop.time() - scheduled - self.interval) * 1000
+                self._heartbeat = time.monotonic()
+
+                metrics.observe("loop.lag_ms", lag_ms)
+                metrics.gauge("loop.tasks", len(asyncio.all_tasks(loop)))
+                self._sample_thread_pool()
+        finally:
+            self._stopped.set()
+
+    def _sample_thread_pool(self):
+        limiter = to_thread.current_default_thread_limiter()
+        stats = limiter.statistics()
+        metrics.gauge("to_thread.borrowed", stats.borrowed_tokens)
+        metrics.gauge("to_thread.total", stats.total_tokens)
+        metrics.gauge("to_thread.waiting", stats.tasks_waiting)
+        if stats.tasks_waiting:
+            metrics.incr("to_thread.saturated")
+
+    def _watch(self):
+        # Runs in its own thread: notices when the loop stops ticking and
+        # captures what the loop thread is doing while it is still stuck.
+        threshold = self.interval + self.slow_callback_ms / 1000
+        reported_for = None
+        poll = min(self.interval, self.slow_callback_ms / 1000) / 2
+
+        while not self._stopped.wait(poll):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat
+            if stalled < threshold:
+                continue
+            if reported_for == heartbeat:
+                self.slow_callbacks[-1]["held_ms"] = round((stalled - self.interval) * 1000, 1)
+                continue
+
+            reported_for = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            self.slow_callbacks.append({
+                "detected_at": datetime.now().isoformat(),
+                "held_ms": round((stalled - self.interval) * 1000, 1),
+                "stack": stack,
+            })
+            metrics.incr("loop.slow_callbacks")
+            logger.warning(f"Event loop blocked for over {self.slow_callback_ms} ms:\n{stack}")
+
+    def report(self) -> Dict[str, Any]:
+        snapshot = metrics.snapshot()
+        return {
+            "lag_ms": snapshot["timings"].get("loop.lag_ms", {}),
+            "tasks": snapshot["gauges"].get("loop.tasks"),
+            "thread_pool": {
+                "borrowed": snapshot["gauges"].get("to_thread.borrowed"),
+                "total": snapshot["gauges"].get("to_thread.total"),
+                "waiting": snapshot["gauges"].get("to_thread.waiting"),
+                "saturated": snapshot["counters"].get("to_thread.saturated", 0),
+            },
+            "slow_callbacks": list(self.slow_callbacks),
+        }
+
+watchdog = LoopWatchdog()
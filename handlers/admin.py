@@ -0,0 +1,17 @@
+import logging
+
+from common.nats_server import nc
+from common.profiler import profiler
+
+logger = logging.getLogger()
+
+
+@nc.reply("telegram.admin.profile")
+async def admin_profile(data: dict):
+
+    duration = data.get("duration", 10)
+    interval_ms = data.get("interval_ms")
+    mode = data.get("mode", "cpu")
+
+    logger.info(f"Starting {mode} profile for {duration}s")
+    return await profiler.profile(duration, interval_ms, mode)
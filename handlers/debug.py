@@ -0,0 +1,32 @@
+import logging
+
+from common.nats_server import nc
+from common.metrics import metrics
+from common.watchdog import watchdog
+from common.mysql import MySQL as db
+
+logger = logging.getLogger()
+
+
+@nc.reply("telegram.debug.loop")
+async def debug_loop(data: dict):
+    return watchdog.report()
+
+
+@nc.reply("telegram.debug.metrics")
+async def debug_metrics(data: dict):
+    return metrics.snapshot()
+
+
+@nc.reply("telegram.debug.mysql")
+async def debug_mysql(data: dict):
+    return db.stats()
+
+
+@nc.reply("telegram.debug.nats")
+async def debug_nats(data: dict):
+    return {
+        "in_flight": nc.in_flight,
+        "draining": nc.draining,
+        "compression": nc.compression.stats(),
+    }
@@ -0,0 +1,25 @@
+import logging
+from datetime import datetime
+
+from common.nats_server import nc
+from common.export import exports
+
+logger = logging.getLogger()
+
+
+@nc.reply("telegram.export")
+async def export(data: dict):
+
+    return exports.start(
+        int(data['chat_id']),
+        data.get('tables'),
+        data.get('inbox'),
+        datetime.fromisoformat(data['since']) if data.get('since') else None,
+        datetime.fromisoformat(data['until']) if data.get('until') else None,
+    )
+
+
+@nc.reply("telegram.export.status")
+async def export_status(data: dict):
+
+    return {"export": exports.status(data['export_id'])}
@@ -0,0 +1,21 @@
+import logging
+
+from common.nats_server import nc
+from common.outbound import outbound
+
+logger = logging.getLogger()
+
+
+@nc.reply("telegram.send")
+async def send(data: dict):
+
+    return await outbound.send(int(data['chat_id']), data.get('text'), data.get('options'))
+
+
+@nc.reply("telegram.broadcast")
+async def broadcast(data: dict):
+
+    chat_ids = data.get('chat_ids') or []
+    if not chat_ids:
+        raise ValueError("chat_ids is required")
+    return await outbound.broadcast(chat_ids, data.get('text'), data.get('options'), data.get('broadcast_id'))
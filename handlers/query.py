@@ -0,0 +1,180 @@
+import logging
+from datetime import date, datetime, timedelta
+
+from common.nats_server import nc
+from common.mysql import MySQL as db
+from common.cache import cache
+from common.config import CACHE_CFG
+
+logger = logging.getLogger()
+
+MAX_PAGE_SIZE = 500
+
+
+def _jsonable(row: dict) -> dict:
+    return {
+        key: value.isoformat() if isinstance(value, (datetime, date)) else value
+        for key, value in row.items()
+    }
+
+
+async def get_users(user_ids) -> dict:
+    users = {}
+    missing = []
+    for user_id in user_ids:
+        user = cache.get(("user", user_id))
+        if user is None:
+            missing.append(user_id)
+        else:
+            users[user_id] = user
+
+    if missing:
+        # A replica may still have the row from before a recent write, and a
+        # fill that started before the write must not land after it.
+        generation = cache.generation()
+        placeholders = ", ".join(["%s"] * len(missing))
+        rows = await db.aexecute_query(
+            f"""
+            SELECT `user_id`, `first_name`, `last_name`, `username`, `is_bot`, `photo`
+            FROM `kopilot_telegram`.`user`
+            WHERE `user_id` IN ({placeholders});
+            """,
+            tuple(missing),
+            primary=cache.settling(*[("user", user_id) for user_id in missing])
+        )
+        for row in rows:
+            user = _jsonable(row)
+            cache.set(("user", row['user_id']), user, since=generation)
+            users[row['user_id']] = user
+
+    return users
+
+
+@nc.reply("telegram.query.chat")
+async def query_chat(data: dict):
+
+    chat_id = int(data['chat_id'])
+
+    chat = cache.get(("chat", chat_id))
+    if chat is None:
+        generation = cache.generation()
+        row = await db.aexecute_query(
+            """
+            SELECT `chat_id`, `title`, `photo`, `accent_color`, `invite_link`, `is_deleted`, `date_created`
+            FROM `kopilot_telegram`.`chat`
+            WHERE `chat_id` = %s LIMIT 1;
+            """,
+            (chat_id,),
+            fetch_one=True,
+            primary=cache.settling(("chat", chat_id))
+        )
+        if not row:
+            return {"chat": None}
+        chat = _jsonable(row)
+        cache.set(("chat", chat_id), chat, since=generation)
+
+    return {"chat": chat}
+
+
+@nc.reply("telegram.query.chatmembers")
+async def query_chatmembers(data: dict):
+
+    chat_id = int(data['chat_id'])
+    after_id = int(data.get('after_id') or 0)
+    limit = max(1, min(int(data.get('limit') or 100), MAX_PAGE_SIZE))
+    status = data.get('status')
+
+    key = ("chatmembers", chat_id, status, after_id, limit)
+    page = cache.get(key)
+    if page is None:
+        query = f"""
+        SELECT `id`, `user_id`, `status`, `custom_title`, `joined_at`, `left_at`, `added_by`, `removed_by`
+        FROM `kopilot_telegram`.`chatmember`
+        WHERE `chat_id` = %s AND `id` > %s {"AND `status` = %s" if status else ""}
+        ORDER BY `id`
+        LIMIT %s;
+        """
+        params = (chat_id, after_id, status, limit) if status else (chat_id, after_id, limit)
+        generation = cache.generation()
+        rows = await db.aexecute_query(query, params, primary=cache.settling(("chatmembers", chat_id)))
+        page = {
+            "rows": [_jsonable(row) for row in rows],
+            "next_after_id": rows[-1]['id'] if len(rows) == limit else None,
+        }
+        cache.set(key, page, tags=[("chatmembers", chat_id)], weight=len(rows) + 1, since=generation)
+
+    users = await get_users([row['user_id'] for row in page["rows"]])
+    return {
+        "members": [
+            {**row, "user": users.get(row['user_id'])} for row in page["rows"]
+        ],
+        "next_after_id": page["next_after_id"],
+    }
+
+
+@nc.reply("telegram.query.chat_stats")
+async def query_chat_stats(data: dict):
+
+    chat_id = int(data['chat_id'])
+    to_day = date.fromisoformat(data['to']) if data.get('to') else date.today()
+    from_day = date.fromisoformat(data['from']) if data.get('from') else to_day - timedelta(days=29)
+    top = max(0, min(int(data.get('top', 10)), 100))
+
+    key = ("chat_stats", chat_id, from_day, to_day, top)
+    stats = cache.get(key)
+    if stats is not None:
+        return stats
+
+    generation = cache.generation()
+    primary = cache.settling(("chat_stats", chat_id))
+    days = await db.aexecute_query(
+        """
+        SELECT `day`, `messages`, `replies`, `reactions`
+        FROM `kopilot_telegram`.`chat_activity_daily`
+        WHERE `chat_id` = %s AND `day` BETWEEN %s AND %s
+        ORDER BY `day`;
+        """,
+        (chat_id, from_day, to_day),
+        primary=primary
+    )
+    types = await db.aexecute_query(
+        """
+        SELECT `type`, SUM(`messages`) AS `messages`
+        FROM `kopilot_telegram`.`chat_type_activity_daily`
+        WHERE `chat_id` = %s AND `day` BETWEEN %s AND %s
+        GROUP BY `type`;
+        """,
+        (chat_id, from_day, to_day),
+        primary=primary
+    )
+    members = []
+    if top:
+        members = await db.aexecute_query(
+            """
+            SELECT `user_id`, SUM(`messages`) AS `messages`, SUM(`replies`) AS `replies`, SUM(`reactions`) AS `reactions`
+            FROM `kopilot_telegram`.`chatmember_activity_daily`
+            WHERE `chat_id` = %s AND `day` BETWEEN %s AND %s
+            GROUP BY `user_id`
+            ORDER BY `messages` DESC
+            LIMIT %s;
+            """,
+            (chat_id, from_day, to_day, top),
+            primary=primary
+        )
+
+    stats = {
+        "chat_id": chat_id,
+        "from": from_day.isoformat(),
+        "to": to_day.isoformat(),
+        "totals": {
+            field: sum(int(row[field]) for row in days)
+            for field in ("messages", "replies", "reactions")
+        },
+        "days": [_jsonable(row) for row in days],
+        "types": {row['type']: int(row['messages']) for row in types},
+        "top_members": [
+            {key: int(value) for key, value in row.items()} for row in members
+        ],
+    }
+    cache.set(key, stats, tags=[("chat_stats", chat_id)], ttl=CACHE_CFG.get("stats_ttl", 60), since=generation)
+    return stats
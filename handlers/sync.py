@@ -5,16 +5,45 @@ from collections import Counter
 import io
 
 from common.nats_server import nc
+from common.lanes import BACKGROUND
 from common.mysql import MySQL as db
 from common.telegram import TelegramBot as tg
-from common.config import MEDIA_PATH, TELEGRAM_TOKEN
+from common.tracing import tracer
+from common.cache import cache
+from common.tasks import map_bounded
+from common.config import MEDIA_PATH, TELEGRAM_TOKEN, TELEGRAM_API_URL
+from common.startup import lazy_import
 
-import httpx
 from anyio import Path, open_file, to_thread
-from PIL import Image
+
+httpx = lazy_import("httpx")
+# Only chat photos need it.
+Image = lazy_import("PIL.Image")
 
 logger = logging.getLogger()
 
+SELECT_USER = db.prepare(
+    "user.select", "SELECT * FROM `kopilot_telegram`.`user` WHERE user_id = %s LIMIT 1;"
+)
+SELECT_CHAT = db.prepare(
+    "chat.select", "SELECT * FROM `kopilot_telegram`.`chat` WHERE chat_id = %s LIMIT 1;"
+)
+SELECT_CHATMEMBER = db.prepare("chatmember.select", """
+SELECT * FROM `kopilot_telegram`.`chatmember`
+WHERE user_id = %s AND chat_id = %s LIMIT 1;
+""")
+UPDATE_CHATMEMBER = db.prepare("chatmember.update", """
+UPDATE `kopilot_telegram`.`chatmember`
+SET
+    `status` = %s, 
+    `custom_title` = %s, 
+    `joined_at` = %s, 
+    `left_at` = %s,
+    `added_by` = %s,
+    `removed_by` = %s
+WHERE `user_id` = %s AND `chat_id` = %s;
+""")
+
 def extract_dominant_color(image_bytes):
     try:
         img = Image.open(io.BytesIO(image_bytes))
@@ -30,6 +59,7 @@ def extract_dominant_color(image_bytes):
         logger.error(f"Failed to extract dominant color: {str(e)}")
         return "#000000"
 
+@tracer.traced()
 async def download_user_photo(user, file_id):
     file_info = await tg.call("getFile", file_id=file_id)
     if not file_info:
@@ -41,32 +71,32 @@ async def download_user_photo(user, file_id):
         logger.error("No file path in file info")
         return
     
-    file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
+    file_url = f"{TELEGRAM_API_URL}/file/bot{TELEGRAM_TOKEN}/{file_path}"
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            file_response = await client.get(file_url)
-            file_response.raise_for_status()
-
-            image_bytes = file_response.content
-
-            filename = f"{user['user_id']}.jpg"
-            file_path_local = Path(MEDIA_PATH, 'user', filename)
-
-            await file_path_local.write_bytes(image_bytes)
-
-            query = """
-            UPDATE `kopilot_telegram`.`user`
-            SET 
-                `photo` = %s,
-                `photo_file_id` = %s
-            WHERE `user_id` = %s;
-            """
-            relative_path = f"user/{filename}"
-            params = (relative_path, file_id, user['user_id'])
-            await db.aexecute_update(query, params)
-            
-            logger.info(f"Downloaded profile photo for user {user['user_id']} to {file_path_local}")
+        file_response = await tg.client().get(file_url, timeout=30.0)
+        file_response.raise_for_status()
+
+        image_bytes = file_response.content
+
+        filename = f"{user['user_id']}.jpg"
+        file_path_local = Path(MEDIA_PATH, 'user', filename)
+
+        await file_path_local.write_bytes(image_bytes)
+
+        query = """
+        UPDATE `kopilot_telegram`.`user`
+        SET 
+            `photo` = %s,
+            `photo_file_id` = %s
+        WHERE `user_id` = %s;
+        """
+        relative_path = f"user/{filename}"
+        params = (relative_path, file_id, user['user_id'])
+        await db.aexecute_update(query, params)
+        cache.patch(("user", user['user_id']), photo=relative_path)
+        
+        logger.info(f"Downloaded profile photo for user {user['user_id']} to {file_path_local}")
 
     except httpx.HTTPStatusError as e:
         logger.error(f"HTTP error downloading profile photo for user {user['user_id']}: {e.response.status_code}")
@@ -75,6 +105,7 @@ async def download_user_photo(user, file_id):
     except Exception as e:
         logger.error(f"Failed to download profile photo for user {user['user_id']}: {str(e)}")
         
+@tracer.traced()
 async def download_chat_photo(chat, file_id):
     file_info = await tg.call("getFile", file_id=file_id)
     if not file_info:
@@ -86,34 +117,34 @@ async def download_chat_photo(chat, file_id):
         logger.error("No file path in file info")
         return
     
-    file_url = f"https://api.telegram.org/file/bot{TELEGRAM_TOKEN}/{file_path}"
+    file_url = f"{TELEGRAM_API_URL}/file/bot{TELEGRAM_TOKEN}/{file_path}"
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            file_response = await client.get(file_url)
-            file_response.raise_for_status()
-
-            image_bytes = file_response.content
-            accent_color = await to_thread.run_sync(extract_dominant_color, image_bytes)
-
-            filename = f"{chat['chat_id']}.jpg"
-            file_path_local = Path(MEDIA_PATH, 'chat', filename)
-            
-            await file_path_local.write_bytes(image_bytes)
-
-            query = """
-            UPDATE `kopilot_telegram`.`chat`
-            SET 
-                `photo` = %s,
-                `photo_file_id` = %s,
-                `accent_color` = %s,
-            WHERE `chat_id` = %s;
-            """
-            relative_path = f"chat/{filename}"
-            params = (relative_path, file_id, accent_color, chat['chat_id'])
-            await db.aexecute_update(query, params)
-            
-            logger.info(f"Downloaded chat photo for chat {chat['chat_id']} to {file_path_local}")
+        file_response = await tg.client().get(file_url, timeout=30.0)
+        file_response.raise_for_status()
+
+        image_bytes = file_response.content
+        accent_color = await to_thread.run_sync(extract_dominant_color, image_bytes)
+
+        filename = f"{chat['chat_id']}.jpg"
+        file_path_local = Path(MEDIA_PATH, 'chat', filename)
+        
+        await file_path_local.write_bytes(image_bytes)
+
+        query = """
+        UPDATE `kopilot_telegram`.`chat`
+        SET 
+            `photo` = %s,
+            `photo_file_id` = %s,
+            `accent_color` = %s
+        WHERE `chat_id` = %s;
+        """
+        relative_path = f"chat/{filename}"
+        params = (relative_path, file_id, accent_color, chat['chat_id'])
+        await db.aexecute_update(query, params)
+        cache.invalidate(("chat", chat['chat_id']))
+        
+        logger.info(f"Downloaded chat photo for chat {chat['chat_id']} to {file_path_local}")
 
     except httpx.HTTPStatusError as e:
         logger.error(f"HTTP error downloading chat photo for chat {chat['chat_id']}: {e.response.status_code}")
@@ -123,15 +154,14 @@ async def download_chat_photo(chat, file_id):
         logger.error(f"Failed to download chat photo for chat {chat['chat_id']}: {str(e)}")
 
 
-@nc.sub("telegram.sync.user")
+@nc.sub("telegram.sync.user", lane=BACKGROUND)
 async def sync_user(data: dict):
 
     user_id = data['user_id']
-    user = await db.aexecute_query(
-        "SELECT * FROM `kopilot_telegram`.`user` WHERE user_id = %s LIMIT 1;",
-        (user_id,),
-        fetch_one=True
-    )
+    query = SELECT_USER
+    # Primary: photo_file_id decides whether the photo is written again, and
+    # sync events follow the insert closely.
+    user = await db.aexecute_query(query, (user_id,), fetch_one=True, primary=True)
     if not user:
         logger.warning(f"Attempted sync on non existing user: {user_id}.")
         return
@@ -145,15 +175,13 @@ async def sync_user(data: dict):
             await download_user_photo(user, file_id)
 
 
-@nc.sub("telegram.sync.chat")
+@nc.sub("telegram.sync.chat", lane=BACKGROUND)
 async def sync_chat(data: dict):
 
     chat_id = data['chat_id']
-    chat = await db.aexecute_query(
-        "SELECT * FROM `kopilot_telegram`.`chat` WHERE chat_id = %s LIMIT 1;",
-        (chat_id,),
-        fetch_one=True
-    )
+    query = SELECT_CHAT
+    # Primary: the row's values are written back below.
+    chat = await db.aexecute_query(query, (chat_id,), fetch_one=True, primary=True)
     if not chat:
         logger.warning(f"Attempted sync on non existing chat: {chat_id}.")
         return
@@ -172,6 +200,7 @@ async def sync_chat(data: dict):
         """
         params = (title, invite_link, chat_id)
         updated = await db.aexecute_update(query, params)
+        cache.invalidate(("chat", chat_id))
 
         photo = chat_data.get("photo", {})
 
@@ -181,7 +210,7 @@ async def sync_chat(data: dict):
                 await download_chat_photo(chat, file_id)
     
 
-@nc.sub("telegram.sync.chatmember")
+@nc.sub("telegram.sync.chatmember", lane=BACKGROUND)
 async def sync_chatmember(data: dict):
     
     user_id = data['user_id']
@@ -189,20 +218,20 @@ async def sync_chatmember(data: dict):
     timestamp = datetime.fromisoformat(data['timestamp'])
     performer = data.get("performer")
 
-    query = """
-    SELECT * FROM `kopilot_telegram`.`chatmember`
-    WHERE user_id = %s AND chat_id = %s LIMIT 1;
-    """
+    query = SELECT_CHATMEMBER
+    # Primary: the old status decides the join/leave transition written
+    # back below, so a lagging replica would lose or repeat one.
     chatmember = await db.aexecute_query(
         query,
         (user_id, chat_id),
-        fetch_one=True
+        fetch_one=True,
+        primary=True
     )
     if not chatmember:
         logger.warning(f"Attempted sync on non existing chatmember: {user_id}, {chat_id}")
         return
     
-    chatmember_data = await tg.call("getChatMember", user_id=user_id, chat_id=chat_id)
+    chatmember_data = await tg.call("getChatMember", user_id=user_id, chat_id=chat_id) or {}
     status = chatmember_data.get("status", chatmember['status'])
     custom_title = chatmember_data.get("custom_title", chatmember['custom_title'])
     
@@ -220,23 +249,25 @@ async def sync_chatmember(data: dict):
         left_at = timestamp
         removed_by = performer
     
-    query = """
-    UPDATE `kopilot_telegram`.`chatmember`
-    SET
-        `status` = %s, 
-        `custom_title` = %s, 
-        `joined_at` = %s, 
-        `left_at` = %s,
-        `added_by` = %s,
-        `removed_by` = %s
-    WHERE `user_id` = %s AND `chat_id` = %s;
-    """
     params = (
         status, custom_title, joined_at, left_at, 
         added_by, removed_by, user_id, chat_id
     )
 
     updated = await db.aexecute_update(
-        query,
+        UPDATE_CHATMEMBER,
         params
     )
+    cache.invalidate_tag(("chatmembers", chat_id))
+
+
+@nc.sub("telegram.sync.chatmembers", lane=BACKGROUND)
+async def sync_chatmembers(data: dict):
+
+    async def sync_one(user_id):
+        try:
+            await sync_chatmember({**data, 'user_id': user_id})
+        except Exception as e:
+            logger.error(f"Failed to sync chatmember {user_id}, {data['chat_id']}: {e}")
+
+    await map_bounded(sync_one, data['user_ids'])
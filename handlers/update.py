@@ -1,32 +1,139 @@
+import json
 import logging
+from contextvars import ContextVar
 from datetime import datetime
-from typing import Union
+from typing import Union, List, Optional, Set
 
 from common.nats_server import nc
-from common.mysql import MySQL as db
+from common.lanes import CRITICAL
+from common.mysql import MySQL as db, UNAVAILABLE_ERRORS
+from common.spool import spool
 from common.telegram import TelegramBot as tg
+from common.tracing import tracer
+from common.rollup import rollup
+from common.cache import cache
+from common.tasks import gather, map_bounded
+from common.models import (
+    User, Chat, Message, MessageReactionUpdated, ChatMemberUpdated, Update, UpdateEvent,
+    decode_event, classify_message
+)
 
 logger = logging.getLogger()
 
-
-async def handle_chat(chat_data:dict) -> int:
+# Set by batch callers (replay) that already upserted these rows in bulk:
+# {("user", user_id), ("chat", chat_id), ...}
+known_rows: ContextVar[Optional[Set[tuple]]] = ContextVar("known_rows", default=None)
+
+# Hot statements, prepared once per pooled connection.
+UPSERT_CHAT = db.prepare("chat.upsert", """
+INSERT INTO `kopilot_telegram`.`chat` (
+    `chat_id`, `title`
+) VALUES (%s, %s)
+ON DUPLICATE KEY UPDATE
+    `title` = IF(VALUES(`title`) != '', VALUES(`title`), `title`);
+""")
+
+UPSERT_USER = db.prepare("user.upsert", """
+INSERT INTO `kopilot_telegram`.`user` (
+    `user_id`,
+    `first_name`,
+    `last_name`,
+    `username`,
+    `is_bot`
+)
+VALUES (%s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE 
+    `first_name` = IF(VALUES(`first_name`) != '', VALUES(`first_name`), `first_name`),
+    `last_name` = IF(VALUES(`last_name`) != '', VALUES(`last_name`), `last_name`),
+    `username` = VALUES(`username`),
+    `is_bot` = VALUES(`is_bot`);
+""")
+
+SELECT_CHATMEMBER_ID = db.prepare(
+    "chatmember.select_id",
+    "SELECT `id` FROM `kopilot_telegram`.`chatmember` WHERE `user_id` = %s AND `chat_id` = %s LIMIT 1;"
+)
+
+INSERT_CHATMEMBER = db.prepare("chatmember.insert", """
+INSERT INTO `kopilot_telegram`.`chatmember` (
+    `user_id`, `chat_id`, `status`, `custom_title`, `joined_at`, `left_at`
+) VALUES (
+    %s, %s, %s, %s, %s, %s
+)
+ON DUPLICATE KEY UPDATE
+    `id` = LAST_INSERT_ID(`id`);
+""")
+
+SELECT_MESSAGE_ID = db.prepare("message.select_id", """
+SELECT `id` FROM `kopilot_telegram`.`message`
+WHERE `chat_id` = %s AND `message_id` = %s LIMIT 1;
+""")
+
+INSERT_MESSAGE = db.prepare("message.insert", """
+INSERT INTO `kopilot_telegram`.`message` (
+    `message_id`,
+    `chatmember_id`,
+    `user_id`,
+    `chat_id`,
+    `date`,
+    `reply_to_message_id`,
+    `type`,
+    `is_external_forward`
+) VALUES (
+    %s, %s, %s, %s, %s, %s, %s, %s
+);
+""")
+
+SELECT_REACTION_ID = db.prepare("reaction.select_id", """
+SELECT `id` FROM `kopilot_telegram`.`reaction`
+WHERE `chat_id` = %s AND `message_id` = %s LIMIT 1;
+""")
+
+INSERT_REACTION = db.prepare("reaction.insert", """
+INSERT INTO `kopilot_telegram`.`reaction` (
+    `message_id`,
+    `chatmember_id`,
+    `user_id`,
+    `chat_id`,
+    `date`,
+    `is_deleted`
+) VALUES (
+    %s, %s, %s, %s, %s, %s
+);
+""")
+
+
+def patch_cached_user(user: User):
+    # Mirrors the ON DUPLICATE KEY UPDATE rules of the user upserts.
+    fields = {
+        "username": user.username,
+        "is_bot": user.is_bot,
+    }
+    if user.first_name:
+        fields["first_name"] = user.first_name
+    if user.last_name:
+        fields["last_name"] = user.last_name
+    cache.patch(("user", user.id), **fields)
+
+
+@tracer.traced()
+async def handle_chat(chat: Chat) -> int:
     
-    chat_id = int(chat_data["id"])
-    title = chat_data.get("title", '')
+    chat_id = chat.id
+    title = chat.title
+
+    known = known_rows.get()
+    if known is not None and ("chat", chat_id) in known:
+        return chat_id
 
-    query = """
-    INSERT INTO `kopilot_telegram`.`chat` (
-        `chat_id`, `title`
-    ) VALUES (%s, %s)
-    ON DUPLICATE KEY UPDATE
-        `title` = IF(VALUES(`title`) != '', VALUES(`title`), `title`);
-    """
     last_id = await db.aexecute_insert(
-        query,
+        UPSERT_CHAT,
         (chat_id, title)
     )
+    if title:
+        cache.patch(("chat", chat_id), title=title)
     if not last_id:
-        logger.info(f"Updated chat {chat_id} in database.")
+        logger.debug(f"Updated chat {chat_id} in database.")
     else:
         logger.info(f"Inserted chat {chat_id} in database.")
         await nc.pub(
@@ -37,15 +144,55 @@ async def handle_chat(chat_data:dict) -> int:
     return chat_id
 
 
-async def handle_user(user_data: dict) -> int:
+@tracer.traced()
+async def handle_user(user: User) -> int:
 
-    user_id = int(user_data["id"])
-    first_name = user_data.get("first_name", '')
-    last_name = user_data.get("last_name", '')
-    username = user_data.get("username")
-    is_bot = user_data.get("is_bot", False)
+    user_id = user.id
+    first_name = user.first_name
+    last_name = user.last_name
+    username = user.username
+    is_bot = user.is_bot
 
-    query = """
+    known = known_rows.get()
+    if known is not None and ("user", user_id) in known:
+        return user_id
+
+    last_id = await db.aexecute_insert(
+        UPSERT_USER,
+        (user_id, first_name, last_name, username, is_bot)
+    )
+    patch_cached_user(user)
+    if not last_id:
+        logger.debug(f"Updated user {user_id} in database.")
+    else:
+        logger.info(f"Inserted user {user_id} in database.")
+        await nc.pub(
+            "telegram.sync.user",
+            {'user_id': user_id}
+        )
+
+    return user_id
+
+@tracer.traced()
+async def handle_users(users_data: List[User]) -> List[int]:
+
+    users = {user.id: user for user in users_data if user}
+    if not users:
+        return []
+
+    placeholders = ", ".join(["%s"] * len(users))
+    existing = await db.aexecute_query(
+        f"SELECT `user_id` FROM `kopilot_telegram`.`user` WHERE `user_id` IN ({placeholders});",
+        tuple(users),
+        primary=True
+    )
+    existing = {row['user_id'] for row in existing}
+
+    params = []
+    for user_id, user in users.items():
+        params.extend((user_id, user.first_name, user.last_name, user.username, user.is_bot))
+
+    query = f"""
     INSERT INTO `kopilot_telegram`.`user` (
         `user_id`,
         `first_name`,
@@ -53,43 +200,85 @@ async def handle_user(user_data: dict) -> int:
         `username`,
         `is_bot`
     )
-    VALUES (%s, %s, %s, %s, %s)
+    VALUES {", ".join(["(%s, %s, %s, %s, %s)"] * len(users))}
     ON DUPLICATE KEY UPDATE 
         `first_name` = IF(VALUES(`first_name`) != '', VALUES(`first_name`), `first_name`),
         `last_name` = IF(VALUES(`last_name`) != '', VALUES(`last_name`), `last_name`),
         `username` = VALUES(`username`),
         `is_bot` = VALUES(`is_bot`);
     """
-    last_id = await db.aexecute_insert(
-        query,
-        (user_id, first_name, last_name, username, is_bot)
-    )
-    if not last_id:
-        logger.info(f"Updated user {user_id} in database.")
-    else:
-        logger.info(f"Inserted user {user_id} in database.")
+    await db.aexecute_update(query, tuple(params))
+    for user in users.values():
+        patch_cached_user(user)
+    logger.info(f"Upserted {len(users)} users ({len(users) - len(existing)} new) in database.")
+
+    for user_id in users.keys() - existing:
         await nc.pub(
             "telegram.sync.user",
             {'user_id': user_id}
         )
 
-    return user_id
+    return list(users)
+
+
+@tracer.traced()
+async def handle_chats(chats_data: List[Chat]) -> List[int]:
 
+    chats = {chat.id: chat for chat in chats_data if chat}
+    if not chats:
+        return []
+
+    placeholders = ", ".join(["%s"] * len(chats))
+    existing = await db.aexecute_query(
+        f"SELECT `chat_id` FROM `kopilot_telegram`.`chat` WHERE `chat_id` IN ({placeholders});",
+        tuple(chats),
+        primary=True
+    )
+    existing = {row['chat_id'] for row in existing}
+
+    params = []
+    for chat_id, chat in chats.items():
+        params.extend((chat_id, chat.title))
+
+    query = f"""
+    INSERT INTO `kopilot_telegram`.`chat` (
+        `chat_id`, `title`
+    ) VALUES {", ".join(["(%s, %s)"] * len(chats))}
+    ON DUPLICATE KEY UPDATE
+        `title` = IF(VALUES(`title`) != '', VALUES(`title`), `title`);
+    """
+    await db.aexecute_update(query, tuple(params))
+    for chat_id, chat in chats.items():
+        if chat.title:
+            cache.patch(("chat", chat_id), title=chat.title)
+    logger.info(f"Upserted {len(chats)} chats ({len(chats) - len(existing)} new) in database.")
+
+    for chat_id in chats.keys() - existing:
+        await nc.pub(
+            "telegram.sync.chat",
+            {'chat_id': chat_id}
+        )
+
+    return list(chats)
+
+
+@tracer.traced()
 async def handle_chatmember(user_id: Union[int, str], chat_id: Union[int, str], event_time: datetime) -> int:
 
     user_id = int(user_id)
     chat_id = int(chat_id)
 
     chatmember = await db.aexecute_query(
-        "SELECT `id` FROM `kopilot_telegram`.`chatmember` WHERE `user_id` = %s AND `chat_id` = %s LIMIT 1;",
+        SELECT_CHATMEMBER_ID,
         (user_id, chat_id),
-        fetch_one = True
+        fetch_one = True,
+        primary = True
     )
 
     if chatmember:
         return chatmember['id']
     
-    chatmember_data = await tg.call("getChatMember", user_id=user_id, chat_id=chat_id)
+    chatmember_data = await tg.call("getChatMember", user_id=user_id, chat_id=chat_id) or {}
     status = chatmember_data.get("status", "member")
     custom_title = chatmember_data.get("custom_title")
 
@@ -97,39 +286,102 @@ async def handle_chatmember(user_id: Union[int, str], chat_id: Union[int, str],
     if status not in ["member", "administrator", "creator"]:
         left_at = event_time
 
-    query = """
-    INSERT INTO `kopilot_telegram`.`chatmember` (
-        `user_id`, `chat_id`, `status`, `custom_title`, `joined_at`, `left_at`
-    ) VALUES (
-        %s, %s, %s, %s, %s, %s
-    );
-    """
-
     chatmember_id = await db.aexecute_insert(
-        query,
+        INSERT_CHATMEMBER,
         (user_id, chat_id, status, custom_title, event_time, left_at)
     )
+    cache.invalidate_tag(("chatmembers", chat_id))
 
     return chatmember_id
 
 
-async def handle_message(message_data: dict):
+@tracer.traced()
+async def handle_chatmembers(users_data: List[User], chat_id: int, event_time: datetime) -> List[int]:
+    """Bulk handle_user + handle_chatmember for a join wave: one upsert for
+    the users, one lookup for existing members, the missing members' status
+    fetched concurrently (tg.call paces them) and one batched insert."""
+
+    user_ids = await handle_users(users_data)
+    if not user_ids:
+        return []
+
+    placeholders = ", ".join(["%s"] * len(user_ids))
+    existing = await db.aexecute_query(
+        f"""
+        SELECT `user_id` FROM `kopilot_telegram`.`chatmember`
+        WHERE `chat_id` = %s AND `user_id` IN ({placeholders});
+        """,
+        (chat_id, *user_ids),
+        primary = True
+    )
+    existing = {row['user_id'] for row in existing}
+    missing = [user_id for user_id in user_ids if user_id not in existing]
 
-    message_id = message_data.get("message_id")
-    user_data = message_data.get("from", {})
-    if not user_data:
-        return
+    if missing:
+        members = await map_bounded(
+            lambda user_id: tg.call("getChatMember", user_id=user_id, chat_id=chat_id),
+            missing
+        )
+        params = []
+        for user_id, chatmember_data in zip(missing, members):
+            chatmember_data = chatmember_data or {}
+            status = chatmember_data.get("status", "member")
+            left_at = event_time if status not in ["member", "administrator", "creator"] else None
+            params.append((
+                user_id, chat_id, status, chatmember_data.get("custom_title"), event_time, left_at
+            ))
+        await db.aexecute_many(INSERT_CHATMEMBER, params)
+        cache.invalidate_tag(("chatmembers", chat_id))
+    logger.info(f"Resolved {len(user_ids)} chat members of {chat_id} ({len(missing)} new).")
+
+    return user_ids
+
+
+@tracer.traced()
+async def handle_member_change(user_data: User, chat_id: int, event_time: datetime):
+    # A member joined or left through a service message: make sure the
+    # rows exist, then let sync_chatmember fetch the actual status.
+    user_id = await handle_user(user_data)
+    await handle_chatmember(user_id, chat_id, event_time)
+    await nc.pub(
+        "telegram.sync.chatmember",
+        {
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'timestamp': event_time.isoformat()
+        }
+    )
 
-    chat_data = message_data.get("chat", {})
 
-    message_timestamp = message_data.get("date")
-    message_date = datetime.fromtimestamp(message_timestamp)
+@tracer.traced()
+async def handle_join_wave(users_data: List[User], chat_id: int, event_time: datetime):
+    user_ids = await handle_chatmembers(users_data, chat_id, event_time)
+    if user_ids:
+        await nc.pub(
+            "telegram.sync.chatmembers",
+            {
+                'user_ids': user_ids,
+                'chat_id': chat_id,
+                'timestamp': event_time.isoformat()
+            }
+        )
 
-    user_id = await handle_user(user_data)
 
-    chat_type = chat_data.get('type')
+@tracer.traced()
+async def handle_message(message: Message):
+
+    message_id = message.message_id
+    user_data = message.from_
+    if not user_data:
+        return
+
+    chat_data = message.chat
+    message_date = datetime.fromtimestamp(message.date)
+
+    chat_type = chat_data.type
     if chat_type == "private":
-        text = message_data.get('text')
+        user_id = await handle_user(user_data)
+        text = message.text
         if text:
             logger.info("Received KoTube query")
             await nc.pub(
@@ -142,65 +394,40 @@ async def handle_message(message_data: dict):
             )
         
     elif chat_type in ('group', 'supergroup'):
-        chat_id = await handle_chat(chat_data)
-        chatmember_id = await handle_chatmember(user_id, chat_id, message_date)
-    
-        query = """
-        SELECT `id` FROM `kopilot_telegram`.`message`
-        WHERE `chat_id` = %s AND `message_id` = %s LIMIT 1;
-        """
-        message_exists = await db.aexecute_query(
-            query,
-            (chat_id, message_id),
-            fetch_one = True
+        chat_id = chat_data.id
+        reply_to_message = message.reply_to_message
+
+        # Only need the ids, which are known up front: run together.
+        user_id, _, message_exists, reply_to_message_row = await gather(
+            handle_user(user_data),
+            handle_chat(chat_data),
+            db.aexecute_query(
+                SELECT_MESSAGE_ID,
+                (chat_id, message_id),
+                fetch_one = True,
+                primary = True
+            ),
+            # Primary: the reply's row id is stored with the message.
+            db.aexecute_query(
+                SELECT_MESSAGE_ID,
+                (chat_id, reply_to_message.message_id),
+                fetch_one = True,
+                primary = True
+            ) if reply_to_message else None,
         )
+        # Needs the user and chat rows in place.
+        chatmember_id = await handle_chatmember(user_id, chat_id, message_date)
+
         if message_exists:
             logger.info(f"Message {message_id} already exists.")
             return
 
-        message_type = "other"
-        if "text" in message_data: 
-            message_type = "text"
-        elif "audio" in message_data:
-            message_type = "audio"
-        elif "video" in message_data: 
-            message_type = "video"
-        elif "video_note" in message_data: 
-            message_type = "video_note"
-        elif "voice" in message_data: 
-            message_type = "voice"
-        elif "animation" in message_data: 
-            message_type = "animation"
-        elif "document" in message_data: 
-            message_type = "document"
-        elif "photo" in message_data: 
-            message_type = "photo"
-        elif "sticker" in message_data: 
-            message_type = "sticker"
-
-        is_external_forward = False
-        try:
-            forward_from_id = message_data.get("forward_from", {}).get("id", None)
-            if forward_from_id and int(forward_from_id) != int(user_id):
-                is_external_forward = True
-        except:
-            pass
+        message_type = classify_message(message)
+
+        forward_from = message.forward_from
+        is_external_forward = forward_from is not None and forward_from.id != user_id
         
-        reply_to_message_id = None
-        reply_to_message = message_data.get("reply_to_message")
-        if reply_to_message:
-            reply_to_message_message_id = reply_to_message.get("message_id")
-            query = """
-            SELECT `id` FROM `kopilot_telegram`.`message`
-            WHERE `chat_id` = %s AND `message_id` = %s LIMIT 1;
-            """
-            reply_to_message_id = await db.aexecute_query(
-                query,
-                (chat_id, reply_to_message_message_id),
-                fetch_one = True
-            )
-            if reply_to_message_id:
-                reply_to_message_id = reply_to_message_id['id']
+        reply_to_message_id = reply_to_message_row['id'] if reply_to_message_row else None
 
         params = (
             message_id,
@@ -212,128 +439,101 @@ async def handle_message(message_data: dict):
             message_type,
             is_external_forward
         )
-        query = """
-        INSERT INTO `kopilot_telegram`.`message` (
-            `message_id`,
-            `chatmember_id`,
-            `user_id`,
-            `chat_id`,
-            `date`,
-            `reply_to_message_id`,
-            `type`,
-            `is_external_forward`
-        ) VALUES (
-            %s, %s, %s, %s, %s, %s, %s, %s
-        );
-        """
         message_rowid = await db.aexecute_insert(
-            query,
+            INSERT_MESSAGE,
             params
         )
         logger.info(f"Inserted message {message_id} in database.")
+        rollup.add_message(chat_id, user_id, message_date, message_type, bool(reply_to_message_id))
 
+        follow_ups = []
         if not is_external_forward:
-            await nc.pub(
+            follow_ups.append(nc.pub(
                 "analytics.ledger",
                 {
                     'user_id': user_id,
                     'chat_id': chat_id,
-                    'timestamp': message_date,
+                    'timestamp': message_date.isoformat(),
                     'type': message_type
                 }
-            )
+            ))
             if reply_to_message_id:
-                await nc.pub(
+                follow_ups.append(nc.pub(
                     "analytics.ledger",
                     {
                         'user_id': user_id, 'chat_id': chat_id,
-                        'timestamp': message_date, 'type': 'reply'
+                        'timestamp': message_date.isoformat(), 'type': 'reply'
                     }
-                )
+                ))
 
-        new_chat_members = message_data.get('new_chat_members')
+        new_chat_members = message.new_chat_members
         if new_chat_members:
             logger.info(f"Processing {len(new_chat_members)} new chat members")
-            for new_chat_member in new_chat_members:
-                new_user_id = await handle_user(new_chat_member)
-                new_chatmember_id = await handle_chatmember(new_user_id, chat_id, message_date)
-                await nc.pub(
-                    "telegram.sync.chatmember",
-                    {
-                        'user_id': new_user_id,
-                        'chat_id': chat_id,
-                        'timestamp': message_date.isoformat()
-                    }
-                )
+            follow_ups.append(handle_join_wave(new_chat_members, chat_id, message_date))
 
-        left_chat_member = message_data.get('left_chat_member')
+        left_chat_member = message.left_chat_member
         if left_chat_member:
             logger.info(f"Processing left chat member")
-            left_user_id = await handle_user(left_chat_member)
-            left_chatmember_id = await handle_chatmember(left_user_id, chat_id, message_date)
-            await nc.pub(
-                "telegram.sync.chatmember",
-                {
-                    'user_id': left_user_id,
-                    'chat_id': chat_id,
-                    'timestamp': message_date.isoformat()
-                }
-            )
-
-        if any(
-            'new_chat_title' in message_data,
-            'new_chat_photo' in message_data,
-            'delete_chat_photo' in message_data
-        ):
-            await nc.pub(
+            follow_ups.append(handle_member_change(left_chat_member, chat_id, message_date))
+
+        if any((
+            message.new_chat_title is not None,
+            message.new_chat_photo is not None,
+            message.delete_chat_photo is not None
+        )):
+            follow_ups.append(nc.pub(
                 "telegram.sync.chat",
                 {'chat_id': chat_id}
-            )
+            ))
+
+        await gather(*follow_ups)
+
+    else:
+        await handle_user(user_data)
 
 
-async def handle_reaction(message_reaction: dict):
+@tracer.traced()
+async def handle_reaction(message_reaction: MessageReactionUpdated):
 
-    message_id = message_reaction.get("message_id")
-    user_data = message_reaction.get("user", {})
+    message_id = message_reaction.message_id
+    user_data = message_reaction.user
     if not user_data:
         return
 
-    chat_data = message_reaction.get("chat", {})
-
-    reaction_timestamp = message_reaction.get("date")
-    reaction_date = datetime.fromtimestamp(reaction_timestamp)
-
-    user_id = await handle_user(user_data)
+    chat_data = message_reaction.chat
+    reaction_date = datetime.fromtimestamp(message_reaction.date)
 
-    chat_type = chat_data.get('type')
+    chat_type = chat_data.type
     if chat_type in ('group', 'supergroup'):
-        chat_id = await handle_chat(chat_data)
-        chatmember_id = await handle_chatmember(user_id, chat_id, reaction_date)
-    
-        query = """
-        SELECT `id` FROM `kopilot_telegram`.`message`
-        WHERE `chat_id` = %s AND `message_id` = %s LIMIT 1;
-        """
-        message_row = await db.aexecute_query(
-            query,
-            (chat_id, message_id),
-            fetch_one = True
+        chat_id = chat_data.id
+        user_id, _, message_row = await gather(
+            handle_user(user_data),
+            handle_chat(chat_data),
+            # Primary: the reaction is stored against this row, or skipped
+            # without it.
+            db.aexecute_query(
+                SELECT_MESSAGE_ID,
+                (chat_id, message_id),
+                fetch_one = True,
+                primary = True
+            ),
+        )
+        chatmember_id, reaction_exists = await gather(
+            handle_chatmember(user_id, chat_id, reaction_date),
+            db.aexecute_query(
+                SELECT_REACTION_ID,
+                (chat_id, message_row['id']),
+                fetch_one = True,
+                primary = True
+            ) if message_row else None,
         )
+
         if not message_row:
             logger.info(f"Message {message_id} does not exist.")
             return
         
         message_rowid = message_row['id']
         
-        query = """
-        SELECT `id` FROM `kopilot_telegram`.`reaction`
-        WHERE `chat_id` = %s AND `message_id` = %s LIMIT 1;
-        """
-        reaction_exists = await db.aexecute_query(
-            query,
-            (chat_id, message_rowid),
-            fetch_one = True
-        )
         if reaction_exists:
             logger.info(f"Reaction already exists.")
             return
@@ -348,53 +548,53 @@ async def handle_reaction(message_reaction: dict):
             reaction_date,
             is_deleted
         )
-        query = """
-        INSERT INTO `kopilot_telegram`.`reaction` (
-            `message_id`,
-            `chatmember_id`,
-            `user_id`,
-            `chat_id`,
-            `date`,
-            `is_deleted`
-        ) VALUES (
-            %s, %s, %s, %s, %s, %s
-        );
-        """
         reaction_rowid = await db.aexecute_insert(
-            query,
+            INSERT_REACTION,
             params
         )
         logger.info(f"Inserted reaction in database.")
+        rollup.add_reaction(chat_id, user_id, reaction_date)
 
         await nc.pub(
             "analytics.ledger",
             {
                 'user_id': user_id,
                 'chat_id': chat_id,
-                'timestamp': reaction_date,
+                'timestamp': reaction_date.isoformat(),
                 'type': 'reaction'
             }
         )
 
+    else:
+        await handle_user(user_data)
+
+
+@tracer.traced()
+async def handle_chatmember_updated(chatmember_updated: ChatMemberUpdated):
+    user_data = chatmember_updated.from_
+    chat_data = chatmember_updated.chat
+    date = datetime.fromtimestamp(chatmember_updated.date)
+
+    new_chat_member_data = chatmember_updated.new_chat_member
+    new_chat_member_user_data = new_chat_member_data.user if new_chat_member_data else None
+    # Joining by link: the performer is the member. Upsert that row once.
+    same_user = new_chat_member_user_data is None or new_chat_member_user_data.id == user_data.id
+
+    chat_type = chat_data.type
+    is_group = chat_type in ('group', 'supergroup')
+    user_id, new_user_id, chat_id = await gather(
+        handle_user(user_data),
+        handle_user(new_chat_member_user_data) if not same_user else None,
+        handle_chat(chat_data) if is_group else None,
+    )
+    if same_user:
+        new_user_id = user_id
 
-async def handle_chatmember_updated(chatmember_updated: dict):
-    user_data = chatmember_updated.get("from", {})
-    chat_data = chatmember_updated.get("chat", {})
-
-    timestamp = chatmember_updated.get("date")
-    date = datetime.fromtimestamp(timestamp)
-
-    user_id = await handle_user(user_data)
-
-    new_chat_member_data = chatmember_updated.get("new_chat_member", {})
-    new_chat_member_user_data = new_chat_member_data.get("user", {})
-    new_user_id = await handle_user(new_chat_member_user_data)
-
-    chat_type = chat_data.get('type')
-    if chat_type in ('group', 'supergroup'):
-        chat_id = await handle_chat(chat_data)
-        chatmember_id = await handle_chatmember(user_id, chat_id, date)
-        new_chatmember_id = await handle_chatmember(new_user_id, chat_id, date)
+    if is_group:
+        chatmember_id, new_chatmember_id = await gather(
+            handle_chatmember(user_id, chat_id, date),
+            handle_chatmember(new_user_id, chat_id, date) if not same_user else None,
+        )
         await nc.pub(
             "telegram.sync.chatmember",
             {
@@ -406,44 +606,80 @@ async def handle_chatmember_updated(chatmember_updated: dict):
         )
 
 
-@nc.sub("telegram.update")
-async def update(data: dict):
-    
-    event_id = data.get("event_id")
-    update_data = data.get("update", {})
+async def process_update(update_data: Update, event_id=None):
 
+    # The parts of one update are independent of each other.
+    parts = []
+
+    if update_data.message:
+        logger.debug(f"Processing message component for update {event_id}")
+        parts.append(handle_message(update_data.message))
+
+    if update_data.message_reaction:
+        logger.debug(f"Processing reaction for update {event_id}")
+        parts.append(handle_reaction(update_data.message_reaction))
+
+    if update_data.my_chat_member:
+        logger.debug(f"Processing my_chat_member component for update {event_id}")
+        parts.append(handle_chatmember_updated(update_data.my_chat_member))
+
+    if update_data.chat_member:
+        logger.debug(f"Processing chat_member component for update {event_id}")
+        parts.append(handle_chatmember_updated(update_data.chat_member))
+
+    callback_query = update_data.callback_query
+    if callback_query:
+        logger.debug(f"Processing callback query component for update {event_id}")
+        parts.append(nc.pub(
+            "youtube.callback",
+            {
+                "query": callback_query,
+                "timestamp": datetime.now().isoformat()
+            }
+        ))
+
+    await gather(*parts)
+
+
+@nc.sub("telegram.update", lane=CRITICAL, raw=True)
+async def update(payload: bytes):
+
+    # Decoded straight into the models; the parts of the update no handler
+    # reads are skipped.
     try:
-        message_data = update_data.get("message", {})
-        if message_data:
-            logger.info(f"Processing message component for update {event_id}")
-            await handle_message(message_data)
-
-        message_reaction = update_data.get("message_reaction", {})
-        if message_reaction:
-            logger.info(f"Processing reaction for update {event_id}")
-            await handle_reaction(message_reaction)
-
-        my_chat_member = update_data.get("my_chat_member", {})
-        if my_chat_member:
-            logger.info(f"Processing my_chat_member component for update {event_id}")
-            await handle_chatmember_updated(my_chat_member)
-
-        chat_member = update_data.get("chat_member", {})
-        if chat_member:
-            logger.info(f"Processing chat_member component for update {event_id}")
-            await handle_chatmember_updated(chat_member)
-
-        callback_query = update_data.get("callback_query", {})
-        if callback_query:
-            logger.info(f"Processing callback query component for update {event_id}")
-            await nc.pub(
-                "youtube.callback",
-                {
-                    "query": callback_query,
-                    "timestamp": datetime.now().isoformat()
-                }
-            )
+        event = decode_event(payload)
+    except ValueError as e:
+        await report_error(_event_id(payload), e)
+        return
+    tracer.set_attribute("event_id", event.event_id)
+    if not db.primary.available or spool.behind("telegram.update"):
+        # Keep ingesting while MySQL is down or stalled; the spool drainer
+        # runs the event once the primary recovers. Until the spooled
+        # updates have all run, newer ones queue behind them so that (say)
+        # a spooled join cannot land after a live leave.
+        await spool.defer("telegram.update", json.loads(payload))
+        return
+
+    try:
+        await process_event(event)
+    except UNAVAILABLE_ERRORS as e:
+        logger.warning(f"Spooling update {event.event_id}, primary unavailable: {e}")
+        await spool.defer("telegram.update", json.loads(payload))
+
+
+@spool.replayer("telegram.update")
+async def run_update(data: dict):
+    await process_event(UpdateEvent.from_dict(data))
 
+
+async def process_event(event: UpdateEvent):
+    """Processes one update and reports its outcome. Errors that mean the
+    primary is unreachable propagate so the caller can spool the event."""
+    
+    event_id = event.event_id
+
+    try:
+        await process_update(event.update or Update(), event_id)
         await nc.pub(
             "telegram.update.processed",
             {
@@ -452,16 +688,31 @@ async def update(data: dict):
             }
         )
     
+    except UNAVAILABLE_ERRORS:
+        raise
     except Exception as e:
-        logger.error(f"Error processing update {event_id}")
-        await nc.pub(
-            "telegram.update.error_processing",
-            {
-                "event_id": event_id,
-                "timestamp": datetime.now().isoformat(),
-                "error_message": str(e)
-            }
-        )
+        await report_error(event_id, e)
+
+
+async def report_error(event_id, error: Exception):
+    tracer.record_exception(error)
+    logger.error(f"Error processing update {event_id}")
+    await nc.pub(
+        "telegram.update.error_processing",
+        {
+            "event_id": event_id,
+            "timestamp": datetime.now().isoformat(),
+            "error_message": str(error)
+        }
+    )
+
+
+def _event_id(payload: bytes):
+    # For reporting a payload the models could not decode.
+    try:
+        return json.loads(payload).get("event_id")
+    except (ValueError, AttributeError):
+        return None
 
 
 @nc.sub("telegram.update.processed")
@@ -489,8 +740,9 @@ async def update_processed(data: dict):
     WHERE `id` = %s;
     """
     params = (timestamp, event_id)
-    updated = await db.aexecute_update(query, params)
-    logger.info(f"Updated {updated} event rows as processed.")
+    updated = await spool.execute_update(query, params)
+    if updated is not None:
+        logger.info(f"Updated {updated} event rows as processed.")
 
 
 @nc.sub("telegram.update.error_processing")
@@ -512,5 +764,6 @@ async def update_error_processing(data: dict):
     WHERE `id` = %s;
     """
     params = (error_message, event_id)
-    updated = await db.aexecute_update(query, params)
-    logger.info(f"Updated {updated} event rows as failed.")
\ No newline at end of file
+    updated = await spool.execute_update(query, params)
+    if updated is not None:
+        logger.info(f"Updated {updated} event rows as failed.")
\ No newline at end of file
@@ -1,8 +1,25 @@
+import argparse
 import logging
 import signal
 
 from common.nats_server import nc
+from common.watchdog import watchdog
+from common.rollup import rollup
+from common.mysql import MySQL as db
+from common.partitions import partitions
+from common.spool import spool
+from common.outbound import outbound
+from common.export import exports
+from common.telegram import TelegramBot as tg
+from common.config import NATS_CFG, configure_logging
+from common.startup import startup
 import handlers.update
+import handlers.sync
+import handlers.debug
+import handlers.admin
+import handlers.query
+import handlers.outbound
+import handlers.export
 
 import asyncio
 from anyio import run
@@ -13,10 +30,41 @@ class NATSService:
     def __init__(self):
         logger.info("Starting NATS Service")
         self.running = False
+        self.watchdog_task = None
+        self.rollup_task = None
+        self.replica_task = None
+        self.partition_task = None
+        self.spool_task = None
+        self.pool_task = None
+        self.lane_task = None
+        self.outbound_task = None
+        self.stopping = False
+        self.stopped = asyncio.Event()
+
+    async def initialise(self):
+        # Importing the service builds nothing; pools and clients are set up
+        # here, before subscribing, so the first updates after a deploy do
+        # not pay for them.
+        with startup.phase("mysql pools"):
+            await db.warm_up()
+        with startup.phase("telegram client"):
+            await tg.start()
+        with startup.phase("nats connect"):
+            await nc.connect()
+        with startup.phase("background tasks"):
+            self.watchdog_task = asyncio.create_task(watchdog.run())
+            self.rollup_task = asyncio.create_task(rollup.run())
+            self.partition_task = asyncio.create_task(partitions.run())
+            self.spool_task = asyncio.create_task(spool.run())
+            self.pool_task = asyncio.create_task(db.maintain_pools())
+            self.lane_task = asyncio.create_task(nc.background.run())
+            self.outbound_task = asyncio.create_task(outbound.run())
+            if db.replicas:
+                self.replica_task = asyncio.create_task(db.monitor_replicas())
 
     async def start(self):
         try:
-            await nc.connect()
+            await self.initialise()
             
             self.running = True
             logger.info("NATS Service started successfully")
@@ -24,18 +72,53 @@ class NATSService:
             # Keep running
             while self.running:
                 await asyncio.sleep(1)
+            # Returning ends the process; let stop() finish draining first.
+            await self.stopped.wait()
                 
         except Exception as e:
             logger.error(f"Failed to start NATS service: {e}")
             raise
     
     async def stop(self):
+        if self.stopping:
+            return
+        self.stopping = True
         logger.info("Stopping NATS Service...")
         self.running = False
+
+        # No new messages; handlers in flight finish and can still publish.
+        in_flight = await nc.drain(NATS_CFG.get("drain_timeout", 25))
+
+        tasks = [
+            task for task in (
+                self.watchdog_task, self.rollup_task, self.replica_task,
+                self.partition_task, self.spool_task, self.pool_task,
+                self.lane_task, self.outbound_task
+            ) if task
+        ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Exports in progress are not resumed; their consumers are told.
+        await exports.close()
+
+        # Buffered writers, while the database is still reachable.
+        try:
+            await rollup.flush()
+        except Exception as e:
+            logger.error(f"Final rollup flush failed: {e}")
+        # Background messages never started are replayed from the spool on the next start.
+        await nc.background.spill()
+
         await nc.close()
-        logger.info("NATS Service stopped")
+        await db.close()
+        await tg.close()
+        spool.close()
+        self.stopped.set()
+        logger.info(f"NATS Service stopped ({in_flight} handlers still in flight at the drain deadline)")
 
 async def main():
+    configure_logging()
     service = NATSService()
 
     def signal_handler():
@@ -51,5 +134,24 @@ async def main():
     except KeyboardInterrupt:
         await service.stop()
 
+async def profile_startup():
+    """Runs the startup phase once, stops, and prints how long importing
+    each module and each phase took."""
+    configure_logging()
+    service = NATSService()
+    try:
+        await service.initialise()
+    except Exception as e:
+        logger.error(f"Startup failed: {e}")
+    finally:
+        await service.stop()
+    print("\n".join(startup.report("main")))
+
 if __name__ == "__main__":
-    run(main)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--startup-profile", action="store_true",
+        help="report import and startup time per module and phase, then exit"
+    )
+    args = parser.parse_args()
+    run(profile_startup if args.startup_profile else main)
@@ -0,0 +1,46 @@
+"""Partition maintenance for `message` and `reaction`.
+
+    python manage_partitions.py maintain     # create months ahead, archive + drop expired
+    python manage_partitions.py status       # list partitions and their row estimates
+    python manage_partitions.py indexes      # index reads/writes since server start
+
+Meant to run from cron (daily). Expired partitions are those entirely older
+than PARTITION_RETENTION_MONTHS; they are written to ARCHIVE_PATH as gzipped
+NDJSON, verified by row count, then dropped.
+"""
+import argparse
+import logging
+
+from common.config import configure_logging
+from common.mysql import MySQL as db
+from common.partitions import partitions, PARTITIONED_TABLES
+
+import anyio
+
+logger = logging.getLogger()
+
+
+async def main(args):
+    if args.command == "maintain":
+        result = await partitions.maintain()
+        for table, changes in result.items():
+            print(f"{table}: created {changes['created'] or 'none'}, archived {changes['archived'] or 'none'}")
+
+    elif args.command == "status":
+        for table in PARTITIONED_TABLES:
+            for partition in await partitions.partitions(table):
+                print(f"{table}.{partition['name']:<10} < {partition['upper_bound'] or 'MAXVALUE'}  ~{partition['rows']} rows")
+
+    elif args.command == "indexes":
+        uptime = await db.aexecute_query("SHOW GLOBAL STATUS LIKE 'Uptime';", fetch_one=True, primary=True)
+        print(f"Index usage over the last {int(uptime['Value']) / 86400:.1f} days of server uptime:")
+        for row in await partitions.index_usage():
+            flag = "  <- unused" if not row['reads'] else ""
+            print(f"{row['table']}.{row['index']:<28} reads={row['reads']:<12} writes={row['writes']}{flag}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage message/reaction partitions")
+    parser.add_argument("command", choices=("maintain", "status", "indexes"))
+    configure_logging()
+    anyio.run(main, parser.parse_args())
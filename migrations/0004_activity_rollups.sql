@@ -0,0 +1,37 @@
+CREATE TABLE IF NOT EXISTS `kopilot_telegram`.`chat_activity_daily` (
+    `chat_id` BIGINT NOT NULL,
+    `day` DATE NOT NULL,
+    `messages` INT UNSIGNED NOT NULL DEFAULT 0,
+    `replies` INT UNSIGNED NOT NULL DEFAULT 0,
+    `reactions` INT UNSIGNED NOT NULL DEFAULT 0,
+    `date_modified` DATETIME(6) DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+
+    PRIMARY KEY (`chat_id`, `day`)
+);
+
+CREATE TABLE IF NOT EXISTS `kopilot_telegram`.`chatmember_activity_daily` (
+    `chat_id` BIGINT NOT NULL,
+    `user_id` BIGINT NOT NULL,
+    `day` DATE NOT NULL,
+    `messages` INT UNSIGNED NOT NULL DEFAULT 0,
+    `replies` INT UNSIGNED NOT NULL DEFAULT 0,
+    `reactions` INT UNSIGNED NOT NULL DEFAULT 0,
+    `date_modified` DATETIME(6) DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+
+    PRIMARY KEY (`chat_id`, `user_id`, `day`),
+    INDEX `idx_user_day` (`user_id`, `day`)
+);
+
+CREATE TABLE IF NOT EXISTS `kopilot_telegram`.`chat_type_activity_daily` (
+    `chat_id` BIGINT NOT NULL,
+    `day` DATE NOT NULL,
+    `type` ENUM(
+        'text', 'animation', 'audio', 'document',
+        'photo', 'sticker', 'video', 'video_note',
+        'voice', 'other'
+    ) NOT NULL,
+    `messages` INT UNSIGNED NOT NULL DEFAULT 0,
+    `date_modified` DATETIME(6) DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+
+    PRIMARY KEY (`chat_id`, `day`, `type`)
+);
@@ -0,0 +1,49 @@
+-- Monthly RANGE partitioning of `message` and `reaction` by `date`.
+--
+-- MySQL cannot partition tables that have foreign keys or are referenced by
+-- one, so the constraints on both tables are dropped; the handlers already
+-- resolve every referenced row before inserting. The primary key has to
+-- contain the partitioning column and becomes (`id`, `date`).
+--
+-- No secondary index has to go for either change, so all of them are kept.
+-- Those left behind by the dropped foreign keys, or on flags nothing filters
+-- on, are only candidates: drop them once `manage_partitions.py indexes`
+-- shows them unused over a representative uptime.
+--
+-- Both tables start out as a single `p_future` partition. Run
+-- `manage_partitions.py maintain` right after this migration: it splits
+-- `p_future` into `p_history` (everything before the current month) and the
+-- months ahead, and keeps adding months and archiving expired ones from
+-- then on.
+
+ALTER TABLE `kopilot_telegram`.`reaction`
+DROP FOREIGN KEY `fk_reaction_chatmember`,
+DROP FOREIGN KEY `fk_reaction_user`,
+DROP FOREIGN KEY `fk_reaction_chat`,
+DROP FOREIGN KEY `fk_reaction_message`;
+
+ALTER TABLE `kopilot_telegram`.`message`
+DROP FOREIGN KEY `fk_message_chatmember`,
+DROP FOREIGN KEY `fk_message_user`,
+DROP FOREIGN KEY `fk_message_chat`,
+DROP FOREIGN KEY `fk_message_reply`;
+
+ALTER TABLE `kopilot_telegram`.`message`
+ADD INDEX `idx_chat_message` (`chat_id`, `message_id`),
+DROP PRIMARY KEY,
+ADD PRIMARY KEY (`id`, `date`);
+
+ALTER TABLE `kopilot_telegram`.`reaction`
+ADD INDEX `idx_chat_message` (`chat_id`, `message_id`),
+DROP PRIMARY KEY,
+ADD PRIMARY KEY (`id`, `date`);
+
+ALTER TABLE `kopilot_telegram`.`message`
+PARTITION BY RANGE COLUMNS(`date`) (
+    PARTITION `p_future` VALUES LESS THAN (MAXVALUE)
+);
+
+ALTER TABLE `kopilot_telegram`.`reaction`
+PARTITION BY RANGE COLUMNS(`date`) (
+    PARTITION `p_future` VALUES LESS THAN (MAXVALUE)
+);
@@ -0,0 +1,28 @@
+-- Outbound queue for telegram.send / telegram.broadcast.
+CREATE TABLE IF NOT EXISTS `kopilot_telegram`.`outbound_message` (
+    `id` BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+    `broadcast_id` VARCHAR(64) NULL,
+    `chat_id` BIGINT NOT NULL,
+    `text` TEXT NOT NULL,
+    `options` JSON NULL,
+    `state` ENUM('queued', 'sending', 'sent', 'failed') NOT NULL DEFAULT 'queued',
+    `attempts` SMALLINT UNSIGNED NOT NULL DEFAULT 0,
+    -- Earliest next attempt while queued; lease expiry while sending.
+    `not_before` DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    `claim` CHAR(32) NULL,
+    `message_id` BIGINT NULL,
+    `error` VARCHAR(255) NULL,
+    `date_created` DATETIME(6) DEFAULT CURRENT_TIMESTAMP(6),
+    `date_modified` DATETIME(6) DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6),
+
+    INDEX `idx_state_not_before` (`state`, `not_before`),
+    INDEX `idx_claim` (`claim`),
+    INDEX `idx_broadcast_id` (`broadcast_id`)
+);
+
+-- can_chat becomes tri-state: NULL unknown, TRUE delivered to, FALSE blocked
+-- the bot. Nothing wrote it before, so every FALSE so far is the default.
+ALTER TABLE `kopilot_telegram`.`user`
+MODIFY COLUMN `can_chat` BOOLEAN NULL DEFAULT NULL;
+
+UPDATE `kopilot_telegram`.`user` SET `can_chat` = NULL WHERE `can_chat` = FALSE;
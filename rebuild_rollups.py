@@ -0,0 +1,112 @@
+"""Regenerate the *_activity_daily rollup tables from `message` and `reaction`.
+
+    python rebuild_rollups.py --from 2025-01-01 --to 2026-10-18 [--chat-id ID]
+
+Days are rebuilt one at a time: the rollup rows of the day are deleted and
+recomputed from the raw tables in one transaction. The range defaults to
+everything up to yesterday; rebuilding today races with live increments
+flushed by the running service.
+"""
+import argparse
+import logging
+from datetime import date, datetime, timedelta
+
+from common.config import configure_logging
+from common.mysql import MySQL as db
+
+import anyio
+
+logger = logging.getLogger()
+
+TABLES = ("chat_activity_daily", "chatmember_activity_daily", "chat_type_activity_daily")
+
+REBUILD_STATEMENTS = (
+    """
+    INSERT INTO `kopilot_telegram`.`chat_activity_daily` (`chat_id`, `day`, `messages`, `replies`)
+    SELECT `chat_id`, DATE(`date`), COUNT(*), SUM(`reply_to_message_id` IS NOT NULL)
+    FROM `kopilot_telegram`.`message`
+    WHERE `date` >= %s AND `date` < %s {chat_filter}
+    GROUP BY `chat_id`, DATE(`date`);
+    """,
+    """
+    INSERT INTO `kopilot_telegram`.`chat_activity_daily` (`chat_id`, `day`, `reactions`)
+    SELECT `chat_id`, DATE(`date`), COUNT(*)
+    FROM `kopilot_telegram`.`reaction`
+    WHERE `date` >= %s AND `date` < %s {chat_filter}
+    GROUP BY `chat_id`, DATE(`date`)
+    ON DUPLICATE KEY UPDATE `reactions` = VALUES(`reactions`);
+    """,
+    """
+    INSERT INTO `kopilot_telegram`.`chatmember_activity_daily` (`chat_id`, `user_id`, `day`, `messages`, `replies`)
+    SELECT `chat_id`, `user_id`, DATE(`date`), COUNT(*), SUM(`reply_to_message_id` IS NOT NULL)
+    FROM `kopilot_telegram`.`message`
+    WHERE `date` >= %s AND `date` < %s {chat_filter}
+    GROUP BY `chat_id`, `user_id`, DATE(`date`);
+    """,
+    """
+    INSERT INTO `kopilot_telegram`.`chatmember_activity_daily` (`chat_id`, `user_id`, `day`, `reactions`)
+    SELECT `chat_id`, `user_id`, DATE(`date`), COUNT(*)
+    FROM `kopilot_telegram`.`reaction`
+    WHERE `date` >= %s AND `date` < %s {chat_filter}
+    GROUP BY `chat_id`, `user_id`, DATE(`date`)
+    ON DUPLICATE KEY UPDATE `reactions` = VALUES(`reactions`);
+    """,
+    """
+    INSERT INTO `kopilot_telegram`.`chat_type_activity_daily` (`chat_id`, `day`, `type`, `messages`)
+    SELECT `chat_id`, DATE(`date`), COALESCE(`type`, 'other'), COUNT(*)
+    FROM `kopilot_telegram`.`message`
+    WHERE `date` >= %s AND `date` < %s {chat_filter}
+    GROUP BY `chat_id`, DATE(`date`), COALESCE(`type`, 'other');
+    """,
+)
+
+
+def rebuild_day(day: date, chat_id=None):
+    start = datetime.combine(day, datetime.min.time())
+    end = start + timedelta(days=1)
+    chat_filter = "AND `chat_id` = %s" if chat_id else ""
+    chat_params = (chat_id,) if chat_id else ()
+
+    with db.connection() as con:
+        cursor = con.cursor()
+        try:
+            for table in TABLES:
+                cursor.execute(
+                    f"DELETE FROM `kopilot_telegram`.`{table}` WHERE `day` = %s {chat_filter};",
+                    (day, *chat_params)
+                )
+            for statement in REBUILD_STATEMENTS:
+                cursor.execute(statement.format(chat_filter=chat_filter), (start, end, *chat_params))
+            con.commit()
+        finally:
+            cursor.close()
+
+
+async def rebuild(args):
+    first_day = args.from_day
+    if first_day is None:
+        row = await db.aexecute_query(
+            "SELECT DATE(MIN(`date`)) AS `day` FROM `kopilot_telegram`.`message`;",
+            fetch_one=True
+        )
+        first_day = row['day'] if row and row['day'] else args.to_day
+
+    day = first_day
+    while day <= args.to_day:
+        async with db.primary.limiter:
+            await anyio.to_thread.run_sync(rebuild_day, day, args.chat_id)
+        logger.info(f"Rebuilt activity rollups for {day}")
+        day += timedelta(days=1)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild the daily activity rollup tables")
+    parser.add_argument("--from", dest="from_day", type=date.fromisoformat, default=None)
+    parser.add_argument("--to", dest="to_day", type=date.fromisoformat, default=date.today() - timedelta(days=1))
+    parser.add_argument("--chat-id", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    configure_logging()
+    anyio.run(rebuild, parse_args())
@@ -0,0 +1,232 @@
+"""Reprocess rows of kopilot_events.raw_events through the update handlers.
+
+    python replay.py --status failed --workers 8
+    python replay.py --from-id 1000 --to-id 250000 --bot-api cache
+
+Rows are read in id order, a keyset page of `--batch-size` rows at a time
+(`id` > last ORDER BY `id` LIMIT n), each fetched whole so no cursor stays
+open while the batch is processed. Each batch has its users and chats
+upserted in bulk, its events run through process_update on
+`--workers` workers (events of one chat stay on one worker, in order), and
+its statuses written back in bulk before the checkpoint advances.
+"""
+import argparse
+import json
+import logging
+import os
+from datetime import datetime
+from typing import Dict, Any, List, Tuple
+
+from common.config import REPLAY_CFG, configure_logging
+from common.mysql import MySQL as db
+from common.nats_server import nc
+from common.telegram import TelegramBot as tg
+from common.rollup import rollup
+from common.models import Update, User, Chat, Message, MessageReactionUpdated, decode
+from handlers.update import process_update, handle_users, handle_chats, known_rows
+
+import anyio
+
+logger = logging.getLogger()
+
+
+def update_parts(update_data: Update) -> list:
+    return [
+        part for part in (
+            update_data.message, update_data.message_reaction,
+            update_data.my_chat_member, update_data.chat_member
+        ) if part is not None
+    ]
+
+
+def update_entities(update_data: Update) -> Tuple[List[User], List[Chat]]:
+    users, chats = [], []
+    for part in update_parts(update_data):
+        if part.chat.type in ("group", "supergroup"):
+            chats.append(part.chat)
+        if isinstance(part, Message):
+            users.append(part.from_)
+            users.extend(part.new_chat_members or [])
+            users.append(part.left_chat_member)
+        elif isinstance(part, MessageReactionUpdated):
+            users.append(part.user)
+        else:
+            users.append(part.from_)
+            users.append(part.new_chat_member.user if part.new_chat_member else None)
+    return [user for user in users if user], chats
+
+
+def update_chat_id(update_data: Update) -> int:
+    parts = update_parts(update_data)
+    return parts[0].chat.id if parts else 0
+
+
+class Checkpoint:
+    def __init__(self, path: str, filters: Dict[str, Any]):
+        self.path = path
+        self.filters = filters
+
+    def load(self) -> int:
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path, encoding="utf-8") as f:
+            state = json.load(f)
+        if state.get("filters") != self.filters:
+            logger.warning(f"Ignoring checkpoint {self.path}: it was written for {state.get('filters')}")
+            return 0
+        return state.get("last_id", 0)
+
+    def save(self, last_id: int):
+        if not self.path:
+            return
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"last_id": last_id, "filters": self.filters}, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+async def mark_done(event_ids: List[int]):
+    if not event_ids:
+        return
+    query = f"""
+    UPDATE `kopilot_events`.`raw_events`
+    SET
+        `processed` = TRUE,
+        `processed_at` = %s,
+        `status` = 'done'
+    WHERE `id` IN ({", ".join(["%s"] * len(event_ids))});
+    """
+    await db.aexecute_update(query, (datetime.now(), *event_ids))
+
+
+async def mark_failed(failures: List[Tuple[int, str]]):
+    if not failures:
+        return
+    query = """
+    UPDATE `kopilot_events`.`raw_events`
+    SET
+        `status` = 'failed',
+        `error_message` = %s,
+        `retry_count` = `retry_count` + 1
+    WHERE `id` = %s;
+    """
+    await db.aexecute_many(query, [(error, event_id) for event_id, error in failures])
+
+
+async def replay_batch(rows: List[dict], workers: int) -> Tuple[List[int], List[Tuple[int, str]]]:
+    events, failed = [], []
+    users, chats = [], []
+    for row in rows:
+        payload = row["payload"]
+        try:
+            if isinstance(payload, (str, bytes, bytearray)):
+                update_data = decode(payload, Update)
+            else:
+                update_data = Update.from_dict(payload)
+        except ValueError as e:
+            logger.error(f"Replay of event {row['id']} failed, undecodable payload: {e}")
+            failed.append((row["id"], str(e)))
+            continue
+        events.append((row["id"], update_data))
+        batch_users, batch_chats = update_entities(update_data)
+        users.extend(batch_users)
+        chats.extend(batch_chats)
+
+    user_ids = await handle_users(users)
+    chat_ids = await handle_chats(chats)
+    known_rows.set({("user", user_id) for user_id in user_ids} | {("chat", chat_id) for chat_id in chat_ids})
+
+    lanes: List[List[tuple]] = [[] for _ in range(workers)]
+    for event_id, update_data in events:
+        lanes[hash(update_chat_id(update_data)) % workers].append((event_id, update_data))
+
+    done = []
+
+    async def work(lane):
+        for event_id, update_data in lane:
+            try:
+                await process_update(update_data, event_id)
+                done.append(event_id)
+            except Exception as e:
+                logger.error(f"Replay of event {event_id} failed: {e}")
+                failed.append((event_id, str(e)))
+
+    async with anyio.create_task_group() as task_group:
+        for lane in lanes:
+            if lane:
+                task_group.start_soon(work, lane)
+
+    return done, failed
+
+
+async def replay(args):
+    if args.bot_api == "skip":
+        tg.offline = True
+    elif args.bot_api == "cache":
+        tg.enable_cache(("getChatMember",))
+
+    filters = {"from_id": args.from_id, "to_id": args.to_id, "status": args.status}
+    checkpoint = Checkpoint(args.checkpoint, filters)
+    last_id = max(args.from_id, 0 if args.restart else checkpoint.load())
+    if last_id > args.from_id:
+        logger.info(f"Resuming replay after event {last_id}")
+
+    conditions, params = ["`id` > %s"], []
+    if args.to_id:
+        conditions.append("`id` <= %s")
+        params.append(args.to_id)
+    if args.status:
+        conditions.append("`status` = %s")
+        params.append(args.status)
+    query = f"""
+    SELECT `id`, `{REPLAY_CFG['payload_column']}` AS `payload`
+    FROM `kopilot_events`.`raw_events`
+    WHERE {" AND ".join(conditions)}
+    ORDER BY `id`
+    LIMIT %s;
+    """
+
+    # Publish only: this process must not start consuming live subjects.
+    await nc.connect(register_handlers=False)
+    total_done, total_failed = 0, 0
+    try:
+        while True:
+            rows = await db.aexecute_query(query, (last_id, *params, args.batch_size))
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            done, failed = await replay_batch(rows, args.workers)
+            await rollup.flush()
+            await mark_done(done)
+            await mark_failed(failed)
+
+            checkpoint.save(last_id)
+            total_done += len(done)
+            total_failed += len(failed)
+            logger.info(
+                f"Replayed events up to {last_id}: "
+                f"{total_done} done, {total_failed} failed so far"
+            )
+            if len(rows) < args.batch_size:
+                break
+    finally:
+        await nc.close()
+
+    logger.info(f"Replay finished: {total_done} done, {total_failed} failed")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay kopilot_events.raw_events through the update handlers")
+    parser.add_argument("--from-id", type=int, default=0, help="replay events with id greater than this")
+    parser.add_argument("--to-id", type=int, default=None, help="replay events with id up to and including this")
+    parser.add_argument("--status", choices=("pending", "done", "failed"), default=None)
+    parser.add_argument("--workers", type=int, default=REPLAY_CFG["workers"])
+    parser.add_argument("--batch-size", type=int, default=REPLAY_CFG["batch_size"])
+    parser.add_argument("--bot-api", choices=("live", "cache", "skip"), default="cache")
+    parser.add_argument("--checkpoint", default=REPLAY_CFG["checkpoint"])
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    configure_logging()
+    anyio.run(replay, parse_args())